@@ -0,0 +1,90 @@
+"""Время и память импорта pypkk и первой работы с геометрией.
+
+Каждый замер - в отдельном процессе, чтобы модули не были загружены заранее:
+- `import pypkk` (только запросы атрибутов);
+- `import pypkk` и первый перевод геометрии (загрузка shapely и pyproj);
+- `import pypkk.image` (весь стек векторизации с opencv).
+
+Выводятся медиана времени, RSS процесса и самые долгие модули
+по `python -X importtime`:
+
+    python benchmarks/bench_import.py [--repeat 10] [--top 10]
+"""
+
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+
+CASES = {
+    "attrs": "import pypkk",
+    "geometry": (
+        "import pypkk\n"
+        "from shapely.geometry import Point\n"
+        "from pypkk.geom_utils import to_4326\n"
+        "to_4326(Point(4187000, 7508000))"
+    ),
+    "image": "import pypkk.image",
+}
+
+_MEASURE = """
+import resource, sys
+from time import perf_counter
+start = perf_counter()
+exec(compile(sys.argv[1], "<case>", "exec"))
+duration = perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(duration, rss)
+"""
+
+_IMPORTTIME = re.compile(r"import time:\s+\d+ \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def measure(code: str) -> tuple[float, int]:
+    """Время выполнения `code` в новом процессе (с) и пиковый RSS (КиБ)"""
+    out = subprocess.run(
+        [sys.executable, "-c", _MEASURE, code],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+    return float(out[0]), int(out[1])
+
+
+def slowest_imports(code: str, top: int) -> list[tuple[str, float]]:
+    """Модули первых двух уровней вложенности с наибольшим накопленным
+    временем импорта (мс)"""
+    err = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    modules = []
+    for match in _IMPORTTIME.finditer(err):
+        cumulative, indent, name = match.groups()
+        # отступ 1 - модули из кода замера, 3 - импортированные ими
+        if len(indent) <= 3:
+            modules.append((name, int(cumulative) / 1000))
+    return sorted(modules, key=lambda i: -i[1])[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", nargs="+", default=list(CASES), choices=CASES)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    for name in args.cases:
+        runs = [measure(CASES[name]) for _ in range(args.repeat)]
+        duration = statistics.median(i[0] for i in runs)
+        rss = max(i[1] for i in runs)
+        print(f"{name}: {duration * 1000:.0f} мс, RSS {rss / 1024:.1f} МиБ")
+        for module, ms in slowest_imports(CASES[name], args.top):
+            print(f"    {module:<40} {ms:8.1f} мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Сравнение векторизации по тайлам и через мозаику на синтетических объектах.
+
+Запуск: python benchmarks/bench_mosaic.py [--repeat 3]
+"""
+
+import argparse
+from itertools import product
+from time import perf_counter
+
+import cv2
+import numpy as np
+from shapely.affinity import translate
+from shapely.geometry import MultiPoint, Polygon
+from shapely.geometry.base import BaseGeometry
+
+from pypkk.geom_utils import to_4326
+from pypkk.image import TilePayload, extract_geometry, extract_mosaic_geometry
+from pypkk.schemas.coords import PkkExtent
+from pypkk.tile_utils import DEFAULT_SCALE, PKK_MAX_TILE_SIZE, generate_tile_extents
+
+# (число тайлов, сетка строк x столбцов)
+CASES = [(10, (2, 5)), (50, (5, 10)), (100, (10, 10))]
+
+
+def make_polygon(width: float, height: float, vertices: int = 2000) -> Polygon:
+    """Извилистый контур с большим числом вершин, вписанный в экстент"""
+    t = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    r = 0.42 + 0.05 * np.sin(t * 37) + 0.03 * np.cos(t * 91)
+    x = width / 2 + r * width * np.cos(t)
+    y = height / 2 + r * height * np.sin(t)
+    return Polygon(np.column_stack([x, y]))
+
+
+def make_fragmented(width: float, height: float, holes: int = 400) -> BaseGeometry:
+    """Контур с множеством дыр, режущихся границами тайлов"""
+    rng = np.random.default_rng(0)
+    shell = make_polygon(width, height)
+    centers = rng.uniform(
+        (0.25 * width, 0.25 * height), (0.75 * width, 0.75 * height), (holes, 2)
+    )
+    radius = min(width, height) / 80
+    return shell.difference(MultiPoint(centers).buffer(radius, quad_segs=4))
+
+
+SHAPES = {"simple": make_polygon, "fragmented": make_fragmented}
+
+
+def render_tiles(polygon: BaseGeometry, extents: list[PkkExtent]) -> list[TilePayload]:
+    tiles = []
+    for e in extents:
+        width = min(round((e.xmax - e.xmin) * DEFAULT_SCALE), PKK_MAX_TILE_SIZE)
+        height = min(round((e.ymax - e.ymin) * DEFAULT_SCALE), PKK_MAX_TILE_SIZE)
+        img = np.full((height, width), 255, dtype=np.uint8)
+
+        def to_pixels(ring):
+            coords = np.asarray(ring.coords)
+            px = (coords[:, 0] - e.xmin) / (e.xmax - e.xmin) * width
+            py = (e.ymax - coords[:, 1]) / (e.ymax - e.ymin) * height
+            return np.round(np.column_stack([px, py])).astype(np.int32)
+
+        for part in getattr(polygon, "geoms", [polygon]):
+            cv2.fillPoly(img, [to_pixels(part.exterior)], 0)
+            if part.interiors:
+                cv2.fillPoly(img, [to_pixels(i) for i in part.interiors], 255)
+        png = cv2.imencode(".png", img)[1].tobytes()
+        tiles.append(TilePayload(png, (e.xmin, e.ymin, e.xmax, e.ymax), width, height))
+    return tiles
+
+
+def bench(func, tiles, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        func(tiles)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    step = PKK_MAX_TILE_SIZE / DEFAULT_SCALE - 20
+    print(f"{'shape':>10} {'tiles':>6} {'tiles, s':>10} {'mosaic, s':>10} {'diff':>10}")
+    for (_, (rows, cols)), (name, make) in product(CASES, SHAPES.items()):
+        # объект в районе Москвы, чтобы перепроецирование было реалистичным
+        polygon = translate(make(cols * step, rows * step), 4185000.0, 7510000.0)
+        xmin, ymin, xmax, ymax = polygon.bounds
+        extent = PkkExtent(xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax)
+        tiles = render_tiles(polygon, generate_tile_extents(extent))
+        tiles_time = bench(extract_geometry, tiles, args.repeat)
+        mosaic_time = bench(extract_mosaic_geometry, tiles, args.repeat)
+        reference = to_4326(polygon)
+        diff = extract_mosaic_geometry(tiles).symmetric_difference(reference)
+        print(
+            f"{name:>10} {len(tiles):>6} {tiles_time:>10.2f} {mosaic_time:>10.2f}"
+            f" {diff.area / reference.area:>10.5f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
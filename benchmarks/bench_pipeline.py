@@ -0,0 +1,286 @@
+"""Сквозной бенчмарк get_geojson на локальной подмене ПКК (pypkk.testing).
+
+Для участков small/complex/large измеряются:
+- пропускная способность и перцентили задержки AsyncPKK.get_geojson;
+- процессорное время стадий векторизации: декодирование png, поиск контуров,
+  сборка полигонов, перепроецирование, объединение;
+- пиковая память векторизации (tracemalloc) и пиковый RSS процесса.
+
+Результат пишется в json с хешем коммита, чтобы сравнивать коммиты между собой:
+
+    python benchmarks/bench_pipeline.py --output before.json
+    git checkout other-branch
+    python benchmarks/bench_pipeline.py --compare before.json
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter, process_time
+
+from shapely.ops import unary_union
+from shapely.validation import make_valid
+
+from pypkk.api import AsyncPKK
+from pypkk.geom_utils import to_4326
+from pypkk.image import (
+    _decode_mask,
+    _get_mask_xy_corner,
+    _xy_corner_to_geometry,
+    extract_geometry,
+)
+from pypkk.schemas.inputs import Cn
+from pypkk.testing import FakePkkTransport, sample_parcels
+from pypkk.tile_utils import plan_tile_extents
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if dirty else commit
+
+
+def percentile(values: list[float], q: float) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+async def bench_end_to_end(
+    fake, cn: Cn, requests: int, concurrency: int, executor, coalesce: bool = False
+):
+    """Задержка каждого get_geojson и общая пропускная способность.
+
+    Кэши выключены, а тайлы подмена рисует один раз на прогреве,
+    поэтому измеряется сам клиент, а не отрисовка тайлов. Все вызовы
+    строят один и тот же объект, поэтому объединение одинаковых запросов
+    (coalesce) по умолчанию выключено: иначе одновременные вызовы
+    сливались бы в один и пропускная способность завышалась бы"""
+    async with AsyncPKK(
+        cache_type=None,
+        api_rate_limit=None,
+        tile_rate_limit=None,
+        executor=executor,
+        transport=fake,
+        coalesce=coalesce,
+    ) as api:
+        feature = (await api.get_attrs(cn)).feature
+        await api.get_geojson(feature)
+        tiles_before = fake.calls["tile", 200]
+        latencies: list[float] = []
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                start = perf_counter()
+                await api.get_geojson(feature)
+                latencies.append(perf_counter() - start)
+
+        start = perf_counter()
+        await asyncio.gather(*(one() for _ in range(requests)))
+        elapsed = perf_counter() - start
+    return {
+        "requests": requests,
+        "tile_requests": fake.calls["tile", 200] - tiles_before,
+        "throughput": requests / elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+    }
+
+
+async def fetch_tiles(fake, cn: Cn):
+    async with AsyncPKK(
+        cache_type=None,
+        api_rate_limit=None,
+        tile_rate_limit=None,
+        executor=None,
+        transport=fake,
+    ) as api:
+        feature = (await api.get_attrs(cn)).feature
+        return await api._fetch_tiles(feature, *plan_tile_extents(feature.extent))
+
+
+def bench_stages(tiles) -> dict[str, float]:
+    """Процессорное время стадий векторизации сеткой тайлов, с"""
+    stages = dict.fromkeys(["decode", "contours", "polygons", "reproject", "union"], 0)
+    geoms = []
+    for tile in tiles:
+        start = process_time()
+        mask = _decode_mask(tile.image)
+        stages["decode"] += process_time() - start
+
+        start = process_time()
+        corners = _get_mask_xy_corner(mask)
+        stages["contours"] += process_time() - start
+        if corners is None:
+            continue
+
+        start = process_time()
+        xmin, ymin, xmax, ymax = tile.extent
+        dx = (xmax - xmin) / tile.width
+        dy = (ymax - ymin) / tile.height
+        geoms.append(make_valid(_xy_corner_to_geometry(corners, xmin, ymax, dx, dy)))
+        stages["polygons"] += process_time() - start
+    # как в extract_geometry: объединение в epsg:3857, перепроецирование один раз
+    start = process_time()
+    merged = unary_union(geoms)
+    stages["union"] += process_time() - start
+    start = process_time()
+    make_valid(to_4326(merged))
+    stages["reproject"] += process_time() - start
+    return stages
+
+
+def bench_memory(tiles) -> float:
+    """Пиковая память векторизации, МБ (без памяти внутри OpenCV и GEOS)"""
+    tracemalloc.start()
+    try:
+        extract_geometry(tiles)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 2**20
+
+
+def max_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux отдает килобайты, macos - байты
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+async def run(args) -> dict:
+    parcels = sample_parcels()
+    cases = {}
+    for name in args.cases:
+        parcel = parcels[name]
+        fake = FakePkkTransport(
+            [parcel],
+            latency=args.latency,
+            tile_errors={400: args.tile_400, 502: args.tile_502},
+            api_errors={502: args.api_502},
+        )
+        cn = Cn.zu(parcel.code)
+        tiles = await fetch_tiles(fake, cn)
+        stages = bench_stages(tiles)
+        case = {
+            "tiles": len(tiles),
+            "tile_bytes": sum(len(i.image) for i in tiles),
+            "end_to_end": await bench_end_to_end(
+                fake, cn, args.requests, args.concurrency, args.executor
+            ),
+            # отдельный случай: одновременные вызовы для одного объекта
+            # сливаются в один, тайлов запрашивается меньше
+            "coalesced": await bench_end_to_end(
+                fake, cn, args.requests, args.concurrency, args.executor, True
+            ),
+            "cpu": stages,
+            "cpu_total": sum(stages.values()),
+            "peak_memory_mb": bench_memory(tiles),
+        }
+        cases[name] = case
+        print_case(name, case)
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {
+            k: v for k, v in vars(args).items() if k not in ("output", "compare")
+        },
+        "max_rss_mb": max_rss_mb(),
+        "cases": cases,
+    }
+
+
+def print_case(name: str, case: dict):
+    e2e = case["end_to_end"]
+    coalesced = case["coalesced"]
+    cpu = " ".join(f"{k}={v:.3f}" for k, v in case["cpu"].items())
+    print(
+        f"{name:>8}: {case['tiles']} tiles, {e2e['throughput']:.2f} req/s, "
+        f"p50={e2e['p50']:.3f}s p95={e2e['p95']:.3f}s, cpu[{cpu}], "
+        f"peak={case['peak_memory_mb']:.1f}MB; coalesced "
+        f"{coalesced['throughput']:.2f} req/s, "
+        f"{coalesced['tile_requests']}/{e2e['tile_requests']} tile requests"
+    )
+
+
+def compare(current: dict, baseline: dict):
+    """Отношение текущих метрик к базовым: для задержек, cpu и памяти
+    меньше 1 - лучше, для пропускной способности - наоборот"""
+    metrics = [
+        ("p50", lambda c: c["end_to_end"]["p50"]),
+        ("p95", lambda c: c["end_to_end"]["p95"]),
+        ("throughput", lambda c: c["end_to_end"]["throughput"]),
+        ("cpu_total", lambda c: c["cpu_total"]),
+        ("peak_memory_mb", lambda c: c["peak_memory_mb"]),
+    ]
+    print(f"\n{baseline['commit']} -> {current['commit']}")
+    print(f"{'case':>8} " + " ".join(f"{name:>15}" for name, _ in metrics))
+    for name, case in current["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        base = baseline["cases"][name]
+        ratios = []
+        for _, get in metrics:
+            ratio = get(case) / get(base) if get(base) else float("nan")
+            ratios.append(f"{ratio:>15.2f}")
+        print(f"{name:>8} " + " ".join(ratios))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--cases", nargs="+", default=list(sample_parcels()), help="участки"
+    )
+    parser.add_argument("--requests", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--executor", choices=["process", "thread"], default="process")
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="задержка ответа, с"
+    )
+    parser.add_argument("--tile-400", type=float, default=0.0, help="доля ответов 400")
+    parser.add_argument("--tile-502", type=float, default=0.0, help="доля ответов 502")
+    parser.add_argument("--api-502", type=float, default=0.0, help="доля ответов 502")
+    parser.add_argument(
+        "--output",
+        type=Path,
+        help="файл результата; по умолчанию results/<коммит>.json",
+    )
+    parser.add_argument("--compare", type=Path, help="результат для сравнения")
+    args = parser.parse_args()
+    result = asyncio.run(run(args))
+    output = args.output or RESULTS_DIR / f"{result['commit']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2))
+    print(f"saved {output}")
+    if args.compare is not None:
+        compare(result, json.loads(args.compare.read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,68 @@
 import asyncio
-from typing import Literal, Optional
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    Iterator,
+    Literal,
+    Optional,
+    TypeVar,
+    Union,
+)
 
 import hishel
 import httpx
-from shapely.geometry import mapping
 
-from pypkk.image import extract_geometry_from_tiles
+from pypkk.async_utils import (
+    SingleFlight,
+    SingleFlightStats,
+    gather_cancelling,
+    map_bounded,
+)
+from pypkk.cache import (
+    MEMORY_CACHE_BYTES,
+    MEMORY_CACHE_ENTRIES,
+    CacheArg,
+    MemoryCacheStats,
+    build_async_storage,
+    build_storage,
+)
+from pypkk.geometry_cache import (
+    DEFAULT_GEOMETRY_CACHE_PATH,
+    DEFAULT_GEOMETRY_CACHE_TTL,
+    GeometryCache,
+)
+from pypkk.instrumentation import ObserverArg, emit, run_timed
+from pypkk.rate_limit import (
+    AsyncRateLimitedTransport,
+    RateLimitArg,
+    RateLimitedTransport,
+    RateLimiter,
+    RateLimiterStats,
+    as_rate_limiter,
+)
 from pypkk.requests import (
+    API_HOST,
     CLIENT_ARGS,
-    SSL_CONTEXT,
+    DEFAULT_API_RATE_LIMIT,
+    DEFAULT_TILE_RATE_LIMIT,
+    SELECTED_TILE_HOST,
+    TileFormat,
+    TileLayer,
     api_request,
     async_api_request,
     async_tile_request,
     tile_request,
 )
+from pypkk.retry import RetryPolicy, RetryStats
+from pypkk.schemas.coords import PkkExtent
 from pypkk.schemas.features import (
     OksGeojson,
     PkkGeojson,
@@ -21,11 +70,41 @@ from pypkk.schemas.features import (
     PkkType,
     ZuGeojson,
 )
-from pypkk.schemas.inputs import Cn
+from pypkk.schemas.inputs import Cn, KvartalCn
 from pypkk.schemas.responses import PkkAtPointResponse, PkkFeatureResponse
-from pypkk.tile_utils import generate_tile_extents
+from pypkk.tile_utils import (
+    ADAPTIVE_MIN_TILES,
+    DEFAULT_RESOLUTION,
+    DEFAULT_SCALE,
+    MAX_SUBTILES_PER_CN,
+    TILE_BUFFER,
+    buffer_extent,
+    coarse_scale,
+    generate_coarse_tile_extents,
+    generate_kvartal_tile_extents,
+    plan_tile_extents,
+)
+from pypkk.transport import PoolConfig, PoolStats, TransportManager
+
+# стек геометрии (pypkk.image, shapely, opencv, pyproj) импортируется
+# внутри методов при первой работе с геометрией: запросам атрибутов
+# он не нужен, а его загрузка занимает большую часть импорта pypkk
+if TYPE_CHECKING:
+    from shapely.geometry import MultiPolygon
+    from shapely.geometry.base import BaseGeometry
+
+    from pypkk.geom_utils import OutputCrs
+    from pypkk.image import TilePayload
+
+T = TypeVar("T")
 
 tolerance = 4
+# сколько тайлов одного объекта запрашивается одновременно
+TILE_CONCURRENCY = 8
+# сколько тайлов одновременно запрашивает весь клиент
+CLIENT_TILE_CONCURRENCY = 16
+# сколько кадастровых номеров одновременно обрабатывается в пакетных методах
+BULK_CONCURRENCY = 8
 _hishel_controller = hishel.Controller(
     allow_stale=True,
     force_cache=True,
@@ -33,27 +112,202 @@ _hishel_controller = hishel.Controller(
 )
 
 
+# где векторизуются тайлы: "thread" - пул потоков (opencv и shapely отпускают
+# GIL), None - в текущем потоке; можно передать и свой Executor.
+# "process" - пул процессов spawn, только по явному выбору: дочерние процессы
+# заново импортируют главный модуль, поэтому скрипт должен запускать клиента
+# под `if __name__ == "__main__":`, иначе первая же векторизация упадет
+# с BrokenProcessPool
+ExecutorArg = Optional[Union[Literal["process", "thread"], Executor]]
+# "adaptive" - грубый проход + уточнение только на границе контура,
+# "grid" - равномерная сетка тайлов по всему экстенту
+TilePlanner = Literal["adaptive", "grid"]
+# "tiles" - контуры ищутся в каждом тайле и объединяются,
+# "mosaic" - тайлы склеиваются в один растр и контуры ищутся один раз
+ExtractionMode = Literal["tiles", "mosaic"]
+
+
 class NoCoordsFeatureError(Exception):
     def __init__(self, feature: PkkSearchFeature):
         super().__init__(f"{feature.attrs.id} [{feature.type}] не имеет экстента")
 
 
+def _build_rate_limiters(
+    api_rate_limit: RateLimitArg, tile_rate_limit: RateLimitArg
+) -> dict[str, RateLimiter]:
+    limiters = {
+        API_HOST: as_rate_limiter(api_rate_limit),
+        SELECTED_TILE_HOST: as_rate_limiter(tile_rate_limit),
+    }
+    return {k: v for k, v in limiters.items() if v is not None}
+
+
+def _create_executor(
+    executor: ExecutorArg, max_workers: Optional[int]
+) -> Optional[Executor]:
+    match executor:
+        case "process":
+            # spawn, а не fork: в родителе крутятся event loop и потоки sqlite
+            return ProcessPoolExecutor(
+                max_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        case "thread":
+            return ThreadPoolExecutor(max_workers)
+    return executor
+
+
+def _transport_manager(
+    transport: Optional[Union[httpx.BaseTransport, httpx.AsyncBaseTransport]],
+    pool: Optional[PoolConfig],
+    transport_manager: Optional[TransportManager],
+) -> tuple[Optional[TransportManager], bool]:
+    """Менеджер пула клиента и признак, что клиент им владеет.
+
+    Без общего `transport_manager` клиент создает свой пул с настройками `pool`"""
+    if pool is not None and transport_manager is not None:
+        raise ValueError("pool задается в TransportManager, а не в клиенте")
+    if transport is not None:
+        return None, False
+    if transport_manager is not None:
+        return transport_manager, False
+    return TransportManager(pool), True
+
+
+def _unpack_timed(observer: ObserverArg, result):
+    if observer is None:
+        return result
+    result, timings = result
+    for name, duration in timings.items():
+        emit(observer, name, duration)
+    return result
+
+
+def _emit_tiles(
+    observer: ObserverArg,
+    layer: TileLayer,
+    tiles: list["TilePayload"],
+    scale: float,
+    duration: float,
+):
+    emit(
+        observer,
+        "tiles",
+        duration,
+        layer.cn,
+        tiles=len(tiles),
+        bytes=sum(len(i.image) for i in tiles),
+        scale=scale,
+    )
+
+
 class PKK:
     def __init__(
         self,
-        cache_type: Optional[Literal["sqlite"]] = "sqlite",
+        cache_type: CacheArg = "sqlite",
         cache_ttl: int = 24 * 60 * 60,
+        cache_dir: Optional[Union[str, Path]] = None,
+        cache_url: Optional[str] = None,
+        memory_cache_entries: int = MEMORY_CACHE_ENTRIES,
+        memory_cache_bytes: int = MEMORY_CACHE_BYTES,
+        api_rate_limit: RateLimitArg = DEFAULT_API_RATE_LIMIT,
+        tile_rate_limit: RateLimitArg = DEFAULT_TILE_RATE_LIMIT,
+        executor: ExecutorArg = None,
+        max_workers: Optional[int] = None,
+        tile_planner: TilePlanner = "adaptive",
+        extraction_mode: ExtractionMode = "tiles",
+        tile_format: TileFormat = "image",
+        output_crs: "OutputCrs" = 4326,
+        retry_policy: Optional[RetryPolicy] = None,
+        geometry_cache_ttl: Optional[int] = DEFAULT_GEOMETRY_CACHE_TTL,
+        transport: Optional[httpx.BaseTransport] = None,
+        observer: ObserverArg = None,
+        pool: Optional[PoolConfig] = None,
+        transport_manager: Optional[TransportManager] = None,
     ):
-        transport = None
-        match cache_type:
-            case "sqlite":
-                transport = hishel.CacheTransport(
-                    transport=httpx.HTTPTransport(verify=SSL_CONTEXT),
-                    storage=hishel.SQLiteStorage(ttl=cache_ttl),
-                    controller=_hishel_controller,
-                )
+        self.observer = observer
+        self.tile_planner = tile_planner
+        self.extraction_mode = extraction_mode
+        self.tile_format = tile_format
+        # epsg:3857 - геометрии без перепроецирования, в координатах тайлов
+        self.output_crs = output_crs
+        # повторы, бюджет и автоматы по хостам общие для всех запросов клиента
+        self.retry_policy = retry_policy or RetryPolicy()
+        # кэш готовых геометрий живет рядом с http-кэшем и включается вместе с ним
+        self._geometry_cache = (
+            GeometryCache(
+                Path(cache_dir or ".") / DEFAULT_GEOMETRY_CACHE_PATH,
+                ttl=geometry_cache_ttl,
+                crs=output_crs,
+            )
+            if cache_type is not None and geometry_cache_ttl is not None
+            else None
+        )
+        self._rate_limiters = _build_rate_limiters(api_rate_limit, tile_rate_limit)
+        self._executor_arg = executor
+        self._max_workers = max_workers
+        self._executor: Optional[Executor] = None
+        self._transport_manager, self._owns_transport_manager = _transport_manager(
+            transport, pool, transport_manager
+        )
+        # transport подменяется в тестах и бенчмарках, см. pypkk.testing
+        transport = RateLimitedTransport(
+            transport or self._transport_manager.transport(),
+            self._rate_limiters,
+            observer,
+        )
+        self._storage = build_storage(
+            cache_type,
+            cache_dir,
+            cache_ttl,
+            cache_url,
+            memory_cache_entries,
+            memory_cache_bytes,
+        )
+        if self._storage is not None:
+            transport = hishel.CacheTransport(
+                transport=transport,
+                storage=self._storage,
+                controller=_hishel_controller,
+            )
         self._client = httpx.Client(**CLIENT_ARGS, transport=transport)
 
+    @property
+    def rate_limit_stats(self) -> dict[str, RateLimiterStats]:
+        return {k: v.stats for k, v in self._rate_limiters.items()}
+
+    @property
+    def retry_stats(self) -> RetryStats:
+        return self.retry_policy.stats
+
+    @property
+    def memory_cache_stats(self) -> Optional[MemoryCacheStats]:
+        if self._storage is None:
+            return None
+        return self._storage.memory.stats
+
+    @property
+    def pool_stats(self) -> Optional[PoolStats]:
+        if self._transport_manager is None:
+            return None
+        return self._transport_manager.stats
+
+    def _geometry_cache_for(
+        self, resolution: float, max_tiles: int
+    ) -> Optional[GeometryCache]:
+        # кэш хранит одну геометрию на объект - построенную с параметрами
+        # по умолчанию; другие разрешения строятся заново
+        if (resolution, max_tiles) != (DEFAULT_RESOLUTION, MAX_SUBTILES_PER_CN):
+            return None
+        return self._geometry_cache
+
+    @property
+    def _extractor(self):
+        from pypkk.image import extract_geometry, extract_mosaic_geometry
+
+        if self.extraction_mode == "mosaic":
+            return extract_mosaic_geometry
+        return extract_geometry
+
     def __enter__(self):
         return self
 
@@ -62,6 +316,51 @@ class PKK:
             self._client.close()
         except AssertionError:
             pass
+        if self._owns_transport_manager:
+            self._transport_manager.close()
+        if self._geometry_cache is not None:
+            self._geometry_cache.close()
+        if self._executor is not None and isinstance(self._executor_arg, str):
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _run_cpu(self, func, *args):
+        if self._executor is None:
+            self._executor = _create_executor(self._executor_arg, self._max_workers)
+        if self.observer is not None:
+            # стадии замеряются там, где идет векторизация, и приходят с результатом
+            args = (func, *args)
+            func = run_timed
+        if self._executor is None:
+            result = func(*args)
+        else:
+            result = self._executor.submit(func, *args).result()
+        return _unpack_timed(self.observer, result)
+
+    def _fetch_tiles(
+        self,
+        feature: Union[PkkSearchFeature, TileLayer],
+        extents: list[PkkExtent],
+        scale: float = DEFAULT_SCALE,
+    ) -> list["TilePayload"]:
+        from pypkk.image import TilePayload
+
+        start = perf_counter()
+        layer = TileLayer.of(feature)
+        tiles = []
+        for i in extents:
+            tile_response = tile_request(
+                self._client,
+                layer,
+                i,
+                scale=scale,
+                observer=self.observer,
+                retry=self.retry_policy,
+                tile_format=self.tile_format,
+            )
+            tiles.append(TilePayload.from_response(tile_response))
+        _emit_tiles(self.observer, layer, tiles, scale, perf_counter() - start)
+        return tiles
 
     def search_at_point(
         self, lng: float, lat: float, types: Optional[list[PkkType]] = None
@@ -72,51 +371,414 @@ class PKK:
         }
         if types is not None:
             params["types"] = types
-        r = api_request(self._client, "get", "/features/", params=params)
+        r = api_request(
+            self._client,
+            "get",
+            "/features/",
+            params=params,
+            observer=self.observer,
+            retry=self.retry_policy,
+        )
         return PkkAtPointResponse.model_validate(r)
 
     def search(self, cn: Cn): ...
 
-    def search_in_polygon(self, limit: int = 40): ...
+    def search_in_polygon(
+        self,
+        polygon: "BaseGeometry",
+        limit: Optional[int] = 40,
+        types: Optional[list[PkkType]] = None,
+        prune: bool = True,
+    ) -> Iterator[PkkSearchFeature]:
+        """Объекты в полигоне (epsg:4326) перебором `search_at_point` по сетке,
+        см. pypkk.search. Выдает объекты по мере нахождения, не больше `limit`"""
+        from pypkk.search import PolygonSweep
+
+        sweep = PolygonSweep(polygon, tolerance, types, prune)
+        count = 0
+        for lng, lat in sweep.points():
+            found = self.search_at_point(lng, lat, types)
+            for feature in sweep.add(found.results):
+                yield feature
+                count += 1
+                if limit is not None and count >= limit:
+                    return
 
     def get_attrs(self, cn: Cn) -> PkkFeatureResponse:
         params = {
             "date_format": r"%c",
         }
         r = api_request(
-            self._client, "get", f"/features/{cn.kind}/{cn.clean_code}", params
+            self._client,
+            "get",
+            f"/features/{cn.kind}/{cn.clean_code}",
+            params,
+            observer=self.observer,
+            retry=self.retry_policy,
         )
         return PkkFeatureResponse.model_validate(r)
 
-    def get_geojson(self, feature: PkkSearchFeature) -> PkkGeojson:
+    def get_geojson(
+        self,
+        feature: PkkSearchFeature,
+        resolution: float = DEFAULT_RESOLUTION,
+        max_tiles: int = MAX_SUBTILES_PER_CN,
+    ) -> PkkGeojson:
+        """Геометрия объекта с тайлов.
+
+        `resolution` - размер пикселя тайлов на местности (м/px), `max_tiles` -
+        сколько тайлов на объект запрашивается не больше: масштаб выбирается
+        наибольший, не мельче `resolution`, при котором объект укладывается
+        в `max_tiles`. Кэш геометрий используется только для значений
+        по умолчанию"""
         if feature.extent is None:
             raise NoCoordsFeatureError(feature)
-        extents = generate_tile_extents(feature.extent)
-        tiles_responses = []
-        for i in extents:
-            tile_response = tile_request(self._client, feature, i)
-            tiles_responses.append(tile_response)
-        geom = extract_geometry_from_tiles(tiles_responses)
-        return PkkGeojson(geometry=mapping(geom), properties=feature.attrs)
+        start = perf_counter()
+        geometry_cache = self._geometry_cache_for(resolution, max_tiles)
+        geom = None
+        if geometry_cache is not None:
+            geom = geometry_cache.get(feature)
+        cached = geom is not None
+        if geom is None:
+            geom = self._get_geometry(feature, resolution, max_tiles)
+            if geometry_cache is not None:
+                geometry_cache.set(feature, geom)
+        emit(
+            self.observer,
+            "geojson",
+            perf_counter() - start,
+            feature.attrs.cn,
+            from_cache=cached,
+        )
+        return PkkGeojson(geometry=geom.__geo_interface__, properties=feature.attrs)
+
+    def _get_geometry(
+        self,
+        feature: PkkSearchFeature,
+        resolution: float = DEFAULT_RESOLUTION,
+        max_tiles: int = MAX_SUBTILES_PER_CN,
+    ) -> "MultiPolygon":
+        extents, scale = plan_tile_extents(feature.extent, resolution, max_tiles)
+        if self.tile_planner == "adaptive" and len(extents) > ADAPTIVE_MIN_TILES:
+            geom = self._get_refined_geometry(feature, resolution, max_tiles)
+            if geom is not None:
+                return geom
+        tiles = self._fetch_tiles(feature, extents, scale)
+        return self._run_cpu(self._extractor, tiles, self.output_crs)
+
+    def _get_refined_geometry(
+        self, feature: PkkSearchFeature, resolution: float, max_tiles: int
+    ) -> Optional["MultiPolygon"]:
+        """Адаптивное разбиение; None - объект (тонкий или мелкий) не виден
+        на грубом тайле, и его нужно строить по полной сетке"""
+        from pypkk.image import (
+            NoContoursError,
+            extract_refined_geometry,
+            plan_refined_tiles,
+        )
+
+        coarse_tiles = self._fetch_tiles(
+            feature,
+            generate_coarse_tile_extents(feature.extent),
+            coarse_scale(feature.extent),
+        )
+        try:
+            coarse, cells, scale = self._run_cpu(
+                plan_refined_tiles, coarse_tiles, feature.extent, resolution, max_tiles
+            )
+        except NoContoursError:
+            return None
+        tiles = self._fetch_tiles(
+            feature, [buffer_extent(i, TILE_BUFFER) for i in cells], scale
+        )
+        return self._run_cpu(
+            extract_refined_geometry,
+            coarse,
+            tiles,
+            cells,
+            self.extraction_mode == "mosaic",
+            self.output_crs,
+        )
+
+    def iter_geojson_batch(
+        self, features: Iterable[PkkSearchFeature]
+    ) -> Iterator[tuple[PkkSearchFeature, Union[PkkGeojson, Exception]]]:
+        """`get_geojson` для набора объектов: пары (объект, geojson или ошибка)
+        в порядке входа.
+
+        Соседние небольшие объекты запрашиваются общими тайлами
+        (см. pypkk.batch), остальные и невыделенные - по одному. Вход читается
+        окнами по BATCH_WINDOW объектов, соседи ищутся внутри окна. Ошибка
+        по одному объекту не прерывает остальные; общий тайл, который
+        не удалось получить, заменяется запросами по одному"""
+        from pypkk.batch import windows
+
+        for window in windows(features):
+            yield from zip(window, self._geojson_window(window))
+
+    def get_geojson_batch(
+        self, features: Iterable[PkkSearchFeature]
+    ) -> list[Union[PkkGeojson, Exception]]:
+        """`iter_geojson_batch` списком: geojson или ошибка на каждый объект"""
+        return [result for _, result in self.iter_geojson_batch(features)]
+
+    def _geojson_window(
+        self, features: list[PkkSearchFeature]
+    ) -> list[Union[PkkGeojson, Exception]]:
+        from pypkk.batch import (
+            batch_extent,
+            batch_layer,
+            extract_batch_geometries,
+            plan_batches,
+        )
+
+        results: dict[int, Union[PkkGeojson, Exception]] = {}
+        pending = []
+        for index, feature in enumerate(features):
+            if feature.extent is None:
+                results[index] = NoCoordsFeatureError(feature)
+                continue
+            start = perf_counter()
+            geom = None
+            if self._geometry_cache is not None:
+                geom = self._geometry_cache.get(feature)
+            if geom is None:
+                pending.append(index)
+                continue
+            emit(
+                self.observer,
+                "geojson",
+                perf_counter() - start,
+                feature.attrs.cn,
+                from_cache=True,
+            )
+            results[index] = PkkGeojson(
+                geometry=geom.__geo_interface__, properties=feature.attrs
+            )
+
+        batches, _ = plan_batches([features[i] for i in pending])
+        for batch in batches:
+            group = [features[pending[i]] for i in batch]
+            try:
+                tiles = self._fetch_tiles(batch_layer(group), [batch_extent(group)])
+                geoms = self._run_cpu(
+                    extract_batch_geometries,
+                    tiles,
+                    [(i.center.x, i.center.y) if i.center else None for i in group],
+                    [i.extent for i in group],
+                    self.output_crs,
+                )
+            except Exception:
+                continue
+            for i, feature, geom in zip(batch, group, geoms):
+                if geom is None:
+                    continue
+                if self._geometry_cache is not None:
+                    self._geometry_cache.set(feature, geom)
+                results[pending[i]] = PkkGeojson(
+                    geometry=geom.__geo_interface__, properties=feature.attrs
+                )
+        # одиночные и невыделенные на общих тайлах объекты, кэш уже проверен
+        for index in pending:
+            if index not in results:
+                try:
+                    results[index] = self._build_geojson(features[index])
+                except Exception as e:
+                    results[index] = e
+        return [results[i] for i in range(len(features))]
+
+    def _build_geojson(self, feature: PkkSearchFeature) -> PkkGeojson:
+        start = perf_counter()
+        geom = self._get_geometry(feature)
+        if self._geometry_cache is not None:
+            self._geometry_cache.set(feature, geom)
+        emit(
+            self.observer,
+            "geojson",
+            perf_counter() - start,
+            feature.attrs.cn,
+            from_cache=False,
+        )
+        return PkkGeojson(geometry=geom.__geo_interface__, properties=feature.attrs)
+
+    def harvest_kvartal(
+        self, kvartal: KvartalCn, kind: PkkType = 1, outline: bool = True
+    ) -> list[PkkGeojson]:
+        """Все объекты типа `kind` в квартале по нескольким общим тайлам,
+        см. pypkk.kvartal. `outline=False` - без обводки (dynamicLayers),
+        если сервер ее не поддерживает: соседи тогда строятся по отдельности"""
+        quarter = self.get_attrs(kvartal).feature
+        if quarter is None or quarter.extent is None:
+            return []
+        from pypkk.geom_utils import to_3857, to_4326
+        from pypkk.image import (
+            EXTENT_TOLERANCE_PX,
+            extract_segments,
+            fits_extent,
+            segment_geometry,
+        )
+        from pypkk.kvartal import MIN_SEGMENT_PX, kvartal_layer, pick_feature
+
+        extents, scale = generate_kvartal_tile_extents(quarter.extent)
+        tiles = self._fetch_tiles(kvartal_layer(kvartal, kind, outline), extents, scale)
+        tolerance = EXTENT_TOLERANCE_PX / scale
+        min_area = MIN_SEGMENT_PX / scale**2
+        harvested: dict[str, PkkGeojson] = {}
+        for segment in self._run_cpu(extract_segments, tiles):
+            remaining = segment
+            while remaining.area > min_area:
+                point = to_4326(remaining.representative_point())
+                found = self.search_at_point(point.x, point.y, types=[kind])
+                feature = pick_feature(found.results, remaining, kvartal, tolerance)
+                if feature is None or feature.attrs.id in harvested:
+                    break
+                if fits_extent(remaining, feature.extent, tolerance):
+                    harvested[feature.attrs.id] = PkkGeojson(
+                        geometry=segment_geometry(
+                            remaining, self.output_crs
+                        ).__geo_interface__,
+                        properties=feature.attrs,
+                    )
+                    break
+                # полигон - несколько слившихся объектов или часть объекта
+                geojson = self.get_geojson(feature)
+                harvested[feature.attrs.id] = geojson
+                geometry = geojson.shapely_geometry
+                if self.output_crs == 4326:
+                    geometry = to_3857(geometry)
+                remaining = remaining.difference(geometry.buffer(tolerance))
+        return list(harvested.values())
 
 
 class AsyncPKK:
     def __init__(
         self,
-        cache_type: Optional[Literal["sqlite"]] = "sqlite",
+        cache_type: CacheArg = "sqlite",
         cache_ttl: int = 24 * 60 * 60,
+        cache_dir: Optional[Union[str, Path]] = None,
+        cache_url: Optional[str] = None,
+        memory_cache_entries: int = MEMORY_CACHE_ENTRIES,
+        memory_cache_bytes: int = MEMORY_CACHE_BYTES,
         use_lock: bool = True,
+        tile_concurrency: int = TILE_CONCURRENCY,
+        client_tile_concurrency: int = CLIENT_TILE_CONCURRENCY,
+        api_rate_limit: RateLimitArg = DEFAULT_API_RATE_LIMIT,
+        tile_rate_limit: RateLimitArg = DEFAULT_TILE_RATE_LIMIT,
+        executor: ExecutorArg = "thread",
+        max_workers: Optional[int] = None,
+        tile_planner: TilePlanner = "adaptive",
+        extraction_mode: ExtractionMode = "tiles",
+        tile_format: TileFormat = "image",
+        output_crs: "OutputCrs" = 4326,
+        retry_policy: Optional[RetryPolicy] = None,
+        geometry_cache_ttl: Optional[int] = DEFAULT_GEOMETRY_CACHE_TTL,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        observer: ObserverArg = None,
+        pool: Optional[PoolConfig] = None,
+        transport_manager: Optional[TransportManager] = None,
+        coalesce: bool = True,
     ):
-        transport = None
-        match cache_type:
-            case "sqlite":
-                transport = hishel.AsyncCacheTransport(
-                    transport=httpx.AsyncHTTPTransport(verify=SSL_CONTEXT),
-                    storage=hishel.AsyncSQLiteStorage(ttl=cache_ttl),
-                    controller=_hishel_controller,
-                )
+        self.observer = observer
+        self.tile_planner = tile_planner
+        self.extraction_mode = extraction_mode
+        self.tile_format = tile_format
+        # epsg:3857 - геометрии без перепроецирования, в координатах тайлов
+        self.output_crs = output_crs
+        # повторы, бюджет и автоматы по хостам общие для всех запросов клиента
+        self.retry_policy = retry_policy or RetryPolicy()
+        # кэш готовых геометрий живет рядом с http-кэшем и включается вместе с ним
+        self._geometry_cache = (
+            GeometryCache(
+                Path(cache_dir or ".") / DEFAULT_GEOMETRY_CACHE_PATH,
+                ttl=geometry_cache_ttl,
+                crs=output_crs,
+            )
+            if cache_type is not None and geometry_cache_ttl is not None
+            else None
+        )
+        self._executor_arg = executor
+        self._max_workers = max_workers
+        self._executor: Optional[Executor] = None
+        # одинаковые одновременные запросы (дубли номеров в пакете) уходят
+        # в сеть один раз: http-кэш заполняется только после ответа
+        self._flights = SingleFlight() if coalesce else None
+        # use_lock=False оставлен для совместимости: отключает лимит на API
+        self._rate_limiters = _build_rate_limiters(
+            api_rate_limit if use_lock else None, tile_rate_limit
+        )
+        self._transport_manager, self._owns_transport_manager = _transport_manager(
+            transport, pool, transport_manager
+        )
+        transport = AsyncRateLimitedTransport(
+            transport or self._transport_manager.async_transport(),
+            self._rate_limiters,
+            observer,
+        )
+        self._storage = build_async_storage(
+            cache_type,
+            cache_dir,
+            cache_ttl,
+            cache_url,
+            memory_cache_entries,
+            memory_cache_bytes,
+        )
+        if self._storage is not None:
+            transport = hishel.AsyncCacheTransport(
+                transport=transport,
+                storage=self._storage,
+                controller=_hishel_controller,
+            )
         self._client = httpx.AsyncClient(**CLIENT_ARGS, transport=transport)
-        self.lock = asyncio.Lock() if use_lock else None
+        self.tile_concurrency = tile_concurrency
+        self._tile_semaphore = asyncio.Semaphore(client_tile_concurrency)
+
+    @property
+    def rate_limit_stats(self) -> dict[str, RateLimiterStats]:
+        return {k: v.stats for k, v in self._rate_limiters.items()}
+
+    @property
+    def retry_stats(self) -> RetryStats:
+        return self.retry_policy.stats
+
+    @property
+    def memory_cache_stats(self) -> Optional[MemoryCacheStats]:
+        if self._storage is None:
+            return None
+        return self._storage.memory.stats
+
+    @property
+    def pool_stats(self) -> Optional[PoolStats]:
+        if self._transport_manager is None:
+            return None
+        return self._transport_manager.async_stats
+
+    @property
+    def coalesce_stats(self) -> Optional[SingleFlightStats]:
+        if self._flights is None:
+            return None
+        return self._flights.stats
+
+    async def _coalesce(self, key: tuple, func: Callable[[], Awaitable[T]]) -> T:
+        if self._flights is None:
+            return await func()
+        return await self._flights.do(key, func)
+
+    def _geometry_cache_for(
+        self, resolution: float, max_tiles: int
+    ) -> Optional[GeometryCache]:
+        # кэш хранит одну геометрию на объект - построенную с параметрами
+        # по умолчанию; другие разрешения строятся заново
+        if (resolution, max_tiles) != (DEFAULT_RESOLUTION, MAX_SUBTILES_PER_CN):
+            return None
+        return self._geometry_cache
+
+    @property
+    def _extractor(self):
+        from pypkk.image import extract_geometry, extract_mosaic_geometry
+
+        if self.extraction_mode == "mosaic":
+            return extract_mosaic_geometry
+        return extract_geometry
 
     async def __aenter__(self):
         return self
@@ -126,6 +788,71 @@ class AsyncPKK:
             await self._client.aclose()
         except AssertionError:
             pass
+        if self._owns_transport_manager:
+            await self._transport_manager.aclose()
+        if self._geometry_cache is not None:
+            self._geometry_cache.close()
+        if self._executor is not None and isinstance(self._executor_arg, str):
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run_cpu(self, func, *args):
+        if self._executor is None:
+            self._executor = _create_executor(self._executor_arg, self._max_workers)
+        if self.observer is not None:
+            args = (func, *args)
+            func = run_timed
+        if self._executor is None:
+            result = func(*args)
+        else:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self._executor, func, *args)
+        return _unpack_timed(self.observer, result)
+
+    async def _fetch_tiles(
+        self,
+        feature: Union[PkkSearchFeature, TileLayer],
+        extents: list[PkkExtent],
+        scale: float = DEFAULT_SCALE,
+    ) -> list["TilePayload"]:
+        from pypkk.image import TilePayload
+
+        start = perf_counter()
+        layer = TileLayer.of(feature)
+        feature_semaphore = asyncio.Semaphore(self.tile_concurrency)
+
+        async def request_tile(extent: PkkExtent):
+            async with feature_semaphore, self._tile_semaphore:
+                tile_response = await async_tile_request(
+                    self._client,
+                    layer,
+                    extent,
+                    scale=scale,
+                    observer=self.observer,
+                    retry=self.retry_policy,
+                    tile_format=self.tile_format,
+                )
+            return TilePayload.from_response(tile_response)
+
+        async def fetch_tile(extent: PkkExtent):
+            key = (
+                "tile",
+                layer.type,
+                layer.where,
+                layer.outline,
+                extent.xmin,
+                extent.ymin,
+                extent.xmax,
+                extent.ymax,
+                scale,
+            )
+            # копия: при ответе 400 запрос сдвигает свой экстент
+            extent = extent.model_copy()
+            return await self._coalesce(key, lambda: request_tile(extent))
+
+        tiles = await gather_cancelling(map(fetch_tile, extents))
+        _emit_tiles(self.observer, layer, tiles, scale, perf_counter() - start)
+        return tiles
 
     async def search_at_point(
         self, lng: float, lat: float, types: Optional[list[PkkType]] = None
@@ -136,41 +863,369 @@ class AsyncPKK:
         }
         if types is not None:
             params["types"] = types
-        r = await async_api_request(
-            self._client, "get", "/features/", params=params, lock=self.lock
-        )
-        return PkkAtPointResponse.model_validate(r)
+
+        async def request():
+            r = await async_api_request(
+                self._client,
+                "get",
+                "/features/",
+                params=params,
+                observer=self.observer,
+                retry=self.retry_policy,
+            )
+            return PkkAtPointResponse.model_validate(r)
+
+        key = ("at_point", lng, lat, tuple(types) if types is not None else None)
+        return await self._coalesce(key, request)
 
     async def search(self, cn: Cn): ...
 
-    async def search_in_polygon(self, limit: int = 40): ...
+    async def search_in_polygon(
+        self,
+        polygon: "BaseGeometry",
+        limit: Optional[int] = 40,
+        types: Optional[list[PkkType]] = None,
+        prune: bool = True,
+        concurrency: int = BULK_CONCURRENCY,
+    ) -> AsyncIterator[PkkSearchFeature]:
+        """Объекты в полигоне (epsg:4326) перебором `search_at_point` по сетке,
+        см. pypkk.search. До `concurrency` точек запрашиваются одновременно;
+        выдает объекты по мере нахождения, не больше `limit`"""
+        from pypkk.search import PolygonSweep
+
+        sweep = PolygonSweep(polygon, tolerance, types, prune)
+
+        async def search(point: tuple[float, float]) -> PkkAtPointResponse:
+            return await self.search_at_point(*point, types)
+
+        results = map_bounded(search, sweep.points(), concurrency)
+        count = 0
+        try:
+            async for _, found in results:
+                if isinstance(found, Exception):
+                    raise found
+                for feature in sweep.add(found.results):
+                    yield feature
+                    count += 1
+                    if limit is not None and count >= limit:
+                        return
+        finally:
+            await results.aclose()
 
     async def get_attrs(self, cn: Cn) -> PkkFeatureResponse:
         params = {
             "date_format": r"%c",
         }
-        r = await async_api_request(
-            self._client,
-            "get",
-            f"/features/{cn.kind}/{cn.clean_code}",
-            params=params,
-            lock=self.lock,
-        )
-        return PkkFeatureResponse.model_validate(r)
 
-    async def get_geojson(self, feature: PkkSearchFeature) -> PkkGeojson:
+        async def request():
+            r = await async_api_request(
+                self._client,
+                "get",
+                f"/features/{cn.kind}/{cn.clean_code}",
+                params=params,
+                observer=self.observer,
+                retry=self.retry_policy,
+            )
+            return PkkFeatureResponse.model_validate(r)
+
+        return await self._coalesce(("attrs", cn.kind, cn.clean_code), request)
+
+    async def get_geojson(
+        self,
+        feature: PkkSearchFeature,
+        resolution: float = DEFAULT_RESOLUTION,
+        max_tiles: int = MAX_SUBTILES_PER_CN,
+    ) -> PkkGeojson:
+        """Геометрия объекта с тайлов.
+
+        `resolution` - размер пикселя тайлов на местности (м/px), `max_tiles` -
+        сколько тайлов на объект запрашивается не больше: масштаб выбирается
+        наибольший, не мельче `resolution`, при котором объект укладывается
+        в `max_tiles`. Кэш геометрий используется только для значений
+        по умолчанию"""
         if feature.extent is None:
             raise NoCoordsFeatureError(feature)
-        extents = generate_tile_extents(feature.extent)
-        tiles_responses = []
-        for i in extents:
-            tile_response = await async_tile_request(self._client, feature, i)
-            tiles_responses.append(tile_response)
-        geom = extract_geometry_from_tiles(tiles_responses)
+        start = perf_counter()
+        geometry_cache = self._geometry_cache_for(resolution, max_tiles)
+        geom = None
+        if geometry_cache is not None:
+            # sqlite блокирует, запрос к кэшу уходит из event loop в поток
+            geom = await asyncio.to_thread(geometry_cache.get, feature)
+        cached = geom is not None
+        if geom is None:
+            geom = await self._coalesce(
+                ("geometry", feature.type, feature.attrs.id, resolution, max_tiles),
+                lambda: self._compute_geometry(
+                    feature, resolution, max_tiles, geometry_cache
+                ),
+            )
+        emit(
+            self.observer,
+            "geojson",
+            perf_counter() - start,
+            feature.attrs.cn,
+            from_cache=cached,
+        )
+        return PkkGeojson(
+            geometry=geom.__geo_interface__, properties=feature.attrs.model_dump_extra()
+        )
+
+    async def _compute_geometry(
+        self,
+        feature: PkkSearchFeature,
+        resolution: float,
+        max_tiles: int,
+        geometry_cache: Optional[GeometryCache],
+    ) -> "MultiPolygon":
+        geom = await self._get_geometry(feature, resolution, max_tiles)
+        if geometry_cache is not None:
+            await asyncio.to_thread(geometry_cache.set, feature, geom)
+        return geom
+
+    async def _get_geometry(
+        self,
+        feature: PkkSearchFeature,
+        resolution: float = DEFAULT_RESOLUTION,
+        max_tiles: int = MAX_SUBTILES_PER_CN,
+    ) -> "MultiPolygon":
+        extents, scale = plan_tile_extents(feature.extent, resolution, max_tiles)
+        if self.tile_planner == "adaptive" and len(extents) > ADAPTIVE_MIN_TILES:
+            geom = await self._get_refined_geometry(feature, resolution, max_tiles)
+            if geom is not None:
+                return geom
+        tiles = await self._fetch_tiles(feature, extents, scale)
+        return await self._run_cpu(self._extractor, tiles, self.output_crs)
+
+    async def _get_refined_geometry(
+        self, feature: PkkSearchFeature, resolution: float, max_tiles: int
+    ) -> Optional["MultiPolygon"]:
+        """Адаптивное разбиение; None - объект (тонкий или мелкий) не виден
+        на грубом тайле, и его нужно строить по полной сетке"""
+        from pypkk.image import (
+            NoContoursError,
+            extract_refined_geometry,
+            plan_refined_tiles,
+        )
+
+        coarse_tiles = await self._fetch_tiles(
+            feature,
+            generate_coarse_tile_extents(feature.extent),
+            coarse_scale(feature.extent),
+        )
+        try:
+            coarse, cells, scale = await self._run_cpu(
+                plan_refined_tiles, coarse_tiles, feature.extent, resolution, max_tiles
+            )
+        except NoContoursError:
+            return None
+        tiles = await self._fetch_tiles(
+            feature, [buffer_extent(i, TILE_BUFFER) for i in cells], scale
+        )
+        return await self._run_cpu(
+            extract_refined_geometry,
+            coarse,
+            tiles,
+            cells,
+            self.extraction_mode == "mosaic",
+            self.output_crs,
+        )
+
+    async def iter_geojson_batch(
+        self,
+        features: Iterable[PkkSearchFeature],
+        concurrency: int = BULK_CONCURRENCY,
+    ) -> AsyncIterator[tuple[PkkSearchFeature, Union[PkkGeojson, Exception]]]:
+        """`get_geojson` для набора объектов: пары (объект, geojson или ошибка)
+        в порядке входа.
+
+        Соседние небольшие объекты запрашиваются общими тайлами
+        (см. pypkk.batch), остальные и невыделенные - по одному, одновременно
+        не больше `concurrency` тайлов или объектов. Вход читается окнами
+        по BATCH_WINDOW объектов, соседи ищутся внутри окна. Ошибка по одному
+        объекту не прерывает остальные; общий тайл, который не удалось
+        получить, заменяется запросами по одному"""
+        from pypkk.batch import windows
+
+        for window in windows(features):
+            results = await self._geojson_window(window, concurrency)
+            for item in zip(window, results):
+                yield item
+
+    async def get_geojson_batch(
+        self,
+        features: Iterable[PkkSearchFeature],
+        concurrency: int = BULK_CONCURRENCY,
+    ) -> list[Union[PkkGeojson, Exception]]:
+        """`iter_geojson_batch` списком: geojson или ошибка на каждый объект"""
+        return [
+            result async for _, result in self.iter_geojson_batch(features, concurrency)
+        ]
+
+    async def _geojson_window(
+        self, features: list[PkkSearchFeature], concurrency: int
+    ) -> list[Union[PkkGeojson, Exception]]:
+        from pypkk.batch import (
+            batch_extent,
+            batch_layer,
+            extract_batch_geometries,
+            plan_batches,
+        )
+
+        results: dict[int, Union[PkkGeojson, Exception]] = {}
+        pending = []
+        for index, feature in enumerate(features):
+            if feature.extent is None:
+                results[index] = NoCoordsFeatureError(feature)
+                continue
+            start = perf_counter()
+            geom = None
+            if self._geometry_cache is not None:
+                geom = await asyncio.to_thread(self._geometry_cache.get, feature)
+            if geom is None:
+                pending.append(index)
+                continue
+            emit(
+                self.observer,
+                "geojson",
+                perf_counter() - start,
+                feature.attrs.cn,
+                from_cache=True,
+            )
+            results[index] = PkkGeojson(
+                geometry=geom.__geo_interface__,
+                properties=feature.attrs.model_dump_extra(),
+            )
+
+        async def fetch_batch(batch: list[int]) -> list[Optional["MultiPolygon"]]:
+            group = [features[pending[i]] for i in batch]
+            tiles = await self._fetch_tiles(batch_layer(group), [batch_extent(group)])
+            return await self._run_cpu(
+                extract_batch_geometries,
+                tiles,
+                [(i.center.x, i.center.y) if i.center else None for i in group],
+                [i.extent for i in group],
+                self.output_crs,
+            )
+
+        batches, _ = plan_batches([features[i] for i in pending])
+        async for batch, geoms in map_bounded(fetch_batch, batches, concurrency):
+            # общий тайл не получен - объекты строятся по одному
+            if isinstance(geoms, Exception):
+                continue
+            for i, geom in zip(batch, geoms):
+                if geom is None:
+                    continue
+                feature = features[pending[i]]
+                if self._geometry_cache is not None:
+                    await asyncio.to_thread(self._geometry_cache.set, feature, geom)
+                results[pending[i]] = PkkGeojson(
+                    geometry=geom.__geo_interface__,
+                    properties=feature.attrs.model_dump_extra(),
+                )
+
+        async def fetch_single(index: int) -> PkkGeojson:
+            return await self._build_geojson(features[index])
+
+        # одиночные и невыделенные на общих тайлах объекты, кэш уже проверен
+        rest = [i for i in pending if i not in results]
+        async for index, result in map_bounded(fetch_single, rest, concurrency):
+            results[index] = result
+        return [results[i] for i in range(len(features))]
+
+    async def _build_geojson(self, feature: PkkSearchFeature) -> PkkGeojson:
+        start = perf_counter()
+        geom = await self._coalesce(
+            (
+                "geometry",
+                feature.type,
+                feature.attrs.id,
+                DEFAULT_RESOLUTION,
+                MAX_SUBTILES_PER_CN,
+            ),
+            lambda: self._compute_geometry(
+                feature, DEFAULT_RESOLUTION, MAX_SUBTILES_PER_CN, self._geometry_cache
+            ),
+        )
+        emit(
+            self.observer,
+            "geojson",
+            perf_counter() - start,
+            feature.attrs.cn,
+            from_cache=False,
+        )
         return PkkGeojson(
-            geometry=mapping(geom), properties=feature.attrs.model_dump_extra()
+            geometry=geom.__geo_interface__, properties=feature.attrs.model_dump_extra()
         )
 
+    async def harvest_kvartal(
+        self,
+        kvartal: KvartalCn,
+        kind: PkkType = 1,
+        outline: bool = True,
+        concurrency: int = BULK_CONCURRENCY,
+    ) -> list[PkkGeojson]:
+        """Все объекты типа `kind` в квартале по нескольким общим тайлам,
+        см. pypkk.kvartal. `outline=False` - без обводки (dynamicLayers),
+        если сервер ее не поддерживает: соседи тогда строятся по отдельности"""
+        quarter = (await self.get_attrs(kvartal)).feature
+        if quarter is None or quarter.extent is None:
+            return []
+        from pypkk.geom_utils import to_3857, to_4326
+        from pypkk.image import (
+            EXTENT_TOLERANCE_PX,
+            extract_segments,
+            fits_extent,
+            segment_geometry,
+        )
+        from pypkk.kvartal import MIN_SEGMENT_PX, kvartal_layer, pick_feature
+
+        extents, scale = generate_kvartal_tile_extents(quarter.extent)
+        tiles = await self._fetch_tiles(
+            kvartal_layer(kvartal, kind, outline), extents, scale
+        )
+        tolerance = EXTENT_TOLERANCE_PX / scale
+        min_area = MIN_SEGMENT_PX / scale**2
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def harvest_segment(segment) -> dict[str, PkkGeojson]:
+            # у каждого сегмента свои находки: общий словарь между
+            # конкурентными задачами давал бы результат в порядке их гонки
+            harvested: dict[str, PkkGeojson] = {}
+            remaining = segment
+            while remaining.area > min_area:
+                point = to_4326(remaining.representative_point())
+                async with semaphore:
+                    found = await self.search_at_point(point.x, point.y, types=[kind])
+                feature = pick_feature(found.results, remaining, kvartal, tolerance)
+                if feature is None or feature.attrs.id in harvested:
+                    break
+                if fits_extent(remaining, feature.extent, tolerance):
+                    harvested[feature.attrs.id] = PkkGeojson(
+                        geometry=segment_geometry(
+                            remaining, self.output_crs
+                        ).__geo_interface__,
+                        properties=feature.attrs.model_dump_extra(),
+                    )
+                    break
+                # полигон - несколько слившихся объектов или часть объекта
+                async with semaphore:
+                    geojson = await self.get_geojson(feature)
+                harvested[feature.attrs.id] = geojson
+                geometry = geojson.shapely_geometry
+                if self.output_crs == 4326:
+                    geometry = to_3857(geometry)
+                remaining = remaining.difference(geometry.buffer(tolerance))
+            return harvested
+
+        segments = await self._run_cpu(extract_segments, tiles)
+        # объект, найденный в нескольких сегментах, берется из первого
+        # по порядку сегментов - как в синхронном клиенте
+        harvested: dict[str, PkkGeojson] = {}
+        for found in await gather_cancelling(map(harvest_segment, segments)):
+            for id_, geojson in found.items():
+                harvested.setdefault(id_, geojson)
+        return list(harvested.values())
+
     async def find_geojson(self, cn: Cn) -> Optional[PkkGeojson]:
         resp = await self.get_attrs(cn)
         feature = resp.feature
@@ -181,6 +1236,19 @@ class AsyncPKK:
         geojson = await self.get_geojson(feature)
         return geojson
 
+    def find_geojson_many(
+        self,
+        cns: Union[Iterable[Cn], AsyncIterable[Cn]],
+        concurrency: int = BULK_CONCURRENCY,
+        ordered: bool = False,
+    ) -> AsyncIterator[tuple[Cn, Union[Optional[PkkGeojson], Exception]]]:
+        """Пакетный `find_geojson`: выдает пары (cn, geojson или ошибка) по мере готовности.
+
+        Одновременно обрабатывается не больше `concurrency` номеров, а вход читается
+        лениво, поэтому память не растет с размером входа. Ошибка по одному номеру
+        не прерывает обработку остальных"""
+        return map_bounded(self.find_geojson, cns, concurrency, ordered)
+
     async def find_zu_geojson(self, code: str) -> Optional[ZuGeojson]:
         geojson = await self.find_geojson(Cn.zu(code))
         if geojson is None:
@@ -0,0 +1,186 @@
+import asyncio
+from dataclasses import dataclass, replace
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Hashable,
+    Iterable,
+    Optional,
+    TypeVar,
+    Union,
+)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+async def gather_cancelling(aws: Iterable[Awaitable[T]]) -> list[T]:
+    """Аналог asyncio.gather: результаты в порядке входа,
+    при первой ошибке оставшиеся задачи отменяются, а ошибка пробрасывается"""
+    tasks = [asyncio.ensure_future(i) for i in aws]
+    if len(tasks) == 0:
+        return []
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    except asyncio.CancelledError:
+        await _cancel_all(tasks)
+        raise
+    if pending:
+        await _cancel_all(pending)
+    for task in tasks:
+        if task in done and not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+    return [i.result() for i in tasks]
+
+
+async def _cancel_all(tasks: Iterable[asyncio.Future]):
+    tasks = list(tasks)
+    for i in tasks:
+        i.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def aiterate(items: Union[Iterable[T], AsyncIterable[T]]) -> AsyncIterator[T]:
+    """Обычный или асинхронный итерируемый объект как асинхронный"""
+    if isinstance(items, AsyncIterable):
+        async for i in items:
+            yield i
+    else:
+        for i in items:
+            yield i
+
+
+async def map_bounded(
+    func: Callable[[T], Awaitable[R]],
+    items: Union[Iterable[T], AsyncIterable[T]],
+    concurrency: int,
+    ordered: bool = False,
+) -> AsyncIterator[tuple[T, Union[R, Exception]]]:
+    """Применяет `func` к `items`, держа в работе не больше `concurrency` задач.
+
+    Выдает пары (item, результат или ошибка) по мере готовности, либо в порядке
+    входа при `ordered=True`. Входные данные читаются лениво: пока потребитель
+    не забрал результат, новые задачи не создаются. Следующий элемент
+    асинхронного входа ждется вместе с задачами, поэтому медленный вход
+    не задерживает выдачу готовых результатов"""
+    if concurrency < 1:
+        raise ValueError("concurrency должен быть не меньше 1")
+    if isinstance(items, AsyncIterable):
+        aiterator = items.__aiter__()
+        iterator = None
+    else:
+        aiterator = None
+        iterator = iter(items)
+    pending: dict[asyncio.Future, tuple[int, T]] = {}
+    # ожидание следующего элемента асинхронного входа
+    next_item: Optional[asyncio.Future] = None
+    # готовые результаты, ожидающие своей очереди при ordered=True
+    buffer: dict[int, tuple[T, Union[R, Exception]]] = {}
+    next_index = 0
+    yield_index = 0
+    exhausted = False
+
+    def start(item: T):
+        nonlocal next_index
+        task = asyncio.ensure_future(func(item))
+        pending[task] = (next_index, item)
+        next_index += 1
+
+    try:
+        while True:
+            while (
+                not exhausted
+                and next_item is None
+                and len(pending) + len(buffer) < concurrency
+            ):
+                if aiterator is not None:
+                    next_item = asyncio.ensure_future(aiterator.__anext__())
+                    break
+                try:
+                    start(next(iterator))
+                except StopIteration:
+                    exhausted = True
+            if len(pending) == 0 and next_item is None:
+                break
+            waiting = [*pending, next_item] if next_item is not None else [*pending]
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            if next_item is not None and next_item in done:
+                try:
+                    start(next_item.result())
+                except StopAsyncIteration:
+                    exhausted = True
+                finally:
+                    next_item = None
+            for task in sorted(
+                (i for i in done if i in pending), key=lambda t: pending[t][0]
+            ):
+                index, item = pending.pop(task)
+                if task.cancelled():
+                    result = asyncio.CancelledError()
+                elif task.exception() is not None:
+                    result = task.exception()
+                else:
+                    result = task.result()
+                if ordered:
+                    buffer[index] = (item, result)
+                else:
+                    yield item, result
+            while yield_index in buffer:
+                yield buffer.pop(yield_index)
+                yield_index += 1
+    finally:
+        await _cancel_all([*pending, *([next_item] if next_item is not None else [])])
+
+
+@dataclass
+class SingleFlightStats:
+    # сколько вызовов пришло и сколько из них присоединились к уже идущему
+    calls: int = 0
+    shared: int = 0
+
+
+@dataclass
+class _Flight:
+    task: asyncio.Future
+    waiters: int = 0
+
+
+class SingleFlight:
+    """Объединение одинаковых одновременных вызовов.
+
+    Пока вызов с ключом `key` выполняется, повторные вызовы с тем же ключом
+    не запускают `func` заново, а ждут общий результат (или общую ошибку).
+    Отмена одного ожидающего не прерывает вызов для остальных; вызов
+    отменяется, только когда его больше никто не ждет"""
+
+    def __init__(self):
+        self._flights: dict[Hashable, _Flight] = {}
+        self._stats = SingleFlightStats()
+
+    @property
+    def stats(self) -> SingleFlightStats:
+        return replace(self._stats)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        self._stats.calls += 1
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(func()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+        else:
+            self._stats.shared += 1
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+                self._forget(key, flight)
+
+    def _forget(self, key: Hashable, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
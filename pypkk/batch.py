@@ -0,0 +1,143 @@
+"""Общие тайлы для соседних объектов пакета.
+
+Небольшие объекты одного типа, которые вместе умещаются в один тайл,
+запрашиваются одним тайлом с фильтром `ID IN (...)` и обводкой объектов.
+Контуры общего тайла (`extract_segments`) раздаются объектам по центру:
+объект получает полигон, в котором лежит его центр, если полигон больше
+ничей и его экстент совпадает с экстентом объекта. Остальные объекты
+(несколько контуров, слившиеся соседи, нет центра) строятся по одному"""
+
+from itertools import islice
+from typing import Iterable, Iterator, Optional, Sequence, TypeVar
+
+from shapely import STRtree
+from shapely.geometry import MultiPolygon, Point
+
+from pypkk.geom_utils import OutputCrs
+from pypkk.image import (
+    EXTENT_TOLERANCE_PX,
+    TilePayload,
+    extract_segments,
+    fits_extent,
+    segment_geometry,
+)
+from pypkk.requests import TileLayer
+from pypkk.schemas.coords import PkkExtent
+from pypkk.schemas.features import PkkSearchFeature
+from pypkk.tile_utils import (
+    DEFAULT_SCALE,
+    PKK_MAX_TILE_SIZE,
+    TILE_BUFFER,
+    buffer_extent,
+)
+
+# сколько объектов рисуется на одном общем тайле: список ID
+# попадает в адрес запроса и не должен раздувать его
+BATCH_MAX_FEATURES = 20
+# сколько объектов входа раскладывается по общим тайлам за раз: соседи
+# ищутся внутри окна, а вход читается частями, и память не растет с его размером
+BATCH_WINDOW = 500
+
+T = TypeVar("T")
+
+
+def windows(items: Iterable[T], size: int = BATCH_WINDOW) -> Iterator[list[T]]:
+    """Вход частями не больше `size` элементов"""
+    iterator = iter(items)
+    while window := list(islice(iterator, size)):
+        yield window
+
+
+def _union_extent(extents: Sequence[PkkExtent]) -> PkkExtent:
+    return PkkExtent(
+        xmin=min(i.xmin for i in extents),
+        ymin=min(i.ymin for i in extents),
+        xmax=max(i.xmax for i in extents),
+        ymax=max(i.ymax for i in extents),
+    )
+
+
+def plan_batches(
+    features: Sequence[PkkSearchFeature], max_features: int = BATCH_MAX_FEATURES
+) -> tuple[list[list[int]], list[int]]:
+    """Группы соседних объектов, которые вместе умещаются в один тайл.
+
+    Возвращает группы индексов `features` (от двух объектов) и индексы
+    объектов, запрашиваемых по одному"""
+    max_size = PKK_MAX_TILE_SIZE / DEFAULT_SCALE - TILE_BUFFER * 2
+    # группа: тип объектов, общий экстент и индексы
+    groups: list[tuple[int, PkkExtent, list[int]]] = []
+    singles: list[int] = []
+    order = sorted(
+        (i for i, f in enumerate(features) if f.extent is not None),
+        key=lambda i: (-features[i].extent.ymax // max_size, features[i].extent.xmin),
+    )
+    for index in order:
+        feature = features[index]
+        extent = feature.extent
+        if extent.xmax - extent.xmin > max_size or extent.ymax - extent.ymin > max_size:
+            singles.append(index)
+            continue
+        for n, (kind, group_extent, indices) in enumerate(groups):
+            if kind != feature.type or len(indices) >= max_features:
+                continue
+            merged = _union_extent([group_extent, extent])
+            if (
+                merged.xmax - merged.xmin <= max_size
+                and merged.ymax - merged.ymin <= max_size
+            ):
+                indices.append(index)
+                groups[n] = (kind, merged, indices)
+                break
+        else:
+            groups.append((feature.type, extent, [index]))
+    batches = []
+    for _, _, indices in groups:
+        if len(indices) > 1:
+            batches.append(indices)
+        else:
+            singles.extend(indices)
+    return batches, sorted(singles)
+
+
+def batch_layer(features: Sequence[PkkSearchFeature]) -> TileLayer:
+    ids = ", ".join(f"'{i.attrs.id}'" for i in features)
+    return TileLayer(features[0].type, f"ID IN ({ids})", outline=True)
+
+
+def batch_extent(features: Sequence[PkkSearchFeature]) -> PkkExtent:
+    """Экстент общего тайла группы с буфером"""
+    return buffer_extent(_union_extent([i.extent for i in features]), TILE_BUFFER)
+
+
+def extract_batch_geometries(
+    tiles: Sequence[TilePayload],
+    centers: Sequence[Optional[tuple[float, float]]],
+    extents: Sequence[PkkExtent],
+    output_crs: OutputCrs = 4326,
+) -> list[Optional[MultiPolygon]]:
+    """Геометрии объектов группы с общего тайла, по порядку `centers`.
+
+    None - объект не удалось однозначно выделить, его нужно строить отдельно.
+    Чистая функция от сырых данных - может выполняться в пуле процессов"""
+    tolerance = EXTENT_TOLERANCE_PX / DEFAULT_SCALE
+    result: list[Optional[MultiPolygon]] = [None] * len(centers)
+    segments = extract_segments(tiles)
+    if len(segments) == 0:
+        return result
+    tree = STRtree(segments)
+    owners: dict[int, list[int]] = {}
+    for index, center in enumerate(centers):
+        if center is None:
+            continue
+        hits = tree.query(Point(center).buffer(tolerance), predicate="intersects")
+        if len(hits) == 1:
+            owners.setdefault(int(hits[0]), []).append(index)
+    for segment, indices in owners.items():
+        # в полигоне несколько центров - соседи слились в один контур
+        if len(indices) != 1:
+            continue
+        index = indices[0]
+        if fits_extent(segments[segment], extents[index], tolerance):
+            result[index] = segment_geometry(segments[segment], output_crs)
+    return result
@@ -0,0 +1,443 @@
+"""Хранилища http-кэша.
+
+Ответы ПКК кэшируются в двух уровнях: ограниченный LRU в памяти процесса
+и постоянное хранилище за ним - sqlite, файлы или общий для нескольких
+машин redis (либо любой клиент с тем же подмножеством методов)"""
+
+import datetime
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Any, Literal, Optional, TypedDict, Union
+
+import anysqlite
+import hishel
+from hishel import clone_model
+from httpcore import Request, Response
+
+HTTP_CACHE_PATH = ".hishel.sqlite"
+HTTP_CACHE_DIR = ".hishel"
+DEFAULT_REDIS_URL = "redis://localhost:6379/0"
+# префикс ключей в общем хранилище, чтобы не пересекаться с чужими данными
+REDIS_KEY_PREFIX = "pypkk:"
+# предел LRU в памяти: по числу ответов и по суммарному размеру тел
+MEMORY_CACHE_ENTRIES = 1024
+MEMORY_CACHE_BYTES = 64 * 2**20
+
+CacheType = Literal["sqlite", "filesystem", "redis"]
+# тип постоянного хранилища или готовое хранилище hishel; None - без кэша
+CacheArg = Optional[Union[CacheType, hishel.BaseStorage, hishel.AsyncBaseStorage]]
+
+
+class Metadata(TypedDict):
+    """Метаданные ответа в хранилище hishel; повторяет hishel._serializers.Metadata,
+    чтобы не зависеть от приватного модуля"""
+
+    cache_key: str
+    number_of_uses: int
+    created_at: datetime.datetime
+
+
+StoredResponse = tuple[Response, Request, Metadata]
+
+
+@dataclass
+class MemoryCacheStats:
+    hits: int = 0
+    misses: int = 0
+    entries: int = 0
+    bytes: int = 0
+
+
+def _entry_size(response: Response) -> int:
+    return len(response.content) + sum(len(k) + len(v) for k, v in response.headers)
+
+
+def _clone_response(response: Response) -> Response:
+    clone = clone_model(response)
+    # тело - те же bytes, чтение только помечает ответ прочитанным
+    clone.read()
+    return clone
+
+
+def _clone(stored: StoredResponse) -> StoredResponse:
+    # транспорт hishel дописывает extensions в отданный ответ,
+    # поэтому наружу уходят копии
+    response, request, metadata = stored
+    return _clone_response(response), clone_model(request), Metadata(**metadata)
+
+
+def _cache_key(key: Union[str, Response]) -> str:
+    if isinstance(key, Response):
+        return key.extensions["cache_metadata"]["cache_key"]
+    return key
+
+
+class _MemoryLru:
+    """LRU ответов в памяти, ограниченный числом записей и байтами"""
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: Optional[float]):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (ответ, размер, время записи)
+        self._entries: OrderedDict[str, tuple[StoredResponse, int, float]] = (
+            OrderedDict()
+        )
+        self._stats = MemoryCacheStats()
+
+    @property
+    def stats(self) -> MemoryCacheStats:
+        with self._lock:
+            return replace(self._stats)
+
+    def get(self, key: str) -> Optional[StoredResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._pop(key)
+                entry = None
+            if entry is None:
+                self._stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats.hits += 1
+        return _clone(entry[0])
+
+    def put(self, key: str, stored: StoredResponse, created: Optional[float] = None):
+        size = _entry_size(stored[0])
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        stored = (_clone_response(stored[0]), clone_model(stored[1]), stored[2])
+        created = created if created is not None else _now()
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (stored, size, created)
+            self._stats.bytes += size
+            while (
+                len(self._entries) > self.max_entries
+                or self._stats.bytes > self.max_bytes
+            ):
+                self._pop(next(iter(self._entries)))
+            self._stats.entries = len(self._entries)
+
+    def update_metadata(self, key: str, metadata: Metadata):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                (response, request, _), size, created = entry
+                self._entries[key] = ((response, request, metadata), size, created)
+
+    def remove(self, key: str):
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._stats.bytes -= entry[1]
+        self._stats.entries = len(self._entries)
+
+    def _expired(self, entry: tuple[StoredResponse, int, float]) -> bool:
+        return self.ttl is not None and _now() - entry[2] > self.ttl
+
+
+def _now() -> float:
+    return datetime.datetime.now(datetime.timezone.utc).timestamp()
+
+
+def _created_at(stored: StoredResponse) -> float:
+    return stored[2]["created_at"].timestamp()
+
+
+class LayeredStorage(hishel.BaseStorage):
+    """LRU в памяти перед постоянным хранилищем `backend`.
+
+    Горячие ответы (атрибуты, повторные тайлы) отдаются из памяти без чтения
+    и разбора json. Счетчик использований hishel обновляется только в памяти:
+    sqlite на каждое попадание перезаписывал бы ответ целиком"""
+
+    def __init__(
+        self,
+        backend: hishel.BaseStorage,
+        max_entries: int = MEMORY_CACHE_ENTRIES,
+        max_bytes: int = MEMORY_CACHE_BYTES,
+        ttl: Optional[float] = None,
+    ):
+        super().__init__(ttl=ttl)
+        self.backend = backend
+        self.memory = _MemoryLru(max_entries, max_bytes, ttl)
+
+    def store(
+        self,
+        key: str,
+        response: Response,
+        request: Request,
+        metadata: Optional[Metadata] = None,
+    ):
+        metadata = metadata or Metadata(
+            cache_key=key,
+            created_at=datetime.datetime.now(datetime.timezone.utc),
+            number_of_uses=0,
+        )
+        self.backend.store(key, response, request, metadata)
+        self.memory.put(key, (response, request, metadata))
+
+    def retrieve(self, key: str) -> Optional[StoredResponse]:
+        stored = self.memory.get(key)
+        if stored is not None:
+            return stored
+        stored = self.backend.retrieve(key)
+        if stored is not None:
+            stored[0].read()
+            self.memory.put(key, stored, _created_at(stored))
+        return stored
+
+    def update_metadata(
+        self, key: str, response: Response, request: Request, metadata: Metadata
+    ):
+        self.memory.update_metadata(key, metadata)
+
+    def remove(self, key: Union[str, Response]):
+        self.memory.remove(_cache_key(key))
+        self.backend.remove(key)
+
+    def close(self):
+        self.backend.close()
+
+
+class AsyncLayeredStorage(hishel.AsyncBaseStorage):
+    """Асинхронный вариант `LayeredStorage`"""
+
+    def __init__(
+        self,
+        backend: hishel.AsyncBaseStorage,
+        max_entries: int = MEMORY_CACHE_ENTRIES,
+        max_bytes: int = MEMORY_CACHE_BYTES,
+        ttl: Optional[float] = None,
+    ):
+        super().__init__(ttl=ttl)
+        self.backend = backend
+        self.memory = _MemoryLru(max_entries, max_bytes, ttl)
+
+    async def store(
+        self,
+        key: str,
+        response: Response,
+        request: Request,
+        metadata: Optional[Metadata] = None,
+    ):
+        metadata = metadata or Metadata(
+            cache_key=key,
+            created_at=datetime.datetime.now(datetime.timezone.utc),
+            number_of_uses=0,
+        )
+        await self.backend.store(key, response, request, metadata)
+        self.memory.put(key, (response, request, metadata))
+
+    async def retrieve(self, key: str) -> Optional[StoredResponse]:
+        stored = self.memory.get(key)
+        if stored is not None:
+            return stored
+        stored = await self.backend.retrieve(key)
+        if stored is not None:
+            await stored[0].aread()
+            self.memory.put(key, stored, _created_at(stored))
+        return stored
+
+    async def update_metadata(
+        self, key: str, response: Response, request: Request, metadata: Metadata
+    ):
+        self.memory.update_metadata(key, metadata)
+
+    async def remove(self, key: Union[str, Response]):
+        self.memory.remove(_cache_key(key))
+        await self.backend.remove(key)
+
+    async def aclose(self):
+        await self.backend.aclose()
+
+
+class KeyValueStorage(hishel.BaseStorage):
+    """Хранилище в общем key-value сервере: redis.Redis или любой клиент
+    с методами get(key), set(key, value, px=ttl_ms) и delete(key)"""
+
+    def __init__(
+        self,
+        client: Any,
+        ttl: Optional[float] = None,
+        prefix: str = REDIS_KEY_PREFIX,
+    ):
+        super().__init__(ttl=ttl)
+        self._client = client
+        self._prefix = prefix
+
+    def store(
+        self,
+        key: str,
+        response: Response,
+        request: Request,
+        metadata: Optional[Metadata] = None,
+    ):
+        metadata = metadata or Metadata(
+            cache_key=key,
+            created_at=datetime.datetime.now(datetime.timezone.utc),
+            number_of_uses=0,
+        )
+        data = self._serializer.dumps(
+            response=response, request=request, metadata=metadata
+        )
+        px = int(self._ttl * 1000) if self._ttl is not None else None
+        self._client.set(self._prefix + key, data, px=px)
+
+    def retrieve(self, key: str) -> Optional[StoredResponse]:
+        data = self._client.get(self._prefix + key)
+        if data is None:
+            return None
+        return self._serializer.loads(data)
+
+    def update_metadata(
+        self, key: str, response: Response, request: Request, metadata: Metadata
+    ):
+        # ответ целиком не перезаписывается ради счетчика использований
+        pass
+
+    def remove(self, key: Union[str, Response]):
+        self._client.delete(self._prefix + _cache_key(key))
+
+    def close(self):
+        self._client.close()
+
+
+class AsyncKeyValueStorage(hishel.AsyncBaseStorage):
+    """Асинхронный вариант `KeyValueStorage`: redis.asyncio.Redis
+    или клиент с асинхронными get, set и delete"""
+
+    def __init__(
+        self,
+        client: Any,
+        ttl: Optional[float] = None,
+        prefix: str = REDIS_KEY_PREFIX,
+    ):
+        super().__init__(ttl=ttl)
+        self._client = client
+        self._prefix = prefix
+
+    async def store(
+        self,
+        key: str,
+        response: Response,
+        request: Request,
+        metadata: Optional[Metadata] = None,
+    ):
+        metadata = metadata or Metadata(
+            cache_key=key,
+            created_at=datetime.datetime.now(datetime.timezone.utc),
+            number_of_uses=0,
+        )
+        data = self._serializer.dumps(
+            response=response, request=request, metadata=metadata
+        )
+        px = int(self._ttl * 1000) if self._ttl is not None else None
+        await self._client.set(self._prefix + key, data, px=px)
+
+    async def retrieve(self, key: str) -> Optional[StoredResponse]:
+        data = await self._client.get(self._prefix + key)
+        if data is None:
+            return None
+        return self._serializer.loads(data)
+
+    async def update_metadata(
+        self, key: str, response: Response, request: Request, metadata: Metadata
+    ):
+        pass
+
+    async def remove(self, key: Union[str, Response]):
+        await self._client.delete(self._prefix + _cache_key(key))
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+def _import_redis():
+    try:
+        import redis
+        import redis.asyncio
+    except ImportError as e:
+        raise RuntimeError(
+            "для cache_type='redis' нужен пакет redis: pip install redis"
+        ) from e
+    return redis
+
+
+def build_storage(
+    cache_type: CacheArg,
+    cache_dir: Optional[Union[str, Path]],
+    ttl: Optional[float],
+    cache_url: Optional[str] = None,
+    memory_entries: int = MEMORY_CACHE_ENTRIES,
+    memory_bytes: int = MEMORY_CACHE_BYTES,
+) -> Optional[hishel.BaseStorage]:
+    cache_dir = Path(cache_dir or ".")
+    match cache_type:
+        case None:
+            return None
+        case "sqlite":
+            backend = hishel.SQLiteStorage(
+                connection=sqlite3.connect(
+                    cache_dir / HTTP_CACHE_PATH, check_same_thread=False
+                ),
+                ttl=ttl,
+            )
+        case "filesystem":
+            backend = hishel.FileStorage(base_path=cache_dir / HTTP_CACHE_DIR, ttl=ttl)
+        case "redis":
+            redis = _import_redis()
+            backend = KeyValueStorage(
+                redis.Redis.from_url(cache_url or DEFAULT_REDIS_URL), ttl=ttl
+            )
+        case hishel.BaseStorage():
+            backend = cache_type
+        case _:
+            raise ValueError(f"неизвестный cache_type: {cache_type!r}")
+    return LayeredStorage(backend, memory_entries, memory_bytes, ttl)
+
+
+def build_async_storage(
+    cache_type: CacheArg,
+    cache_dir: Optional[Union[str, Path]],
+    ttl: Optional[float],
+    cache_url: Optional[str] = None,
+    memory_entries: int = MEMORY_CACHE_ENTRIES,
+    memory_bytes: int = MEMORY_CACHE_BYTES,
+) -> Optional[hishel.AsyncBaseStorage]:
+    cache_dir = Path(cache_dir or ".")
+    match cache_type:
+        case None:
+            return None
+        case "sqlite":
+            backend = hishel.AsyncSQLiteStorage(
+                connection=anysqlite.Connection(
+                    sqlite3.connect(
+                        cache_dir / HTTP_CACHE_PATH, check_same_thread=False
+                    )
+                ),
+                ttl=ttl,
+            )
+        case "filesystem":
+            backend = hishel.AsyncFileStorage(
+                base_path=cache_dir / HTTP_CACHE_DIR, ttl=ttl
+            )
+        case "redis":
+            redis = _import_redis()
+            backend = AsyncKeyValueStorage(
+                redis.asyncio.Redis.from_url(cache_url or DEFAULT_REDIS_URL), ttl=ttl
+            )
+        case hishel.AsyncBaseStorage():
+            backend = cache_type
+        case _:
+            raise ValueError(f"неизвестный cache_type: {cache_type!r}")
+    return AsyncLayeredStorage(backend, memory_entries, memory_bytes, ttl)
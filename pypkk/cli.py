@@ -0,0 +1,258 @@
+"""Пакетное получение геометрий из командной строки.
+
+pypkk cns.txt > features.geojsonl
+cat report.txt | pypkk --extract --type oks --format geojsonseq > oks.geojsons
+pypkk cns.txt --format gpkg --output features.gpkg
+"""
+
+import argparse
+import asyncio
+import codecs
+import sys
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+    TextIO,
+)
+
+from pydantic import ValidationError
+
+from pypkk.api import BULK_CONCURRENCY, AsyncPKK
+from pypkk.instrumentation import StatsAggregator
+from pypkk.jobs import BulkJob
+from pypkk.rate_limit import RateLimit
+from pypkk.requests import DEFAULT_API_RATE_LIMIT, DEFAULT_TILE_RATE_LIMIT
+from pypkk.schemas.inputs import Cn
+from pypkk.transport import PoolConfig
+from pypkk.writers import FeatureWriter, GeoJsonSeqWriter, GeoPackageWriter
+
+KINDS = {"zu": 1, "oks": 5}
+# сколько байт входа читается за один переход в поток
+READ_CHUNK_SIZE = 1 << 16
+
+
+async def _aiter_lines(paths: list[str]) -> AsyncIterator[str]:
+    """Строки входа; чтение идет в потоке, чтобы медленный stdin
+    не останавливал event loop с идущими запросами. За один переход
+    в поток читается все, что уже есть во входе (до READ_CHUNK_SIZE байт),
+    а не одна строка: на входе в миллионы строк переходы не тормозят чтение"""
+    for path in paths or ["-"]:
+        if path == "-":
+            file = sys.stdin.buffer
+        else:
+            file = await asyncio.to_thread(open, path, "rb")
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        tail = ""
+        try:
+            while chunk := await asyncio.to_thread(file.read1, READ_CHUNK_SIZE):
+                lines = (tail + decoder.decode(chunk)).splitlines(keepends=True)
+                # последняя строка без перевода дочитывается со следующим куском
+                tail = ""
+                if lines and not lines[-1].endswith(("\n", "\r")):
+                    tail = lines.pop()
+                for line in lines:
+                    yield line
+            tail += decoder.decode(b"", final=True)
+            if tail:
+                yield tail
+        finally:
+            if file is not sys.stdin.buffer:
+                file.close()
+
+
+def _report_invalid(code: str):
+    print(f"{code}\tне кадастровый номер", file=sys.stderr)
+
+
+def _line_cns(
+    line: str, kind: int, extract: bool, on_invalid: Callable[[str], None]
+) -> Iterator[Cn]:
+    codes = Cn.iter_cns(line) if extract else [line.strip()]
+    for code in codes:
+        if not code:
+            continue
+        try:
+            yield Cn(code=code, kind=kind)
+        except ValidationError:
+            on_invalid(code)
+
+
+def iter_cns(
+    lines: Iterable[str],
+    kind: int,
+    extract: bool,
+    on_invalid: Callable[[str], None] = _report_invalid,
+) -> Iterator[Cn]:
+    """Номера из строк ввода: по одному на строку, либо все найденные в тексте.
+
+    Строки, которые не являются номерами, передаются в `on_invalid`"""
+    for line in lines:
+        yield from _line_cns(line, kind, extract, on_invalid)
+
+
+async def aiter_cns(
+    lines: AsyncIterable[str],
+    kind: int,
+    extract: bool,
+    on_invalid: Callable[[str], None] = _report_invalid,
+) -> AsyncIterator[Cn]:
+    """`iter_cns` для асинхронного входа"""
+    async for line in lines:
+        for cn in _line_cns(line, kind, extract, on_invalid):
+            yield cn
+
+
+def _rate_limit(rate: float, burst: int) -> Optional[RateLimit]:
+    return RateLimit(rate, burst) if rate > 0 else None
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="pypkk", description="Геометрии объектов ПКК по кадастровым номерам"
+    )
+    parser.add_argument(
+        "inputs", nargs="*", help="файлы с номерами; по умолчанию stdin (-)"
+    )
+    parser.add_argument("--type", choices=KINDS, default="zu", help="тип объектов")
+    parser.add_argument(
+        "--extract",
+        action="store_true",
+        help="искать номера в произвольном тексте, а не по одному на строку",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["ndjson", "geojsonseq", "gpkg"],
+        default="ndjson",
+        help="ndjson - по объекту на строку, geojsonseq - RFC 8142, "
+        "gpkg - GeoPackage с пространственным индексом (нужен --output)",
+    )
+    parser.add_argument(
+        "-o", "--output", help="файл результата; по умолчанию stdout (кроме gpkg)"
+    )
+    parser.add_argument("--concurrency", type=int, default=BULK_CONCURRENCY)
+    # с журналом номера обрабатываются в порядке журнала, а не входа
+    order = parser.add_mutually_exclusive_group()
+    order.add_argument(
+        "--ordered", action="store_true", help="выводить в порядке входа"
+    )
+    parser.add_argument(
+        "--api-rate",
+        type=float,
+        default=DEFAULT_API_RATE_LIMIT.rate,
+        help="запросов к API в секунду, 0 - без ограничения",
+    )
+    parser.add_argument("--api-burst", type=int, default=DEFAULT_API_RATE_LIMIT.burst)
+    parser.add_argument(
+        "--tile-rate",
+        type=float,
+        default=DEFAULT_TILE_RATE_LIMIT.rate,
+        help="запросов тайлов в секунду, 0 - без ограничения",
+    )
+    parser.add_argument("--tile-burst", type=int, default=DEFAULT_TILE_RATE_LIMIT.burst)
+    parser.add_argument("--cache-dir", help="каталог для файлов кэша")
+    parser.add_argument(
+        "--cache-type",
+        choices=["sqlite", "filesystem", "redis"],
+        default="sqlite",
+        help="постоянное хранилище http-кэша",
+    )
+    parser.add_argument("--cache-url", help="адрес redis для --cache-type redis")
+    parser.add_argument("--no-cache", action="store_true", help="отключить кэш")
+    order.add_argument(
+        "--journal",
+        help="журнал sqlite для возобновляемой обработки (см. pypkk.jobs.BulkJob); "
+        "не сочетается с --ordered",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=PoolConfig.max_connections,
+        help="предел соединений в пуле",
+    )
+    parser.add_argument("--http2", action="store_true", help="HTTP/2 (нужен пакет h2)")
+    parser.add_argument(
+        "--tile-format",
+        choices=["image", "json"],
+        default="image",
+        help="image - сырые png тайлов, json - png в base64 (запасной вариант)",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="напечатать в stderr сводку p50/p95 по стадиям",
+    )
+    return parser
+
+
+def _writer(args: argparse.Namespace, output: TextIO) -> FeatureWriter:
+    if args.format == "gpkg":
+        if not args.output:
+            raise SystemExit("для --format gpkg нужен --output")
+        return GeoPackageWriter(args.output)
+    return GeoJsonSeqWriter(
+        args.output or output, record_separator=args.format == "geojsonseq"
+    )
+
+
+async def run(args: argparse.Namespace, output: TextIO = sys.stdout) -> int:
+    writer = _writer(args, output)
+    # неверные номера во входе тоже считаются сбоем: иначе вход
+    # из одних опечаток завершался бы успешно, ничего не обработав
+    failed = 0
+
+    def invalid(code: str):
+        nonlocal failed
+        failed += 1
+        _report_invalid(code)
+
+    cns = aiter_cns(_aiter_lines(args.inputs), KINDS[args.type], args.extract, invalid)
+    stats = StatsAggregator() if args.stats else None
+    async with AsyncPKK(
+        cache_type=None if args.no_cache else args.cache_type,
+        cache_dir=args.cache_dir,
+        cache_url=args.cache_url,
+        api_rate_limit=_rate_limit(args.api_rate, args.api_burst),
+        tile_rate_limit=_rate_limit(args.tile_rate, args.tile_burst),
+        observer=stats,
+        pool=PoolConfig(max_connections=args.max_connections, http2=args.http2),
+        tile_format=args.tile_format,
+    ) as api:
+        if args.journal:
+            job = BulkJob(api, args.journal, concurrency=args.concurrency)
+            results = job.run(cns)
+        else:
+            job = None
+            results = api.find_geojson_many(
+                cns, concurrency=args.concurrency, ordered=args.ordered
+            )
+        try:
+            async for cn, result in results:
+                if isinstance(result, Exception):
+                    failed += 1
+                    print(
+                        f"{cn.code}\t{type(result).__name__}: {result}", file=sys.stderr
+                    )
+                elif result is None:
+                    print(f"{cn.code}\tне найден или без координат", file=sys.stderr)
+                else:
+                    writer.write(result)
+        finally:
+            writer.close()
+            if job is not None:
+                job.close()
+    if stats is not None:
+        stats.print_summary()
+    return 1 if failed else 0
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,72 @@
-from typing import TypeVar
+from functools import lru_cache
+from typing import Callable, Literal, TypeVar
 
-import pyproj
+import numpy as np
+import shapely
 from shapely.geometry.base import BaseGeometry
-from shapely.ops import transform
+
+# модуль относится к стеку геометрии: pypkk.api импортирует его
+# только при первой работе с геометрией
 
 T = TypeVar("T", bound=BaseGeometry)
 
+# система координат результата: тайлы ПКК в epsg:3857,
+# по умолчанию геометрии переводятся в epsg:4326
+OutputCrs = Literal[4326, 3857]
+
+# радиус сферы Web Mercator (epsg:3857), м
+EARTH_RADIUS = 6378137.0
+
+
+def mercator_to_lnglat(coords: np.ndarray) -> np.ndarray:
+    """Массив (N, 2) координат epsg:3857 в (lng, lat) epsg:4326.
 
-EPSG_3857 = pyproj.CRS("epsg:3857")
-EPSG_4326 = pyproj.CRS("epsg:4326")
-TRANSFORM_3857_4326 = pyproj.Transformer.from_crs(
-    EPSG_3857, EPSG_4326, always_xy=True
-).transform
+    Обратная сферическая проекция Меркатора в замкнутом виде,
+    совпадает с pyproj до ошибки округления"""
+    lng = np.degrees(coords[:, 0] / EARTH_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(coords[:, 1] / EARTH_RADIUS)) - np.pi / 2)
+    return np.column_stack([lng, lat])
+
+
+def lnglat_to_mercator(coords: np.ndarray) -> np.ndarray:
+    """Массив (N, 2) координат (lng, lat) epsg:4326 в epsg:3857"""
+    x = np.radians(coords[:, 0]) * EARTH_RADIUS
+    y = np.log(np.tan(np.pi / 4 + np.radians(coords[:, 1]) / 2)) * EARTH_RADIUS
+    return np.column_stack([x, y])
 
 
 def to_4326(geom: T) -> T:
-    """Перевод геометрии из epsg:3857 в epsg:4326"""
-    return transform(TRANSFORM_3857_4326, geom)
+    """Перевод геометрии (или массива геометрий) из epsg:3857 в epsg:4326"""
+    return shapely.transform(geom, mercator_to_lnglat)
+
+
+def to_3857(geom: T) -> T:
+    """Перевод геометрии (или массива геометрий) из epsg:4326 в epsg:3857"""
+    return shapely.transform(geom, lnglat_to_mercator)
+
+
+def to_crs(geom: T, crs: OutputCrs) -> T:
+    """Перевод геометрии из epsg:3857 в систему координат результата"""
+    if crs == 3857:
+        return geom
+    return to_4326(geom)
+
+
+@lru_cache(maxsize=None)
+def _transformer(src: str, dst: str) -> Callable:
+    import pyproj
+
+    return pyproj.Transformer.from_crs(src, dst, always_xy=True).transform
+
+
+def __getattr__(name: str):
+    # прежние константы модуля на pyproj, создаются по первому обращению
+    if name in ("EPSG_3857", "EPSG_4326"):
+        import pyproj
+
+        return pyproj.CRS(name.replace("_", ":").lower())
+    if name == "TRANSFORM_3857_4326":
+        return _transformer("epsg:3857", "epsg:4326")
+    if name == "TRANSFORM_4326_3857":
+        return _transformer("epsg:4326", "epsg:3857")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
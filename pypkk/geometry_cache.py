@@ -0,0 +1,115 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from time import time
+from typing import TYPE_CHECKING, Optional, Union
+
+from pypkk.schemas.features import PkkSearchFeature
+from pypkk.schemas.inputs import clean_cn
+
+if TYPE_CHECKING:
+    from shapely.geometry import MultiPolygon
+
+    from pypkk.geom_utils import OutputCrs
+
+DEFAULT_GEOMETRY_CACHE_PATH = ".pypkk.sqlite"
+DEFAULT_GEOMETRY_CACHE_TTL = 30 * 24 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS geometries (
+    kind INTEGER NOT NULL,
+    code TEXT NOT NULL,
+    attrs_hash TEXT NOT NULL,
+    geometry BLOB NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (kind, code)
+)
+"""
+
+
+def attrs_hash(feature: PkkSearchFeature) -> str:
+    """Отпечаток объекта: при изменении его экстента геометрия пересчитывается.
+
+    Берутся только поля, общие для ответов поиска (SearchAttrs) и get_attrs
+    (ZuAttrs, OksAttrs): остальные атрибуты у них разные по составу и типам,
+    и один объект получал бы два отпечатка"""
+    extent = feature.extent
+    key = [
+        feature.attrs.id,
+        clean_cn(feature.attrs.cn),
+        None
+        if extent is None
+        else [extent.xmin, extent.ymin, extent.xmax, extent.ymax],
+    ]
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+
+class GeometryCache:
+    """Кэш итоговых геометрий объектов по (тип, кадастровый номер).
+
+    В отличие от http-кэша хранит уже векторизованную геометрию (WKB),
+    поэтому повторный запрос объекта не декодирует тайлы заново.
+
+    Геометрии хранятся в epsg:4326; `crs` - система координат,
+    в которой они принимаются и отдаются"""
+
+    def __init__(
+        self,
+        path: Union[str, Path] = DEFAULT_GEOMETRY_CACHE_PATH,
+        ttl: Optional[int] = DEFAULT_GEOMETRY_CACHE_TTL,
+        crs: "OutputCrs" = 4326,
+    ):
+        self.ttl = ttl
+        self.crs = crs
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(_SCHEMA)
+
+    def get(self, feature: PkkSearchFeature) -> Optional["MultiPolygon"]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT attrs_hash, geometry, created_at FROM geometries "
+                "WHERE kind = ? AND code = ?",
+                (feature.type, clean_cn(feature.attrs.cn)),
+            ).fetchone()
+        if row is None:
+            return None
+        hash_, geometry, created_at = row
+        if hash_ != attrs_hash(feature):
+            return None
+        if self.ttl is not None and time() - created_at > self.ttl:
+            return None
+        import shapely
+
+        geometry = shapely.from_wkb(geometry)
+        if self.crs == 3857:
+            from pypkk.geom_utils import to_3857
+
+            geometry = to_3857(geometry)
+        return geometry
+
+    def set(self, feature: PkkSearchFeature, geometry: "MultiPolygon"):
+        import shapely
+
+        if self.crs == 3857:
+            from pypkk.geom_utils import to_4326
+
+            geometry = to_4326(geometry)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO geometries VALUES (?, ?, ?, ?, ?)",
+                (
+                    feature.type,
+                    clean_cn(feature.attrs.cn),
+                    attrs_hash(feature),
+                    shapely.to_wkb(geometry),
+                    time(),
+                ),
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
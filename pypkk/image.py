@@ -1,28 +1,84 @@
-from io import BytesIO
-from typing import Optional
+from typing import NamedTuple, Optional, Sequence
 
 import cv2
 import numpy as np
-from shapely.geometry import LineString, MultiPolygon, Polygon
+import shapely
+from shapely.geometry import MultiPolygon, Polygon
+from shapely.geometry.base import BaseGeometry
 from shapely.ops import unary_union
 from shapely.validation import make_valid
 
-from pypkk.geom_utils import to_4326
+from pypkk.geom_utils import OutputCrs, to_4326, to_crs
+from pypkk.instrumentation import stage
+from pypkk.schemas.coords import PkkExtent
 from pypkk.schemas.responses import PkkTileResponse
+from pypkk.tile_utils import (
+    DEFAULT_RESOLUTION,
+    MAX_SUBTILES_PER_CN,
+    OUTLINE_PX,
+    generate_refined_tile_extents,
+)
+
+# предел размера мозаики в пикселях (= байтах маски uint8); тайлы большого
+# объекта склеиваются полосами из целых рядов, чтобы не упереться в память
+MOSAIC_MAX_PIXELS = 256_000_000
+
+
+# допуск сравнения экстентов полигона и объекта, пиксели тайла
+EXTENT_TOLERANCE_PX = 4
 
 
 class NoContoursError(Exception):
     pass
 
 
-def _get_image_xy_corner(stream: BytesIO):
-    """get сartesian coordinates from raster"""
-    image_xy_corners = []
-    bytes = bytearray(stream.read())
-    numpyarray = np.asarray(bytes, dtype=np.uint8)
-    img = cv2.imdecode(numpyarray, cv2.IMREAD_GRAYSCALE)
-    imagem = 255 - img
-    ret, thresh = cv2.threshold(imagem, 10, 128, cv2.THRESH_BINARY)
+class TilePayload(NamedTuple):
+    """Компактное представление тайла для передачи в пул процессов:
+    сырой png и его привязка"""
+
+    image: bytes
+    # xmin, ymin, xmax, ymax
+    extent: tuple[float, float, float, float]
+    width: int
+    height: int
+
+    @classmethod
+    def from_response(cls, tile_data: PkkTileResponse) -> "TilePayload":
+        extent = tile_data.extent
+        return cls(
+            image=tile_data.image_data,
+            extent=(extent.xmin, extent.ymin, extent.xmax, extent.ymax),
+            width=tile_data.width,
+            height=tile_data.height,
+        )
+
+
+def _get_image_xy_corner(image: bytes) -> Optional[list[list[np.ndarray]]]:
+    """get сartesian coordinates from raster
+
+    Возвращает полигоны как списки колец (первое - внешнее),
+    каждое кольцо - массив (N, 2) пиксельных координат"""
+    # маска (16 МБ на тайл 4000x4000) освобождается сразу после поиска контуров
+    return _get_mask_xy_corner(_decode_mask(image))
+
+
+def _decode_mask(image: bytes) -> np.ndarray:
+    """Маска объекта из png: 128 - объект, 0 - фон"""
+    with stage("decode"):
+        # frombuffer не копирует png, а порог пишется в тот же массив:
+        # на тайл остается одна копия растра вместо трех
+        img = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        # темнее 245 - объект, то же, что (255 - img) > 10
+        cv2.threshold(img, 244, 128, cv2.THRESH_BINARY_INV, dst=img)
+    return img
+
+
+def _get_mask_xy_corner(thresh: np.ndarray) -> Optional[list[list[np.ndarray]]]:
+    with stage("contours"):
+        return _find_xy_corner(thresh)
+
+
+def _find_xy_corner(thresh: np.ndarray) -> Optional[list[list[np.ndarray]]]:
     try:
         contours, hierarchy = cv2.findContours(
             thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE
@@ -34,21 +90,17 @@ def _get_image_xy_corner(stream: BytesIO):
     if hierarchy is None:
         return None
     hierarchy = hierarchy[0]
-    hierarchy_contours = [[] for _ in range(len(hierarchy))]
+    hierarchy_contours: list[list[np.ndarray]] = [[] for _ in range(len(hierarchy))]
     for fry, current_contour in enumerate(contours):
-        current_hierarchy = hierarchy[fry]
-        cc = []
         # perimeter = cv2.arcLength(current_contour, True)
         # epsilon = 0.001 * cv2.arcLength(currentContour, True)
         # epsilon = epsilon * self.epsilon
         epsilon = 5
         approx = cv2.approxPolyDP(current_contour, epsilon, True)
         if len(approx) > 2:
-            for c in approx:
-                cc.append([c[0][0], c[0][1]])
-            parent_index = current_hierarchy[3]
+            parent_index = hierarchy[fry][3]
             index = fry if parent_index < 0 else parent_index
-            hierarchy_contours[index].append(cc)
+            hierarchy_contours[index].append(approx.reshape(-1, 2))
     image_xy_corners = [c for c in hierarchy_contours if len(c) > 0]
     if len(image_xy_corners) == 0:
         return None
@@ -56,40 +108,313 @@ def _get_image_xy_corner(stream: BytesIO):
 
 
 def get_image_geometry(tile_data: PkkTileResponse) -> Optional[MultiPolygon]:
-    image_xy_corner = _get_image_xy_corner(BytesIO(tile_data.image_data))
+    return get_payload_geometry(TilePayload.from_response(tile_data))
+
+
+def get_payload_geometry(tile_data: TilePayload) -> Optional[MultiPolygon]:
+    """Геометрия одного тайла в epsg:4326, `get_image_geometry` для TilePayload"""
+    geom = _get_image_geometry_3857(tile_data)
+    if geom is None:
+        return None
+    with stage("reproject"):
+        return make_valid(to_4326(geom))
+
+
+def _get_image_geometry_3857(tile_data: TilePayload) -> Optional[MultiPolygon]:
+    image_xy_corner = _get_image_xy_corner(tile_data.image)
     if image_xy_corner is None:
         return None
-    dx = (tile_data.extent.xmax - tile_data.extent.xmin) / tile_data.width
-    dy = (tile_data.extent.ymax - tile_data.extent.ymin) / tile_data.height
-    for ig, geom in enumerate(image_xy_corner):
-        for icnt, contours in enumerate(geom):
-            for ic, coord in enumerate(contours):
-                im_x, im_y = coord
-                x = tile_data.extent.xmin + (im_x * dx)
-                y = tile_data.extent.ymax - (im_y * dy)
-                image_xy_corner[ig][icnt][ic] = [x, y]
-    return to_geom(image_xy_corner)
+    xmin, ymin, xmax, ymax = tile_data.extent
+    dx = (xmax - xmin) / tile_data.width
+    dy = (ymax - ymin) / tile_data.height
+    return _xy_corner_to_geometry(image_xy_corner, xmin, ymax, dx, dy)
+
+
+def _xy_corner_to_geometry(
+    image_xy_corner: list[list[np.ndarray]],
+    xmin: float,
+    ymax: float,
+    dx: float,
+    dy: float,
+) -> MultiPolygon:
+    rings = [ring for polygon in image_xy_corner for ring in polygon]
+    ring_index = np.repeat(np.arange(len(rings)), [len(i) for i in rings])
+    polygon_index = np.repeat(
+        np.arange(len(image_xy_corner)), [len(i) for i in image_xy_corner]
+    )
+    with stage("polygons"):
+        # аффинное преобразование пиксели -> epsg:3857 разом для всех вершин
+        coords = np.concatenate(rings) * (dx, -dy) + (xmin, ymax)
+        return _build_multipolygon(coords, ring_index, polygon_index)
 
 
 def extract_geometry_from_tiles(tiles_data: list[PkkTileResponse]) -> MultiPolygon:
+    return extract_geometry(list(map(TilePayload.from_response, tiles_data)))
+
+
+def extract_geometry(
+    tiles: Sequence[TilePayload], output_crs: OutputCrs = 4326
+) -> MultiPolygon:
+    """Векторизация тайлов объекта в одну геометрию.
+
+    Тайлы объединяются в epsg:3857, и перепроецируется один раз
+    уже итоговая геометрия. Чистая функция от сырых данных -
+    может выполняться в пуле процессов"""
+    geoms = []
+    for i in tiles:
+        geom = _get_image_geometry_3857(i)
+        if geom is not None:
+            geoms.append(make_valid(geom))
+    return _merge_geometries(geoms, output_crs)
+
+
+def extract_mosaic_geometry(
+    tiles: Sequence[TilePayload], output_crs: OutputCrs = 4326
+) -> MultiPolygon:
+    """Векторизация тайлов через мозаику: тайлы склеиваются в один растр
+    (или несколько полос), и контуры ищутся один раз без объединения по тайлам"""
+    return _merge_geometries(_get_mosaic_geometries_3857(tiles), output_crs)
+
+
+def _merge_geometries(
+    geoms: Sequence[BaseGeometry], output_crs: OutputCrs
+) -> MultiPolygon:
+    """Объединение частей в epsg:3857 и перевод результата в `output_crs`"""
+    if len(geoms) == 0:
+        raise NoContoursError
+    with stage("union"):
+        merged = unary_union(geoms)
+    with stage("reproject"):
+        merged = make_valid(to_crs(merged, output_crs))
+    result = _as_multipolygon(merged)
+    if result.is_empty:
+        raise NoContoursError
+    return result
+
+
+def _as_multipolygon(geom: BaseGeometry) -> MultiPolygon:
+    """Полигональная часть геометрии как мультиполигон"""
+    if isinstance(geom, Polygon):
+        return MultiPolygon([geom])
+    if isinstance(geom, MultiPolygon):
+        return geom
+    polygons = []
+    for i in shapely.get_parts(geom):
+        if isinstance(i, Polygon):
+            polygons.append(i)
+        elif isinstance(i, MultiPolygon):
+            polygons.extend(i.geoms)
+    return MultiPolygon(polygons)
+
+
+def _get_mosaic_geometries_3857(tiles: Sequence[TilePayload]) -> list[MultiPolygon]:
+    # все тайлы объекта запрошены в одном масштабе
+    xmin, ymin, xmax, ymax = tiles[0].extent
+    dx = (xmax - xmin) / tiles[0].width
+    dy = (ymax - ymin) / tiles[0].height
     geoms = []
-    for i in tiles_data:
-        geom = get_image_geometry(i)
+    for strip in _split_mosaic(tiles, dx, dy):
+        geom = _get_mosaic_strip_geometry(strip, dx, dy)
         if geom is not None:
-            geoms.append(geom)
+            geoms.append(make_valid(geom))
+    return geoms
+
+
+def _split_mosaic(
+    tiles: Sequence[TilePayload], dx: float, dy: float
+) -> list[list[TilePayload]]:
+    """Разбиение тайлов на полосы не больше MOSAIC_MAX_PIXELS.
+
+    Полоса - несколько целых рядов тайлов, а слишком широкий ряд режется
+    на части по столбцам. Соседние полосы перекрываются буфером тайлов"""
+    rows: dict[float, list[TilePayload]] = {}
+    for i in tiles:
+        rows.setdefault(round(i.extent[3] / dy), []).append(i)
+    strips: list[list[TilePayload]] = []
+    strip: list[TilePayload] = []
+    for key in sorted(rows, reverse=True):
+        row = sorted(rows[key], key=lambda t: t.extent[0])
+        if _mosaic_pixels(row, dx, dy) > MOSAIC_MAX_PIXELS:
+            if strip:
+                strips.append(strip)
+                strip = []
+            chunk: list[TilePayload] = []
+            for i in row:
+                if chunk and _mosaic_pixels(chunk + [i], dx, dy) > MOSAIC_MAX_PIXELS:
+                    strips.append(chunk)
+                    chunk = []
+                chunk.append(i)
+            strips.append(chunk)
+        elif strip and _mosaic_pixels(strip + row, dx, dy) > MOSAIC_MAX_PIXELS:
+            strips.append(strip)
+            strip = row
+        else:
+            strip = strip + row
+    if strip:
+        strips.append(strip)
+    return strips
+
+
+def _mosaic_bounds(tiles: Sequence[TilePayload]) -> tuple[float, float, float, float]:
+    return (
+        min(i.extent[0] for i in tiles),
+        min(i.extent[1] for i in tiles),
+        max(i.extent[2] for i in tiles),
+        max(i.extent[3] for i in tiles),
+    )
+
+
+def _mosaic_pixels(tiles: Sequence[TilePayload], dx: float, dy: float) -> float:
+    xmin, ymin, xmax, ymax = _mosaic_bounds(tiles)
+    return (xmax - xmin) / dx * (ymax - ymin) / dy
+
+
+def _build_mosaic(tiles: Sequence[TilePayload], dx: float, dy: float) -> np.ndarray:
+    xmin, ymin, xmax, ymax = _mosaic_bounds(tiles)
+    width = round((xmax - xmin) / dx)
+    height = round((ymax - ymin) / dy)
+    mosaic = np.zeros((height, width), dtype=np.uint8)
+    for i in tiles:
+        col = round((i.extent[0] - xmin) / dx)
+        row = round((ymax - i.extent[3]) / dy)
+        mask = _decode_mask(i.image)
+        h = min(mask.shape[0], height - row)
+        w = min(mask.shape[1], width - col)
+        # в перекрытии (буфер тайлов) соседние тайлы совпадают, достаточно копии
+        mosaic[row : row + h, col : col + w] = mask[:h, :w]
+        del mask
+    return mosaic
+
+
+def _get_mosaic_strip_geometry(
+    tiles: Sequence[TilePayload], dx: float, dy: float
+) -> Optional[MultiPolygon]:
+    xmin, ymin, xmax, ymax = _mosaic_bounds(tiles)
+    mosaic = _build_mosaic(tiles, dx, dy)
+    image_xy_corner = _get_mask_xy_corner(mosaic)
+    del mosaic
+    if image_xy_corner is None:
+        return None
+    return _xy_corner_to_geometry(image_xy_corner, xmin, ymax, dx, dy)
+
+
+def extract_segments(tiles: Sequence[TilePayload]) -> list[Polygon]:
+    """Контуры отдельных объектов на общих тайлах квартала (epsg:3857).
+
+    Тайлы склеиваются в одну мозаику, и каждый внешний контур со своими
+    дырами становится отдельным полигоном без объединения: соседние объекты,
+    разделенные на тайле обводкой, не сливаются. Обводка съедает половину
+    своей толщины с каждой стороны границы, поэтому полигоны расширяются
+    на столько же обратно"""
+    xmin, ymin, xmax, ymax = tiles[0].extent
+    dx = (xmax - xmin) / tiles[0].width
+    dy = (ymax - ymin) / tiles[0].height
+    mxmin, _, _, mymax = _mosaic_bounds(tiles)
+    mosaic = _build_mosaic(tiles, dx, dy)
+    image_xy_corner = _get_mask_xy_corner(mosaic)
+    del mosaic
+    if image_xy_corner is None:
+        return []
+    segments = []
+    for polygon in image_xy_corner:
+        geom = make_valid(_xy_corner_to_geometry([polygon], mxmin, mymax, dx, dy))
+        geom = geom.buffer(OUTLINE_PX / 2 * dx, join_style="mitre")
+        segments.extend(
+            i for i in shapely.get_parts(geom) if isinstance(i, Polygon) and i.area > 0
+        )
+    return segments
+
+
+def fits_extent(segment: BaseGeometry, extent: PkkExtent, tolerance: float) -> bool:
+    """Полигон и есть весь объект: их экстенты совпадают"""
+    bounds = (extent.xmin, extent.ymin, extent.xmax, extent.ymax)
+    return all(abs(a - b) <= tolerance for a, b in zip(segment.bounds, bounds))
+
+
+def segment_geometry(
+    segment: BaseGeometry, output_crs: OutputCrs = 4326
+) -> MultiPolygon:
+    """Полигон мозаики (epsg:3857) как геометрия объекта в `output_crs`"""
+    return _as_multipolygon(make_valid(to_crs(segment, output_crs)))
+
+
+def extract_coarse_geometry(tiles: Sequence[TilePayload]) -> BaseGeometry:
+    """Грубый контур объекта в epsg:3857 для адаптивного разбиения"""
+    geoms = []
+    for i in tiles:
+        geom = _get_image_geometry_3857(i)
+        if geom is not None:
+            geoms.append(make_valid(geom))
     if len(geoms) == 0:
         raise NoContoursError
-    merged = unary_union(geoms)
-    assert isinstance(merged, (Polygon, MultiPolygon))
-    if isinstance(merged, Polygon):
-        return MultiPolygon([merged])
-    return merged
+    with stage("union"):
+        return unary_union(geoms)
+
+
+def plan_refined_tiles(
+    tiles: Sequence[TilePayload],
+    extent: PkkExtent,
+    resolution: float = DEFAULT_RESOLUTION,
+    max_tiles: int = MAX_SUBTILES_PER_CN,
+) -> tuple[BaseGeometry, list[PkkExtent], float]:
+    """Первый проход адаптивного разбиения: грубый контур,
+    ячейки для уточнения и масштаб, в котором их запрашивать"""
+    # грубый контур может выйти за экстент объекта на пару пикселей
+    coarse = extract_coarse_geometry(tiles).intersection(
+        shapely.box(extent.xmin, extent.ymin, extent.xmax, extent.ymax)
+    )
+    cells, scale = generate_refined_tile_extents(extent, coarse, resolution, max_tiles)
+    return coarse, cells, scale
+
+
+def extract_refined_geometry(
+    coarse: BaseGeometry,
+    tiles: Sequence[TilePayload],
+    cells: Sequence[PkkExtent],
+    mosaic: bool = False,
+    output_crs: OutputCrs = 4326,
+) -> MultiPolygon:
+    """Второй проход адаптивного разбиения.
+
+    Внутри ячеек `cells` берется геометрия соответствующих тайлов `tiles`
+    полного масштаба, вне их - грубый контур `coarse` (epsg:3857)"""
+    boxes = [shapely.box(i.xmin, i.ymin, i.xmax, i.ymax) for i in cells]
+    cells_union = unary_union(boxes)
+    parts = [coarse.difference(cells_union)]
+    if mosaic:
+        for geom in _get_mosaic_geometries_3857(tiles):
+            parts.append(geom.intersection(cells_union))
+    else:
+        for tile, cell in zip(tiles, boxes):
+            geom = _get_image_geometry_3857(tile)
+            if geom is not None:
+                parts.append(make_valid(geom).intersection(cell))
+    return _merge_geometries(parts, output_crs)
+
+
+def _build_multipolygon(
+    coords: np.ndarray, ring_index: np.ndarray, polygon_index: np.ndarray
+) -> MultiPolygon:
+    """Сборка мультиполигона из плоского массива вершин.
+
+    `ring_index` - номер кольца для каждой вершины, `polygon_index` - номер
+    полигона для каждого кольца; первое кольцо полигона - внешнее"""
+    rings = shapely.linearrings(coords, indices=ring_index)
+    polygons = shapely.polygons(rings, indices=polygon_index)
+    return shapely.multipolygons(polygons)
 
 
 def to_geom(xy) -> MultiPolygon:
-    polys = []
-    for g in xy:
-        shell = LineString(g[0])
-        holes = [LineString(i) for i in g[1:]] or None
-        polys.append(Polygon(shell, holes))
-    return make_valid(to_4326(MultiPolygon(polys)))
+    """Мультиполигон epsg:4326 из вложенных списков: полигоны - кольца
+    (первое - внешнее) - вершины [x, y] в epsg:3857"""
+    rings = [np.asarray(ring, dtype=float) for polygon in xy for ring in polygon]
+    ring_index = np.repeat(np.arange(len(rings)), [len(i) for i in rings])
+    polygon_index = np.repeat(np.arange(len(xy)), [len(i) for i in xy])
+    return to_geom_arrays(np.concatenate(rings), ring_index, polygon_index)
+
+
+def to_geom_arrays(
+    coords: np.ndarray, ring_index: np.ndarray, polygon_index: np.ndarray
+) -> MultiPolygon:
+    """`to_geom` для плоского массива вершин, см. `_build_multipolygon`"""
+    return make_valid(to_4326(_build_multipolygon(coords, ring_index, polygon_index)))
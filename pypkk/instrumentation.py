@@ -0,0 +1,189 @@
+import random
+import statistics
+import sys
+import threading
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Callable, Iterator, NamedTuple, Optional, TextIO, TypeVar, Union
+
+R = TypeVar("R")
+
+
+@dataclass
+class Event:
+    """Событие конвейера.
+
+    `name` - стадия: http, retry, rate_limit, tiles, geojson или стадия
+    векторизации (decode, contours, polygons, reproject, union);
+    `duration` - длительность, с; `data` - подробности стадии
+    (host, status, from_cache, bytes, tiles, ...)"""
+
+    name: str
+    duration: float = 0.0
+    cn: Optional[str] = None
+    data: dict = field(default_factory=dict)
+
+
+class Observer(ABC):
+    """Получатель событий конвейера, передается в PKK/AsyncPKK(observer=...).
+
+    Вызывается синхронно в потоке, где произошло событие,
+    поэтому не должен блокировать"""
+
+    @abstractmethod
+    def __call__(self, event: Event): ...
+
+
+ObserverArg = Optional[Union[Observer, Callable[[Event], None]]]
+
+
+def emit(
+    observer: ObserverArg,
+    name: str,
+    duration: float = 0.0,
+    cn: Optional[str] = None,
+    **data,
+):
+    if observer is not None:
+        observer(Event(name, duration, cn, data))
+
+
+_stage_timings: ContextVar[Optional[dict[str, float]]] = ContextVar(
+    "_stage_timings", default=None
+)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Замер стадии векторизации; вне `run_timed` ничего не делает"""
+    timings = _stage_timings.get()
+    if timings is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + perf_counter() - start
+
+
+def run_timed(func: Callable[..., R], *args) -> tuple[R, dict[str, float]]:
+    """Вызывает `func` и возвращает результат вместе с временем его стадий.
+
+    Выполняется там же, где и `func` - в том числе в пуле процессов,
+    откуда замеры возвращаются родителю вместе с результатом"""
+    timings: dict[str, float] = {}
+    token = _stage_timings.set(timings)
+    try:
+        return func(*args), timings
+    finally:
+        _stage_timings.reset(token)
+
+
+class StageSummary(NamedTuple):
+    count: int
+    total: float
+    p50: float
+    p95: float
+    # количество событий с истинными флагами (from_cache, waited, ...)
+    # и суммы объемов (bytes, tiles)
+    counters: dict[str, float]
+
+
+# какие числовые поля событий суммируются в сводке
+SUMMED_FIELDS = ("bytes", "tiles")
+# сколько длительностей на стадию хранится для оценки перцентилей
+RESERVOIR_SIZE = 10_000
+
+
+def _percentile(values: list[float], q: int) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+class _Reservoir:
+    """Длительности одной стадии: точные количество и сумма и равномерная
+    выборка не больше `size` значений (алгоритм R) для перцентилей -
+    память не растет с числом событий"""
+
+    def __init__(self, size: int, rng: random.Random):
+        self.size = size
+        self.count = 0
+        self.total = 0.0
+        self.sample: list[float] = []
+        self._rng = rng
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        if len(self.sample) < self.size:
+            self.sample.append(value)
+            return
+        index = self._rng.randrange(self.count)
+        if index < self.size:
+            self.sample[index] = value
+
+
+class StatsAggregator(Observer):
+    """Собирает длительности по стадиям и печатает сводку p50/p95:
+
+    stats = StatsAggregator()
+    async with AsyncPKK(observer=stats) as api: ...
+    stats.print_summary()
+    """
+
+    def __init__(
+        self, reservoir_size: int = RESERVOIR_SIZE, seed: Optional[int] = None
+    ):
+        self._lock = threading.Lock()
+        rng = random.Random(seed)
+        # до reservoir_size событий стадии перцентили точные, дальше - оценка
+        self._durations: dict[str, _Reservoir] = defaultdict(
+            lambda: _Reservoir(reservoir_size, rng)
+        )
+        self._counters: dict[str, dict[str, float]] = defaultdict(
+            lambda: defaultdict(float)
+        )
+
+    def __call__(self, event: Event):
+        with self._lock:
+            self._durations[event.name].add(event.duration)
+            counters = self._counters[event.name]
+            for key, value in event.data.items():
+                if isinstance(value, bool):
+                    counters[key] += value
+                elif key in SUMMED_FIELDS:
+                    counters[key] += value
+
+    def summary(self) -> dict[str, StageSummary]:
+        with self._lock:
+            return {
+                name: StageSummary(
+                    count=durations.count,
+                    total=durations.total,
+                    p50=_percentile(durations.sample, 50),
+                    p95=_percentile(durations.sample, 95),
+                    counters=dict(self._counters[name]),
+                )
+                for name, durations in self._durations.items()
+            }
+
+    def format_summary(self) -> str:
+        lines = [
+            f"{'stage':<12} {'count':>7} {'total, s':>10} {'p50, s':>9} {'p95, s':>9}"
+        ]
+        for name, s in sorted(self.summary().items(), key=lambda i: -i[1].total):
+            counters = " ".join(f"{k}={v:.12g}" for k, v in s.counters.items())
+            lines.append(
+                f"{name:<12} {s.count:>7} {s.total:>10.3f} {s.p50:>9.4f} {s.p95:>9.4f}"
+                f" {counters}".rstrip()
+            )
+        return "\n".join(lines)
+
+    def print_summary(self, file: TextIO = sys.stderr):
+        print(self.format_summary(), file=file)
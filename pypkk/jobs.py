@@ -0,0 +1,271 @@
+import sqlite3
+from dataclasses import dataclass
+from pathlib import Path
+from time import monotonic, time
+from typing import AsyncIterable, AsyncIterator, Iterable, Literal, Optional, Union
+
+from pypkk.api import BULK_CONCURRENCY, AsyncPKK
+from pypkk.async_utils import aiterate
+from pypkk.schemas.features import PkkGeojson
+from pypkk.schemas.inputs import Cn, clean_cn
+
+JobState = Literal["pending", "done", "failed"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    kind INTEGER NOT NULL,
+    code TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL,
+    PRIMARY KEY (kind, code)
+)
+"""
+
+_STATE_RANK = "CASE {} WHEN 'done' THEN 2 WHEN 'failed' THEN 1 ELSE 0 END"
+
+
+@dataclass
+class JobProgress:
+    total: int
+    done: int
+    failed: int
+    # сколько обработано за текущий запуск и за какое время, с
+    processed: int
+    elapsed: float
+
+    @property
+    def pending(self) -> int:
+        return self.total - self.done - self.failed
+
+    @property
+    def rate(self) -> float:
+        """Обработано номеров в секунду за текущий запуск"""
+        return self.processed / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Оценка оставшегося времени, с"""
+        if self.rate == 0:
+            return None
+        return self.pending / self.rate
+
+
+class BulkJob:
+    """Пакетная обработка кадастровых номеров с журналом на диске.
+
+    Состояние каждого номера (pending/done/failed и текст ошибки) пишется
+    в sqlite-журнал пачками по `batch_size`. После падения процесса повторный
+    `run` продолжает с необработанных номеров; упавшие номера повторяются,
+    а успешные - нет"""
+
+    def __init__(
+        self,
+        api: AsyncPKK,
+        journal: Union[str, Path],
+        concurrency: int = BULK_CONCURRENCY,
+        batch_size: int = 100,
+    ):
+        self.api = api
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self._connection = sqlite3.connect(journal)
+        # журнал ведется по номерам без ведущих нулей, как кэш геометрий:
+        # разные записи одного номера не должны обрабатываться дважды
+        self._connection.create_function("clean_cn", 1, clean_cn, deterministic=True)
+        with self._connection:
+            self._connection.execute(_SCHEMA)
+            self._clean_codes()
+        self._updates: list[tuple] = []
+        self._uncommitted = 0
+        self._counts = {"done": 0, "failed": 0}
+        self._total = 0
+        self._processed = 0
+        self._started: Optional[float] = None
+        self._load_counts()
+
+    def _clean_codes(self):
+        # журналы, записанные раньше, ведутся по номерам как во входе;
+        # из нескольких записей одного номера остается самое продвинутое
+        # состояние: done, затем failed, затем pending
+        self._connection.execute(
+            f"""
+            INSERT INTO journal (kind, code, state, error, attempts, updated_at)
+            SELECT kind, clean_cn(code), state, error, attempts, updated_at
+            FROM journal WHERE code != clean_cn(code) ORDER BY rowid
+            ON CONFLICT (kind, code) DO UPDATE SET
+                state = excluded.state,
+                error = excluded.error,
+                attempts = max(attempts, excluded.attempts),
+                updated_at = excluded.updated_at
+            WHERE {_STATE_RANK.format("excluded.state")}
+                > {_STATE_RANK.format("journal.state")}
+            """
+        )
+        self._connection.execute("DELETE FROM journal WHERE code != clean_cn(code)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excinfo):
+        self.close()
+
+    def close(self):
+        self._flush()
+        self._connection.close()
+
+    def _load_counts(self):
+        self._counts = {"done": 0, "failed": 0}
+        self._total = 0
+        for state, count in self._connection.execute(
+            "SELECT state, COUNT(*) FROM journal GROUP BY state"
+        ):
+            self._total += count
+            if state in self._counts:
+                self._counts[state] = count
+
+    @property
+    def progress(self) -> JobProgress:
+        elapsed = monotonic() - self._started if self._started is not None else 0.0
+        return JobProgress(
+            total=self._total,
+            done=self._counts["done"],
+            failed=self._counts["failed"],
+            processed=self._processed,
+            elapsed=elapsed,
+        )
+
+    def add(self, cns: Iterable[Cn]) -> int:
+        """Добавляет номера в журнал; уже известные номера не сбрасываются"""
+        added = 0
+        batch = []
+        for cn in cns:
+            batch.append((cn.kind, cn.clean_code))
+            if len(batch) >= self.batch_size:
+                added += self._insert(batch)
+                batch = []
+        if batch:
+            added += self._insert(batch)
+        self._total += added
+        return added
+
+    def _insert(self, batch: list[tuple]) -> int:
+        with self._connection:
+            cursor = self._connection.executemany(
+                "INSERT OR IGNORE INTO journal (kind, code) VALUES (?, ?)", batch
+            )
+        return cursor.rowcount
+
+    def _add_one(self, cn: Cn) -> bool:
+        """Добавляет номер без отдельной транзакции; False - номер уже в журнале.
+
+        Вставки фиксируются пачками, а до фиксации видны этому же соединению"""
+        cursor = self._connection.execute(
+            "INSERT OR IGNORE INTO journal (kind, code) VALUES (?, ?)",
+            (cn.kind, cn.clean_code),
+        )
+        if cursor.rowcount == 0:
+            return False
+        self._total += 1
+        self._uncommitted += 1
+        if self._uncommitted >= self.batch_size:
+            self._connection.commit()
+            self._uncommitted = 0
+        return True
+
+    def failures(self) -> Iterable[tuple[Cn, str]]:
+        for kind, code, error in self._connection.execute(
+            "SELECT kind, code, error FROM journal WHERE state = 'failed'"
+        ):
+            yield Cn(code=code, kind=kind), error
+
+    def _iter_todo(self, retry_failed: bool) -> Iterable[Cn]:
+        # постранично по rowid: журнал на миллионы строк не читается в память,
+        # а обновления состояний не сдвигают страницы
+        states = ("pending", "failed") if retry_failed else ("pending",)
+        placeholders = ", ".join("?" * len(states))
+        last_rowid = 0
+        while True:
+            rows = self._connection.execute(
+                f"SELECT rowid, kind, code FROM journal WHERE state IN ({placeholders}) "
+                "AND rowid > ? ORDER BY rowid LIMIT ?",
+                (*states, last_rowid, self.batch_size),
+            ).fetchall()
+            if len(rows) == 0:
+                return
+            for rowid, kind, code in rows:
+                last_rowid = rowid
+                yield Cn(code=code, kind=kind)
+
+    def _record(self, cn: Cn, state: JobState, error: Optional[str]):
+        self._updates.append((state, error, time(), cn.kind, cn.clean_code))
+        if len(self._updates) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        with self._connection:
+            if self._updates:
+                self._connection.executemany(
+                    "UPDATE journal SET state = ?, error = ?, attempts = attempts + 1, "
+                    "updated_at = ? WHERE kind = ? AND code = ?",
+                    self._updates,
+                )
+        self._updates = []
+        self._uncommitted = 0
+
+    async def _iter_run(
+        self,
+        cns: Optional[Union[Iterable[Cn], AsyncIterable[Cn]]],
+        retry_failed: bool,
+    ) -> AsyncIterator[Cn]:
+        """Номера запуска: сначала необработанные из журнала, затем новые
+        из `cns` по мере чтения входа - вход не читается в память заранее,
+        и обработка начинается до его конца"""
+        for cn in self._iter_todo(retry_failed):
+            yield cn
+        if cns is None:
+            return
+        async for cn in aiterate(cns):
+            # уже известные номера либо обработаны, либо выданы выше
+            if self._add_one(cn):
+                yield cn
+
+    async def run(
+        self,
+        cns: Optional[Union[Iterable[Cn], AsyncIterable[Cn]]] = None,
+        retry_failed: bool = True,
+    ) -> AsyncIterator[tuple[Cn, Union[Optional[PkkGeojson], Exception]]]:
+        """Обрабатывает все необработанные номера журнала (и новые из `cns`),
+        выдавая пары (cn, geojson или ошибка) по мере готовности.
+
+        Новые номера добавляются в журнал по мере чтения `cns`"""
+        self._load_counts()
+        self._started = monotonic()
+        self._processed = 0
+        try:
+            async for cn, result in self.api.find_geojson_many(
+                self._iter_run(cns, retry_failed), concurrency=self.concurrency
+            ):
+                previous = self._state(cn)
+                if isinstance(result, Exception):
+                    state, error = "failed", f"{type(result).__name__}: {result}"
+                else:
+                    state, error = "done", None
+                if previous in self._counts:
+                    self._counts[previous] -= 1
+                self._counts[state] += 1
+                self._processed += 1
+                self._record(cn, state, error)
+                yield cn, result
+        finally:
+            self._flush()
+
+    def _state(self, cn: Cn) -> JobState:
+        # состояние до текущего запуска: обновления еще могут лежать в буфере,
+        # но номер обрабатывается за запуск один раз
+        row = self._connection.execute(
+            "SELECT state FROM journal WHERE kind = ? AND code = ?",
+            (cn.kind, cn.clean_code),
+        ).fetchone()
+        return row[0] if row is not None else "pending"
@@ -0,0 +1,48 @@
+"""Сбор всех объектов кадастрового квартала с общих тайлов.
+
+Вместо тайлов на каждый объект квартал запрашивается несколькими общими
+тайлами со всеми объектами слоя (фильтр `ID LIKE '<квартал>:%'`), на которых
+объекты залиты с обводкой. Мозаика тайлов делится на отдельные полигоны
+(`extract_segments`), и каждый полигон сопоставляется объекту поиском по точке
+внутри него: объект с центром в полигоне и совпадающим экстентом получает
+геометрию полигона. Если контуры соседей слились (сервер не нарисовал
+обводку) или объект состоит из нескольких контуров, его геометрия строится
+обычным `get_geojson`, а остаток полигона разбирается дальше"""
+
+from typing import Optional
+
+from shapely.geometry import Point
+from shapely.geometry.base import BaseGeometry
+
+from pypkk.requests import TileLayer
+from pypkk.schemas.features import PkkSearchFeature, PkkType
+from pypkk.schemas.inputs import KvartalCn
+
+# полигоны и остатки меньше стольких пикселей считаются шумом
+MIN_SEGMENT_PX = 16
+
+
+def kvartal_layer(kvartal: KvartalCn, kind: PkkType, outline: bool = True) -> TileLayer:
+    """Все объекты типа `kind` в квартале на одном тайле"""
+    return TileLayer(kind, f"ID LIKE '{kvartal.clean_code}:%'", kvartal.code, outline)
+
+
+def pick_feature(
+    results: list[PkkSearchFeature],
+    segment: BaseGeometry,
+    kvartal: KvartalCn,
+    tolerance: float,
+) -> Optional[PkkSearchFeature]:
+    """Объект квартала из результатов поиска по точке внутри полигона.
+
+    Предпочтение - объекту, центр которого лежит в полигоне"""
+    prefix = f"{kvartal.clean_code}:"
+    candidates = [
+        i for i in results if i.attrs.id.startswith(prefix) and i.extent is not None
+    ]
+    for i in candidates:
+        if i.center is None:
+            continue
+        if segment.distance(Point(i.center.x, i.center.y)) <= tolerance:
+            return i
+    return candidates[0] if candidates else None
@@ -0,0 +1,186 @@
+import asyncio
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, replace
+from time import monotonic, sleep
+from typing import NamedTuple, Optional, Union
+
+import httpx
+
+from pypkk.instrumentation import ObserverArg, emit
+
+
+class RateLimit(NamedTuple):
+    """Бюджет запросов: `rate` запросов в секунду, не более `burst` подряд"""
+
+    rate: float
+    burst: int = 1
+
+
+@dataclass
+class RateLimiterStats:
+    # сколько запросов прошло через лимитер
+    requests: int = 0
+    # сколько из них ждали токен
+    waits: int = 0
+    # суммарное время ожидания токенов, с
+    waited: float = 0.0
+    # сколько запросов ждут токен прямо сейчас
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+
+
+class RateLimiter(ABC):
+    """Базовый класс ограничителя частоты запросов.
+
+    Наследнику достаточно реализовать `reserve`: метод занимает место
+    в очереди и возвращает, сколько секунд нужно подождать до запроса"""
+
+    def __init__(self):
+        self._stats = RateLimiterStats()
+        self._stats_lock = threading.Lock()
+
+    @abstractmethod
+    def reserve(self) -> float: ...
+
+    @property
+    def stats(self) -> RateLimiterStats:
+        with self._stats_lock:
+            return replace(self._stats)
+
+    def _enter(self, delay: float):
+        with self._stats_lock:
+            self._stats.requests += 1
+            if delay > 0:
+                self._stats.waits += 1
+                self._stats.waited += delay
+                self._stats.queue_depth += 1
+                self._stats.max_queue_depth = max(
+                    self._stats.max_queue_depth, self._stats.queue_depth
+                )
+
+    def _exit(self, delay: float):
+        if delay > 0:
+            with self._stats_lock:
+                self._stats.queue_depth -= 1
+
+    def acquire(self) -> float:
+        """Ждет своей очереди; возвращает время ожидания, с"""
+        delay = self.reserve()
+        self._enter(delay)
+        try:
+            if delay > 0:
+                sleep(delay)
+        finally:
+            self._exit(delay)
+        return delay
+
+    async def acquire_async(self) -> float:
+        delay = self.reserve()
+        self._enter(delay)
+        try:
+            if delay > 0:
+                await asyncio.sleep(delay)
+        finally:
+            self._exit(delay)
+        return delay
+
+
+class TokenBucket(RateLimiter):
+    """Token bucket: токены копятся со скоростью `rate` в секунду до `burst` штук.
+
+    Токены резервируются в долг, поэтому ожидающие запросы обслуживаются
+    строго в порядке очереди и без лишних пробуждений"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        super().__init__()
+        if rate <= 0:
+            raise ValueError("rate должен быть больше нуля")
+        if burst < 1:
+            raise ValueError("burst должен быть не меньше 1")
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+
+RateLimitArg = Optional[Union[RateLimit, RateLimiter]]
+
+
+def as_rate_limiter(value: RateLimitArg) -> Optional[RateLimiter]:
+    if value is None or isinstance(value, RateLimiter):
+        return value
+    return TokenBucket(*value)
+
+
+def _find_limiter(
+    limiters: dict[str, RateLimiter], request: httpx.Request
+) -> tuple[Optional[str], Optional[RateLimiter]]:
+    url = str(request.url)
+    for host, limiter in limiters.items():
+        if url.startswith(host):
+            return host, limiter
+    return None, None
+
+
+class RateLimitedTransport(httpx.BaseTransport):
+    """Транспорт, ограничивающий частоту запросов по хостам.
+
+    Ставится под кэширующий транспорт, поэтому ответы из кэша лимит не тратят"""
+
+    def __init__(
+        self,
+        transport: httpx.BaseTransport,
+        limiters: dict[str, RateLimiter],
+        observer: ObserverArg = None,
+    ):
+        self._transport = transport
+        self.limiters = limiters
+        self.observer = observer
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        host, limiter = _find_limiter(self.limiters, request)
+        if limiter is not None:
+            delay = limiter.acquire()
+            emit(self.observer, "rate_limit", delay, host=host, waited=delay > 0)
+        return self._transport.handle_request(request)
+
+    def close(self):
+        self._transport.close()
+
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    """Асинхронный вариант `RateLimitedTransport`"""
+
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        limiters: dict[str, RateLimiter],
+        observer: ObserverArg = None,
+    ):
+        self._transport = transport
+        self.limiters = limiters
+        self.observer = observer
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host, limiter = _find_limiter(self.limiters, request)
+        if limiter is not None:
+            delay = await limiter.acquire_async()
+            emit(self.observer, "rate_limit", delay, host=host, waited=delay > 0)
+        return await self._transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self._transport.aclose()
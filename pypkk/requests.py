@@ -1,14 +1,23 @@
 import asyncio
+import json
 import ssl
-from time import sleep
-from typing import Optional
+from time import perf_counter, sleep
+from typing import Literal, NamedTuple, Optional, Union
 
 import httpx
 
+from pypkk.instrumentation import ObserverArg, emit
+from pypkk.rate_limit import RateLimit
+from pypkk.retry import CircuitOpenError, RetryCall, RetryPolicy
 from pypkk.schemas.coords import PkkExtent
 from pypkk.schemas.features import PkkSearchFeature, PkkType
 from pypkk.schemas.responses import PkkTileResponse
-from pypkk.tile_utils import DEFAULT_SCALE, PKK_MAX_TILE_SIZE
+from pypkk.tile_utils import (
+    DEFAULT_SCALE,
+    OUTLINE_PX,
+    PKK_MAX_TILE_SIZE,
+    buffer_extent,
+)
 
 API_HOST = "https://pkk.rosreestr.ru/api"
 SELECTED_TILE_HOST = "https://pkk.rosreestr.ru/arcgis/rest/services/PKK6/CadastreSelected/MapServer/export"
@@ -24,6 +33,10 @@ CLIENT_ARGS = {
     "timeout": 30,
 }
 
+# ПКК отвечает 502 при частых запросах к API, поэтому по умолчанию не чаще 1 в секунду
+DEFAULT_API_RATE_LIMIT = RateLimit(rate=1, burst=1)
+DEFAULT_TILE_RATE_LIMIT = RateLimit(rate=5, burst=10)
+
 SSL_CONTEXT = ssl._create_unverified_context()
 SSL_CONTEXT.set_ciphers("ALL:@SECLEVEL=1")
 
@@ -34,15 +47,98 @@ TILE_LAYERS: dict[PkkType, list[int]] = {
 }
 
 
+# "image" - сырой png (f=image), экстент и размер известны из запроса;
+# "json" - png в base64 внутри json (f=json), на треть больше байтов
+TileFormat = Literal["image", "json"]
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+# сбои соединения, после которых запрос повторяется
+_TRANSIENT_ERRORS = (httpx.TimeoutException, httpx.NetworkError)
+
+
 class TileServerNotResponsedError(Exception):
     pass
 
 
-def time_to_sleep(r: httpx.Response):
-    mcs = 1_000_000 - r.elapsed.microseconds
-    if mcs <= 0:
-        return 0
-    return round(mcs / 10**6, 1)
+class TileCircuitOpenError(CircuitOpenError, TileServerNotResponsedError):
+    """Автомат сервера тайлов разомкнут: запрос тайла не отправлялся"""
+
+
+# политика для запросов без своей: одна на модуль, иначе бюджет повторов
+# и автомат начинались бы заново на каждом запросе и ничего бы не ограничивали
+_DEFAULT_RETRY = RetryPolicy()
+
+
+class TileLayer(NamedTuple):
+    """Что рисует сервер тайлов: слои объектов типа `type` с фильтром `where`.
+
+    `outline` - объекты заливаются черным с белой обводкой (dynamicLayers),
+    чтобы соседние объекты на общем тайле разделялись границей"""
+
+    type: PkkType
+    where: str
+    cn: Optional[str] = None
+    outline: bool = False
+
+    @classmethod
+    def of(cls, feature: Union[PkkSearchFeature, "TileLayer"]) -> "TileLayer":
+        if isinstance(feature, TileLayer):
+            return feature
+        return cls(feature.type, f"ID = '{feature.attrs.id}'", feature.attrs.cn)
+
+
+def _dynamic_layers(layer: TileLayer) -> str:
+    symbol = {
+        "type": "esriSFS",
+        "style": "esriSFSSolid",
+        "color": [0, 0, 0, 255],
+        "outline": {
+            "type": "esriSLS",
+            "style": "esriSLSSolid",
+            "color": [255, 255, 255, 255],
+            # толщина в пунктах, при dpi=96 это OUTLINE_PX пикселей
+            "width": OUTLINE_PX * 72 / 96,
+        },
+    }
+    return json.dumps(
+        [
+            {
+                "id": i,
+                "source": {"type": "mapLayer", "mapLayerId": i},
+                "definitionExpression": layer.where,
+                "drawingInfo": {"renderer": {"type": "simple", "symbol": symbol}},
+            }
+            for i in TILE_LAYERS[layer.type]
+        ]
+    )
+
+
+def _emit_response(
+    observer: ObserverArg,
+    host: str,
+    r: httpx.Response,
+    start: float,
+    cn: Optional[str] = None,
+):
+    # время запроса с точки зрения клиента: вместе с ожиданием лимитера
+    if observer is None:
+        return
+    emit(
+        observer,
+        "http",
+        perf_counter() - start,
+        cn,
+        host=host,
+        status=r.status_code,
+        from_cache=bool(r.extensions.get("from_cache", False)),
+        bytes=len(r.content),
+    )
+
+
+def _api_failure(r: httpx.Response) -> Optional[str]:
+    # ПКК отвечает 502 при перегрузке, остальные 5xx - тоже сбой сервера
+    return str(r.status_code) if r.status_code >= 500 else None
 
 
 def api_request(
@@ -51,12 +147,32 @@ def api_request(
     api_method: str,
     params: Optional[dict] = None,
     json: Optional[dict] = None,
+    observer: ObserverArg = None,
+    retry: Optional[RetryPolicy] = None,
 ):
-    r = client.request(req_method, API_HOST + api_method, params=params, json=json)
-    if not r.extensions["from_cache"]:
-        sleep(time_to_sleep(r))
-    if r.status_code == 502:
-        return api_request(client, req_method, api_method, params, json)
+    call = (retry or _DEFAULT_RETRY).call("api", observer)
+    while True:
+        call.start_attempt()
+        try:
+            start = perf_counter()
+            r = client.request(
+                req_method, API_HOST + api_method, params=params, json=json
+            )
+            _emit_response(observer, "api", r, start)
+        except _TRANSIENT_ERRORS as e:
+            delay = call.failed(type(e).__name__)
+            if delay is None:
+                raise
+            sleep(delay)
+            continue
+        reason = _api_failure(r)
+        if reason is None:
+            call.succeeded()
+            break
+        delay = call.failed(reason)
+        if delay is None:
+            break
+        sleep(delay)
     r.raise_for_status()
     return r.json()
 
@@ -67,32 +183,53 @@ async def async_api_request(
     api_method: str,
     params: Optional[dict] = None,
     json: Optional[dict] = None,
-    lock: Optional[asyncio.Lock] = None,
+    observer: ObserverArg = None,
+    retry: Optional[RetryPolicy] = None,
 ):
-    if lock is not None:
-        await lock.acquire()
-    r = await client.request(
-        req_method, API_HOST + api_method, params=params, json=json
-    )
-    if lock is not None:
-        if not r.extensions["from_cache"]:
-            await asyncio.sleep(time_to_sleep(r))
-        lock.release()
-    if r.status_code == 502:
-        return await async_api_request(
-            client, req_method, api_method, params, json, lock
-        )
+    call = (retry or _DEFAULT_RETRY).call("api", observer)
+    while True:
+        call.start_attempt()
+        try:
+            start = perf_counter()
+            r = await client.request(
+                req_method, API_HOST + api_method, params=params, json=json
+            )
+            _emit_response(observer, "api", r, start)
+        except _TRANSIENT_ERRORS as e:
+            delay = call.failed(type(e).__name__)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+        reason = _api_failure(r)
+        if reason is None:
+            call.succeeded()
+            break
+        delay = call.failed(reason)
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
     r.raise_for_status()
     return r.json()
 
 
-def _generate_tile_params(feature: PkkSearchFeature, tile_extent: PkkExtent):
-    width = (tile_extent.xmax - tile_extent.xmin) * DEFAULT_SCALE
-    height = (tile_extent.ymax - tile_extent.ymin) * DEFAULT_SCALE
-    width = width if width < PKK_MAX_TILE_SIZE else PKK_MAX_TILE_SIZE
-    height = height if height < PKK_MAX_TILE_SIZE else PKK_MAX_TILE_SIZE
-    layers = TILE_LAYERS[feature.type]
-    layer_defs = {k: f"ID = '{feature.attrs.id}'" for k in layers}
+def _generate_tile_params(
+    feature: Union[PkkSearchFeature, TileLayer],
+    tile_extent: PkkExtent,
+    scale: float = DEFAULT_SCALE,
+    tile_format: TileFormat = "json",
+):
+    layer = TileLayer.of(feature)
+    width = round((tile_extent.xmax - tile_extent.xmin) * scale)
+    height = round((tile_extent.ymax - tile_extent.ymin) * scale)
+    if width > PKK_MAX_TILE_SIZE or height > PKK_MAX_TILE_SIZE:
+        width = min(width, PKK_MAX_TILE_SIZE)
+        height = min(height, PKK_MAX_TILE_SIZE)
+        # пропорции растра не совпадут с bbox, и сервер подвинет экстент:
+        # настоящий экстент приходит только в json
+        tile_format = "json"
+    layers = TILE_LAYERS[layer.type]
+    layer_defs = {k: layer.where for k in layers}
     params = {
         "bbox": f"{tile_extent.xmin},{tile_extent.ymin},{tile_extent.xmax},{tile_extent.ymax}",
         "bboxSR": "102100",
@@ -103,68 +240,140 @@ def _generate_tile_params(feature: PkkSearchFeature, tile_extent: PkkExtent):
         "transparent": "false",
         "layers": "show:" + ",".join(map(str, layers)),
         "layerDefs": layer_defs,
-        "f": "json",
+        "f": tile_format,
     }
+    if layer.outline:
+        params["dynamicLayers"] = _dynamic_layers(layer)
     return params
 
 
+def _parse_tile(
+    r: httpx.Response, params: dict, tile_extent: PkkExtent
+) -> Optional[PkkTileResponse]:
+    """Тайл из ответа; None - в режиме f=image сервер вернул не png
+    (например, ошибку в json), и тайл нужно запросить с f=json"""
+    if params["f"] == "json":
+        # json разбирается один раз прямо из байтов ответа, без r.text и dict
+        return PkkTileResponse.model_validate_json(r.content)
+    if not r.content.startswith(PNG_SIGNATURE):
+        return None
+    width, height = map(int, params["size"].split(","))
+    extent = tile_extent.model_copy()
+    # image_data уже сырой png, валидация Base64Bytes его бы испортила
+    return PkkTileResponse.model_construct(
+        image_data=r.content,
+        content_type="image/png",
+        width=width,
+        height=height,
+        extent=extent,
+        # масштаб карты, как в ответе f=json: метров на пиксель при dpi=96
+        scale=(extent.xmax - extent.xmin) / width * 96 / 0.0254,
+    )
+
+
+def _jitter_extent(extent: PkkExtent, step: int) -> PkkExtent:
+    """bbox, расширенный на `step` тысячных метра: исходный экстент не меняется"""
+    return buffer_extent(extent, 0.001 * step)
+
+
 async def async_tile_request(
     client: httpx.AsyncClient,
-    feature: PkkSearchFeature,
+    feature: Union[PkkSearchFeature, TileLayer],
     tile_extent: PkkExtent,
-    tries_left: int = 10,
+    scale: float = DEFAULT_SCALE,
+    observer: ObserverArg = None,
+    tile_format: TileFormat = "json",
+    retry: Optional[RetryPolicy] = None,
 ):
-    if tries_left <= 0:
-        raise TileServerNotResponsedError
-    params = _generate_tile_params(feature, tile_extent)
-    try:
-        r = await client.get(SELECTED_TILE_HOST, params=params)
-        r.raise_for_status()
-    except (httpx.HTTPStatusError, httpx.TimeoutException, httpx.NetworkError) as e:
-        if isinstance(e, httpx.HTTPStatusError):
-            # если 400 - ошибка layerDefs от ПКК, но это неправда. Лечится незначительным изменением bbox
-            if e.response.status_code == 400:
-                tile_extent.xmin -= 0.001
-                tile_extent.xmax += 0.001
-                tile_extent.ymin -= 0.001
-                tile_extent.ymax += 0.001
-                return await async_tile_request(
-                    client, feature, tile_extent, tries_left=tries_left
-                )
-            elif e.response.status_code < 500:
-                raise e
-        await asyncio.sleep(1)
-        tries_left -= 1
-        return await async_tile_request(
-            client, feature, tile_extent, tries_left=tries_left
-        )
-    return PkkTileResponse.model_validate(r.json())
+    layer = TileLayer.of(feature)
+    call = (retry or _DEFAULT_RETRY).call("tile", observer, layer.cn)
+    extent = tile_extent
+    jitter = 0
+    while True:
+        params = _generate_tile_params(layer, extent, scale, tile_format)
+        _start_tile_attempt(call)
+        try:
+            start = perf_counter()
+            r = await client.get(SELECTED_TILE_HOST, params=params)
+            _emit_response(observer, "tile", r, start, layer.cn)
+            r.raise_for_status()
+        except (httpx.HTTPStatusError, *_TRANSIENT_ERRORS) as e:
+            action = _tile_failure(call, e)
+            if action == "jitter":
+                jitter += 1
+                extent = _jitter_extent(tile_extent, jitter)
+            elif action is None:
+                raise TileServerNotResponsedError from e
+            else:
+                await asyncio.sleep(action)
+            continue
+        call.succeeded()
+        tile = _parse_tile(r, params, extent)
+        if tile is not None:
+            return tile
+        emit(observer, "retry", cn=layer.cn, host="tile", reason="format")
+        tile_format = "json"
 
 
 def tile_request(
     client: httpx.Client,
-    feature: PkkSearchFeature,
+    feature: Union[PkkSearchFeature, TileLayer],
     tile_extent: PkkExtent,
-    tries_left: int = 10,
+    scale: float = DEFAULT_SCALE,
+    observer: ObserverArg = None,
+    tile_format: TileFormat = "json",
+    retry: Optional[RetryPolicy] = None,
 ):
-    if tries_left <= 0:
-        raise TileServerNotResponsedError
-    params = _generate_tile_params(feature, tile_extent)
+    layer = TileLayer.of(feature)
+    call = (retry or _DEFAULT_RETRY).call("tile", observer, layer.cn)
+    extent = tile_extent
+    jitter = 0
+    while True:
+        params = _generate_tile_params(layer, extent, scale, tile_format)
+        _start_tile_attempt(call)
+        try:
+            start = perf_counter()
+            r = client.get(SELECTED_TILE_HOST, params=params)
+            _emit_response(observer, "tile", r, start, layer.cn)
+            r.raise_for_status()
+        except (httpx.HTTPStatusError, *_TRANSIENT_ERRORS) as e:
+            action = _tile_failure(call, e)
+            if action == "jitter":
+                jitter += 1
+                extent = _jitter_extent(tile_extent, jitter)
+            elif action is None:
+                raise TileServerNotResponsedError from e
+            else:
+                sleep(action)
+            continue
+        call.succeeded()
+        tile = _parse_tile(r, params, extent)
+        if tile is not None:
+            return tile
+        emit(observer, "retry", cn=layer.cn, host="tile", reason="format")
+        tile_format = "json"
+
+
+def _start_tile_attempt(call: RetryCall):
     try:
-        r = client.get(SELECTED_TILE_HOST, params=params)
-        r.raise_for_status()
-    except (httpx.HTTPStatusError, httpx.TimeoutException, httpx.NetworkError) as e:
-        if isinstance(e, httpx.HTTPStatusError):
-            # если 400 - ошибка layerDefs от ПКК, но это неправда. Лечится незначительным изменением bbox
-            if e.response.status_code == 400:
-                tile_extent.xmin -= 0.001
-                tile_extent.xmax += 0.001
-                tile_extent.ymin -= 0.001
-                tile_extent.ymax += 0.001
-                return tile_request(client, feature, tile_extent, tries_left=tries_left)
-            elif e.response.status_code < 500:
-                raise e
-        sleep(1)
-        tries_left -= 1
-        return tile_request(client, feature, tile_extent, tries_left=tries_left)
-    return PkkTileResponse.model_validate(r.json())
+        call.start_attempt()
+    except CircuitOpenError as e:
+        raise TileCircuitOpenError(e.host) from None
+
+
+def _tile_failure(
+    call: RetryCall, e: Exception
+) -> Union[float, Literal["jitter"], None]:
+    """Что делать после неудачной попытки запроса тайла: ждать столько-то
+    секунд, сдвинуть bbox или сдаться (None). Ошибки клиента 4xx,
+    кроме 400, пробрасываются"""
+    if not isinstance(e, httpx.HTTPStatusError):
+        return call.failed(type(e).__name__)
+    status = e.response.status_code
+    # если 400 - ошибка layerDefs от ПКК, но это неправда. Лечится незначительным изменением bbox
+    if status == 400:
+        return "jitter" if call.rejected(str(status)) else None
+    if status < 500:
+        call.succeeded()
+        raise e
+    return call.failed(str(status))
@@ -0,0 +1,241 @@
+"""Повторы запросов к ПКК.
+
+`RetryPolicy` - общая для всех запросов клиента политика:
+- экспоненциальная задержка с полным джиттером: повторы воркеров,
+  упавших одновременно, расходятся во времени, а не бьют в сервер хором;
+- бюджет повторов: повторов не больше доли `budget_ratio` от запросов
+  (и `budget_min_per_second` в секунду), чтобы при отказе сервера
+  повторы не умножали нагрузку;
+- автомат (circuit breaker) на каждый хост: после `failure_threshold`
+  сбоев подряд запросы к хосту сразу падают с `CircuitOpenError`,
+  а через `reset_timeout` секунд пропускается один пробный запрос.
+
+Сбой сервера - 5xx, таймаут или сетевая ошибка. Ответ 400 от сервера тайлов
+сбоем не считается: он лечится сдвигом bbox и повторяется сразу"""
+
+import random
+import threading
+from dataclasses import dataclass, replace
+from time import monotonic
+from typing import Literal, Optional
+
+from pypkk.instrumentation import ObserverArg, emit
+from pypkk.tile_utils import API_TRIES, TILE_TRIES
+
+Host = Literal["api", "tile"]
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, host: str):
+        super().__init__(f"сервер {host} недоступен, запросы временно не отправляются")
+        self.host = host
+
+
+@dataclass
+class RetryStats:
+    # сколько повторов сделано
+    retries: int = 0
+    # сколько раз повтор не сделан из-за исчерпанного бюджета
+    budget_exhausted: int = 0
+    # сколько раз автомат размыкался
+    circuit_opened: int = 0
+    # сколько запросов отклонено разомкнутым автоматом без отправки
+    rejected: int = 0
+
+
+class RetryBudget:
+    """Бюджет повторов: каждый запрос добавляет `ratio` токена, каждый
+    повтор тратит токен; сверх того токены копятся со скоростью
+    `min_per_second`. Токенов не больше `max_tokens`"""
+
+    def __init__(
+        self, ratio: float = 0.2, min_per_second: float = 1.0, max_tokens: float = 10
+    ):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = float(max_tokens)
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, amount: float):
+        now = monotonic()
+        amount += (now - self._updated) * self.min_per_second
+        self._tokens = min(self.max_tokens, self._tokens + amount)
+        self._updated = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill(self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            self._refill(0)
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class CircuitBreaker:
+    """Автомат одного хоста: closed - запросы идут, open - отклоняются,
+    half_open - пропущен один пробный запрос, остальные отклоняются"""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state: Literal["closed", "open", "half_open"] = "closed"
+        self._failures = 0
+        self._changed = monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            # пробный запрос, не вернувший результата за reset_timeout,
+            # тоже считается потерянным - пропускается следующий
+            if monotonic() - self._changed < self.reset_timeout:
+                return False
+            self.state = "half_open"
+            self._changed = monotonic()
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self._failures = 0
+
+    def record_failure(self) -> bool:
+        """Учитывает сбой; True - автомат только что разомкнулся"""
+        with self._lock:
+            self._failures += 1
+            if self.state == "half_open" or (
+                self.state == "closed" and self._failures >= self.failure_threshold
+            ):
+                self.state = "open"
+                self._changed = monotonic()
+                return True
+            return False
+
+
+class RetryPolicy:
+    """Политика повторов, общая для запросов одного клиента.
+
+    `api_tries`, `tile_tries` - сколько всего попыток на запрос;
+    `budget_ratio=None` отключает бюджет, `failure_threshold=None` - автомат"""
+
+    def __init__(
+        self,
+        api_tries: int = API_TRIES,
+        tile_tries: int = TILE_TRIES,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+        budget_ratio: Optional[float] = 0.2,
+        budget_min_per_second: float = 1.0,
+        failure_threshold: Optional[int] = 10,
+        reset_timeout: float = 30.0,
+        seed: Optional[int] = None,
+    ):
+        if api_tries < 1 or tile_tries < 1:
+            raise ValueError("число попыток должно быть не меньше 1")
+        self.tries: dict[str, int] = {"api": api_tries, "tile": tile_tries}
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = (
+            RetryBudget(budget_ratio, budget_min_per_second)
+            if budget_ratio is not None
+            else None
+        )
+        self.breakers: dict[str, CircuitBreaker] = (
+            {
+                host: CircuitBreaker(failure_threshold, reset_timeout)
+                for host in self.tries
+            }
+            if failure_threshold is not None
+            else {}
+        )
+        self._random = random.Random(seed)
+        self._stats = RetryStats()
+        self._stats_lock = threading.Lock()
+
+    @property
+    def stats(self) -> RetryStats:
+        with self._stats_lock:
+            return replace(self._stats)
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            setattr(self._stats, name, getattr(self._stats, name) + 1)
+
+    def backoff(self, retry: int) -> float:
+        """Задержка перед повтором номер `retry` (с нуля): полный джиттер"""
+        return self._random.uniform(0, min(self.max_delay, self.base_delay * 2**retry))
+
+    def call(
+        self, host: Host, observer: ObserverArg = None, cn: Optional[str] = None
+    ) -> "RetryCall":
+        if self.budget is not None:
+            self.budget.deposit()
+        return RetryCall(self, host, observer, cn)
+
+
+class RetryCall:
+    """Попытки одного запроса: цикл запроса спрашивает у него,
+    отправлять ли попытку и сколько ждать перед следующей"""
+
+    def __init__(
+        self,
+        policy: RetryPolicy,
+        host: Host,
+        observer: ObserverArg = None,
+        cn: Optional[str] = None,
+    ):
+        self.policy = policy
+        self.host = host
+        self.observer = observer
+        self.cn = cn
+        self.attempt = 0
+        self._failures = 0
+        self._breaker = policy.breakers.get(host)
+
+    def start_attempt(self):
+        """Перед отправкой попытки: при разомкнутом автомате - CircuitOpenError"""
+        if self._breaker is not None and not self._breaker.allow():
+            self.policy._count("rejected")
+            raise CircuitOpenError(self.host)
+        self.attempt += 1
+
+    def succeeded(self):
+        """Сервер ответил (в том числе ошибкой клиента 4xx)"""
+        if self._breaker is not None:
+            self._breaker.record_success()
+
+    def failed(self, reason: str) -> Optional[float]:
+        """Сбой сервера: задержка перед повтором или None, если повторов больше нет"""
+        if self._breaker is not None and self._breaker.record_failure():
+            self.policy._count("circuit_opened")
+            # повтор все равно был бы отклонен автоматом
+            return None
+        if self.attempt >= self.policy.tries[self.host]:
+            return None
+        budget = self.policy.budget
+        if budget is not None and not budget.withdraw():
+            self.policy._count("budget_exhausted")
+            return None
+        self._retry(reason)
+        self._failures += 1
+        return self.policy.backoff(self._failures - 1)
+
+    def rejected(self, reason: str) -> bool:
+        """Сервер отклонил запрос, который стоит повторить сразу
+        с другими параметрами; False - попытки кончились"""
+        self.succeeded()
+        if self.attempt >= self.policy.tries[self.host]:
+            return False
+        self._retry(reason)
+        return True
+
+    def _retry(self, reason: str):
+        self.policy._count("retries")
+        emit(self.observer, "retry", cn=self.cn, host=self.host, reason=reason)
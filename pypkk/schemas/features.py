@@ -1,13 +1,14 @@
-from typing import Any, Literal, Optional
+from typing import TYPE_CHECKING, Any, Literal, Optional, Union
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from pydantic_geojson import FeatureModel, MultiPolygonModel
-from shapely.geometry import MultiPolygon, Point, shape
 
-from pypkk.geom_utils import to_4326
 from pypkk.schemas.attrs import OksAttrs, SearchAttrs, ZuAttrs
 from pypkk.schemas.coords import PkkCenter, PkkExtent
 
+if TYPE_CHECKING:
+    from shapely.geometry import MultiPolygon
+
 PkkType = Literal[1, 2, 5]
 
 
@@ -20,6 +21,10 @@ class PkkSearchFeature(BaseModel):
 
     @property
     def shapely_geometry(self):
+        from shapely.geometry import Point
+
+        from pypkk.geom_utils import to_4326
+
         if self.center is None:
             return Point()
         return to_4326(Point(self.center.x, self.center.y))
@@ -36,17 +41,32 @@ class ZuFeature(PkkFeature):
     attrs: ZuAttrs
 
 
+class KvartalFeature(PkkFeature):
+    type: Literal[2]
+
+
 class OksFeature(PkkFeature):
     type: Literal[5]
     attrs: OksAttrs
 
 
+class ProjectedMultiPolygonModel(MultiPolygonModel):
+    """Мультиполигон в epsg:3857 (`output_crs=3857`): координаты в метрах,
+    без проверки диапазона долготы и широты"""
+
+    coordinates: list[list[list[tuple[float, float]]]]
+
+
 class PkkGeojson(FeatureModel):
-    geometry: MultiPolygonModel
+    geometry: Union[MultiPolygonModel, ProjectedMultiPolygonModel] = Field(
+        union_mode="left_to_right"
+    )
     properties: SearchAttrs
 
     @property
-    def shapely_geometry(self) -> MultiPolygon:
+    def shapely_geometry(self) -> "MultiPolygon":
+        from shapely.geometry import shape
+
         return shape(self.geometry.model_dump())
 
 
@@ -7,6 +7,11 @@ from typing_extensions import Self
 from pypkk.schemas.features import PkkType
 
 
+def clean_cn(code: str) -> str:
+    """Кадастровый номер без ведущих нулей, как в адресах API"""
+    return ":".join(map(str, map(int, code.split(":"))))
+
+
 class Cn(BaseModel):
     code: Annotated[
         str, StringConstraints(strip_whitespace=True, pattern=r"\d+:\d+:\d+:\d+")
@@ -15,7 +20,7 @@ class Cn(BaseModel):
 
     @property
     def clean_code(self) -> str:
-        return ":".join(map(str, map(int, self.code.split(":"))))
+        return clean_cn(self.code)
 
     @staticmethod
     def zu(code: str) -> "ZuCn":
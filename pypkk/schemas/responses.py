@@ -4,7 +4,12 @@ from pydantic import Base64Bytes, BaseModel, ConfigDict
 from pydantic.alias_generators import to_camel
 
 from pypkk.schemas.coords import PkkExtent
-from pypkk.schemas.features import OksFeature, PkkSearchFeature, ZuFeature
+from pypkk.schemas.features import (
+    KvartalFeature,
+    OksFeature,
+    PkkSearchFeature,
+    ZuFeature,
+)
 
 
 class PkkAtPointResponse(BaseModel):
@@ -19,7 +24,7 @@ class PkkSearchResponse(BaseModel):
 
 
 class PkkFeatureResponse(BaseModel):
-    feature: Optional[ZuFeature | OksFeature] = None
+    feature: Optional[ZuFeature | OksFeature | KvartalFeature] = None
 
 
 class PkkTileResponse(BaseModel):
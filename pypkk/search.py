@@ -0,0 +1,112 @@
+"""Поиск всех объектов в полигоне перебором точек.
+
+API ПКК ищет объекты только в точке с допуском `tolerance`, поэтому полигон
+покрывается сеткой с шагом, при котором круг допуска накрывает ячейку целиком,
+и в центре каждой ячейки вызывается `search_at_point`. Найденные объекты
+дедуплицируются по `attrs.id`, а ячейки, целиком лежащие в экстенте уже
+найденного объекта, не запрашиваются. Экстент - прямоугольник, поэтому
+отсечение может пропустить мелкий объект внутри экстента большого
+невыпуклого соседа; `prune=False` перебирает все ячейки"""
+
+import math
+from typing import Iterator, Optional
+
+import numpy as np
+import shapely
+from shapely import STRtree
+from shapely.geometry import Polygon
+from shapely.geometry.base import BaseGeometry
+
+from pypkk.geom_utils import to_3857, to_4326
+from pypkk.schemas.features import PkkSearchFeature, PkkType
+
+# сколько ячеек сетки перебирается не больше, чтобы опечатка в полигоне
+# не превратилась в миллионы запросов при лимите 1 запрос в секунду
+MAX_SWEEP_CELLS = 100_000
+
+
+class SweepTooLargeError(Exception):
+    def __init__(self, cells: int):
+        super().__init__(
+            f"полигон покрывается {cells} ячейками, больше {MAX_SWEEP_CELLS}"
+        )
+
+
+def sweep_step(tolerance: float) -> float:
+    """Сторона ячейки, вписанной в круг допуска поиска по точке"""
+    return tolerance * math.sqrt(2)
+
+
+class PolygonSweep:
+    """Состояние перебора полигона `polygon` (epsg:4326)"""
+
+    def __init__(
+        self,
+        polygon: BaseGeometry,
+        tolerance: float,
+        types: Optional[list[PkkType]] = None,
+        prune: bool = True,
+        max_cells: int = MAX_SWEEP_CELLS,
+    ):
+        self.polygon = to_3857(polygon)
+        shapely.prepare(self.polygon)
+        self.step = sweep_step(tolerance)
+        self.types = types
+        self.prune = prune
+        xmin, ymin, xmax, ymax = self.polygon.bounds
+        cells = math.ceil((xmax - xmin) / self.step) * math.ceil(
+            (ymax - ymin) / self.step
+        )
+        if cells > max_cells:
+            raise SweepTooLargeError(cells)
+        self.seen: set[str] = set()
+        self._extents: list[Polygon] = []
+        self._tree: Optional[STRtree] = None
+
+    def _cells(self) -> Iterator[Polygon]:
+        xmin, ymin, xmax, ymax = self.polygon.bounds
+        xs = np.arange(xmin, xmax, self.step)
+        for y in np.arange(ymax, ymin, -self.step):
+            boxes = shapely.box(xs, y - self.step, xs + self.step, y)
+            yield from boxes[shapely.intersects(self.polygon, boxes)]
+
+    def _covered(self, cell: Polygon) -> bool:
+        if not self.prune or len(self._extents) == 0:
+            return False
+        if self._tree is None:
+            self._tree = STRtree(self._extents)
+        return len(self._tree.query(cell, predicate="within")) > 0
+
+    def points(self) -> Iterator[tuple[float, float]]:
+        """Центры незакрытых ячеек (lng, lat).
+
+        Читается лениво: закрытие ячейки проверяется в момент,
+        когда до нее доходит очередь"""
+        for cell in self._cells():
+            if self._covered(cell):
+                continue
+            center = to_4326(cell.centroid)
+            yield center.x, center.y
+
+    def add(self, results: list[PkkSearchFeature]) -> list[PkkSearchFeature]:
+        """Новые объекты из результата поиска, пересекающие полигон"""
+        new = []
+        for feature in results:
+            if feature.attrs.id in self.seen:
+                continue
+            if self.types is not None and feature.type not in self.types:
+                continue
+            if feature.extent is not None:
+                extent = shapely.box(
+                    feature.extent.xmin,
+                    feature.extent.ymin,
+                    feature.extent.xmax,
+                    feature.extent.ymax,
+                )
+                if not self.polygon.intersects(extent):
+                    continue
+                self._extents.append(extent)
+                self._tree = None
+            self.seen.add(feature.attrs.id)
+            new.append(feature)
+        return new
@@ -0,0 +1,443 @@
+"""Локальная подмена ПКК для тестов и бенчмарков без сети.
+
+`FakePkkTransport` отвечает на запросы к API (`/features/`) и к серверу тайлов
+(`MapServer/export`) вместо pkk.rosreestr.ru: либо повторяет записанные
+ответы (см. `RecordingTransport`), либо рисует тайлы синтетических объектов.
+Задержка и ошибки 400/502 настраиваются, чтобы проверять повторы запросов.
+
+    fake = FakePkkTransport(sample_parcels().values(), latency=0.05)
+    with PKK(cache_type=None, transport=fake) as api: ...
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Iterable, Optional, Union
+
+import cv2
+import httpx
+import numpy as np
+import pyproj
+import shapely
+from shapely.affinity import translate
+from shapely.geometry import MultiPoint, Point, Polygon
+from shapely.geometry.base import BaseGeometry
+
+from pypkk.requests import API_HOST, SELECTED_TILE_HOST, TILE_LAYERS
+from pypkk.schemas.features import PkkType
+from pypkk.schemas.inputs import clean_cn
+from pypkk.tile_utils import OUTLINE_PX
+
+# район Москвы в epsg:3857, чтобы перепроецирование было реалистичным
+ORIGIN_3857 = (4185000.0, 7510000.0)
+_TRANSFORM_4326_3857 = pyproj.Transformer.from_crs(
+    "epsg:4326", "epsg:3857", always_xy=True
+).transform
+_LAYER_ID_RE = re.compile(r"ID = '([^']+)'")
+_LAYER_ID_IN_RE = re.compile(r"ID IN \(([^)]*)\)")
+_LAYER_ID_LIKE_RE = re.compile(r"ID LIKE '([^'%]*)%'")
+
+
+@dataclass
+class FakeFeature:
+    """Синтетический объект ПКК: кадастровый номер и геометрия в epsg:3857"""
+
+    code: str
+    geometry: BaseGeometry
+    type: PkkType = 1
+    attrs: dict = field(default_factory=dict)
+
+    @property
+    def id(self) -> str:
+        return clean_cn(self.code)
+
+    def to_json(self) -> dict:
+        xmin, ymin, xmax, ymax = self.geometry.bounds
+        center = self.geometry.representative_point()
+        attrs = {
+            "id": self.id,
+            "cn": self.code,
+            "cad_cost": None,
+            "area_value": round(self.geometry.area),
+            "address": None,
+            "fp": None,
+            "util_by_doc": None,
+            "floors": None,
+            "underground_floors": None,
+            "name": None,
+            "year_built": None,
+            "year_used": None,
+            **self.attrs,
+        }
+        return {
+            "attrs": attrs,
+            "type": self.type,
+            "center": {"x": center.x, "y": center.y},
+            "extent": {"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax},
+        }
+
+
+def _wavy_polygon(width: float, height: float, vertices: int) -> Polygon:
+    t = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    r = 0.42 + 0.05 * np.sin(t * 37) + 0.03 * np.cos(t * 91)
+    x = width / 2 + r * width * np.cos(t)
+    y = height / 2 + r * height * np.sin(t)
+    return Polygon(np.column_stack([x, y]))
+
+
+def sample_parcels() -> dict[str, FakeFeature]:
+    """Набор типовых участков: small - один тайл, complex - извилистый контур
+    с дырами на несколько тайлов, large - протяженный объект на десятки тайлов"""
+    x0, y0 = ORIGIN_3857
+    small = Polygon([(0, 0), (48, 3), (52, 37), (4, 41)])
+    rng = np.random.default_rng(0)
+    holes = MultiPoint(rng.uniform((150, 120), (650, 480), (60, 2))).buffer(
+        6, quad_segs=4
+    )
+    complex_ = _wavy_polygon(800, 600, 3000).difference(holes)
+    large = _wavy_polygon(4000, 2500, 5000)
+    return {
+        "small": FakeFeature(
+            "77:01:0001001:101", translate(small, x0, y0), attrs={"address": "small"}
+        ),
+        "complex": FakeFeature("77:01:0001001:102", translate(complex_, x0 + 1000, y0)),
+        "large": FakeFeature("77:01:0001001:103", translate(large, x0, y0 + 1000)),
+    }
+
+
+def sample_kvartal() -> tuple[FakeFeature, list[FakeFeature]]:
+    """Квартал и его участки: сетка смежных участков с общими границами,
+    отдельно стоящий участок и участок из двух контуров"""
+    x0, y0 = ORIGIN_3857
+    x0 += 6000
+    rng = np.random.default_rng(1)
+    cols, rows = 4, 3
+    nodes = np.stack(
+        np.meshgrid(np.arange(cols + 1) * 60.0, np.arange(rows + 1) * 45.0), axis=-1
+    )
+    # внутренние узлы сетки сдвинуты, чтобы границы не шли по пикселям
+    nodes[1:-1, 1:-1] += rng.uniform(-12, 12, (rows - 1, cols - 1, 2))
+    parcels = []
+    for r in range(rows):
+        for c in range(cols):
+            quad = [nodes[r, c], nodes[r, c + 1], nodes[r + 1, c + 1], nodes[r + 1, c]]
+            parcels.append(
+                FakeFeature(
+                    f"77:01:0002002:{len(parcels) + 1}",
+                    translate(Polygon(quad), x0, y0),
+                )
+            )
+    parcels.append(
+        FakeFeature(
+            "77:01:0002002:100",
+            translate(Polygon([(0, 0), (35, 4), (31, 30), (2, 26)]), x0 + 300, y0),
+        )
+    )
+    parcels.append(
+        FakeFeature(
+            "77:01:0002002:101",
+            translate(
+                shapely.box(0, 0, 30, 20).union(shapely.box(0, 40, 30, 60)),
+                x0 + 300,
+                y0 + 80,
+            ),
+        )
+    )
+    bounds = shapely.unary_union([i.geometry for i in parcels]).envelope.buffer(20)
+    kvartal = FakeFeature("77:01:0002002", bounds.envelope, type=2)
+    return kvartal, parcels
+
+
+def render_tile(
+    geometries: Iterable[BaseGeometry],
+    bbox: tuple[float, float, float, float],
+    width: int,
+    height: int,
+    outline: int = 0,
+) -> bytes:
+    """Png тайла как у ПКК: объекты темные на белом фоне.
+
+    `outline` - толщина белой обводки объектов в пикселях (dynamicLayers)"""
+    xmin, ymin, xmax, ymax = bbox
+    img = np.full((height, width), 255, dtype=np.uint8)
+
+    def to_pixels(ring) -> np.ndarray:
+        coords = np.asarray(ring.coords)
+        px = (coords[:, 0] - xmin) / (xmax - xmin) * width
+        py = (ymax - coords[:, 1]) / (ymax - ymin) * height
+        return np.round(np.column_stack([px, py])).astype(np.int32)
+
+    # с запасом, чтобы контур за краем тайла не рисовался вдоль рамки
+    frame = shapely.box(*bbox).buffer((xmax - xmin) / width * 2)
+    parts = [
+        part
+        for geom in geometries
+        for part in shapely.get_parts(geom.intersection(frame))
+        if isinstance(part, Polygon) and not part.is_empty
+    ]
+    for part in parts:
+        cv2.fillPoly(img, [to_pixels(part.exterior)], 0)
+        if part.interiors:
+            cv2.fillPoly(img, [to_pixels(i) for i in part.interiors], 255)
+    # обводка поверх всех заливок, чтобы соседний объект ее не закрасил
+    if outline > 0:
+        for part in parts:
+            rings = [part.exterior, *part.interiors]
+            cv2.polylines(img, [to_pixels(i) for i in rings], True, 255, outline)
+    return cv2.imencode(".png", img)[1].tobytes()
+
+
+def _request_key(request: httpx.Request) -> str:
+    """Ключ записанного ответа: метод, адрес и отсортированные параметры"""
+    params = sorted(request.url.params.multi_items())
+    url = request.url.copy_with(query=None)
+    raw = json.dumps([request.method, str(url), params], ensure_ascii=False)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def _layer_ids(layer_defs: str) -> set[str]:
+    ids = set(_LAYER_ID_RE.findall(layer_defs))
+    for group in _LAYER_ID_IN_RE.findall(layer_defs):
+        ids.update(i.strip(" '") for i in group.split(","))
+    return ids
+
+
+def _layer_matches(layer_defs: str, feature_id: str) -> bool:
+    if feature_id in _layer_ids(layer_defs):
+        return True
+    return any(feature_id.startswith(i) for i in _LAYER_ID_LIKE_RE.findall(layer_defs))
+
+
+class FakePkkTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """Транспорт httpx, отвечающий вместо ПКК.
+
+    `features` - синтетические объекты, тайлы для них рисуются на лету и
+    запоминаются, поэтому повторный запрос тайла почти ничего не стоит.
+    `recordings` - каталог с ответами, записанными `RecordingTransport`;
+    записанный ответ важнее синтетического.
+    `latency` - задержка каждого ответа, с; `api_errors` и `tile_errors` -
+    вероятности ответов с ошибкой по кодам, например {502: 0.1, 400: 0.05};
+    `binary_tiles=False` - сервер без f=image, отвечает на него ошибкой в json"""
+
+    def __init__(
+        self,
+        features: Iterable[FakeFeature] = (),
+        recordings: Optional[Union[str, Path]] = None,
+        latency: float = 0.0,
+        api_errors: Optional[dict[int, float]] = None,
+        tile_errors: Optional[dict[int, float]] = None,
+        seed: int = 0,
+        binary_tiles: bool = True,
+    ):
+        self.features = {(i.type, i.id): i for i in features}
+        self.binary_tiles = binary_tiles
+        self.latency = latency
+        self.api_errors = api_errors or {}
+        self.tile_errors = tile_errors or {}
+        # (api|tile, код ответа) -> количество
+        self.calls: Counter = Counter()
+        self._random = random.Random(seed)
+        self._rendered: dict[str, bytes] = {}
+        self._recordings: dict[str, dict] = {}
+        if recordings is not None:
+            for path in Path(recordings).glob("*.json"):
+                self._recordings[path.stem] = json.loads(path.read_text())
+
+    def add(self, feature: FakeFeature):
+        self.features[(feature.type, feature.id)] = feature
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if self.latency > 0:
+            sleep(self.latency)
+        return self._respond(request)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        return self._respond(request)
+
+    def _respond(self, request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        if url.startswith(SELECTED_TILE_HOST):
+            group, errors = "tile", self.tile_errors
+        elif url.startswith(API_HOST):
+            group, errors = "api", self.api_errors
+        else:
+            return self._count("other", httpx.Response(404))
+        for status, rate in errors.items():
+            if self._random.random() < rate:
+                return self._count(group, httpx.Response(status))
+        key = _request_key(request)
+        if key in self._recordings:
+            record = self._recordings[key]
+            response = httpx.Response(
+                record["status"],
+                content=base64.b64decode(record["body"]),
+                headers={"content-type": record["content_type"]},
+            )
+        elif group == "tile":
+            response = self._tile(request, key)
+        else:
+            response = self._api(request)
+        return self._count(group, response)
+
+    def _count(self, group: str, response: httpx.Response) -> httpx.Response:
+        self.calls[group, response.status_code] += 1
+        return response
+
+    def _api(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.removeprefix(httpx.URL(API_HOST).path)
+        match = re.fullmatch(r"/features/(\d+)/([^/]+)", path)
+        if match is not None:
+            feature = self.features.get((int(match[1]), match[2]))
+            return httpx.Response(
+                200, json={"feature": feature.to_json() if feature else None}
+            )
+        if path.rstrip("/") == "/features":
+            return self._search_at_point(request.url.params)
+        return httpx.Response(404)
+
+    def _search_at_point(self, params: httpx.QueryParams) -> httpx.Response:
+        lat, lng = map(float, params["text"].split())
+        point = Point(_TRANSFORM_4326_3857(lng, lat))
+        types = {int(i) for i in params.get_list("types")}
+        results = [
+            i.to_json()
+            for i in self.features.values()
+            if (not types or i.type in types)
+            and i.geometry.distance(point) <= float(params.get("tolerance", 0))
+        ]
+        return httpx.Response(200, json={"total": len(results), "results": results})
+
+    def _tile(self, request: httpx.Request, key: str) -> httpx.Response:
+        params = request.url.params
+        bbox = tuple(map(float, params["bbox"].split(",")))
+        width, height = (round(float(i)) for i in params["size"].split(","))
+        if key not in self._rendered:
+            # dynamicLayers переопределяет layerDefs и рисует объекты с обводкой
+            dynamic = params.get("dynamicLayers")
+            layer_defs = dynamic or params.get("layerDefs", "")
+            layers = set(map(int, params["layers"].removeprefix("show:").split(",")))
+            geometries = [
+                i.geometry
+                for i in self.features.values()
+                if _layer_matches(layer_defs, i.id)
+                and layers.issuperset(TILE_LAYERS[i.type])
+            ]
+            self._rendered[key] = render_tile(
+                geometries, bbox, width, height, OUTLINE_PX if dynamic else 0
+            )
+        png = self._rendered[key]
+        if params.get("f") == "image":
+            if not self.binary_tiles:
+                # ArcGIS сообщает об ошибках кодом 200 с json в теле
+                return httpx.Response(
+                    200, json={"error": {"code": 400, "message": "Invalid format"}}
+                )
+            return httpx.Response(
+                200, content=png, headers={"content-type": "image/png"}
+            )
+        xmin, ymin, xmax, ymax = bbox
+        return httpx.Response(
+            200,
+            json={
+                "href": "",
+                "imageData": base64.b64encode(png).decode(),
+                "contentType": "image/png",
+                "width": width,
+                "height": height,
+                "extent": {"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax},
+                "scale": 375,
+            },
+        )
+
+
+class RecordingTransport(httpx.BaseTransport):
+    """Транспорт, сохраняющий ответы ПКК в `directory` для `FakePkkTransport`.
+
+    Записывать стоит с отключенным кэшем, иначе попадут только промахи:
+    PKK(cache_type=None, transport=RecordingTransport(HTTPTransport(...), dir))"""
+
+    def __init__(self, transport: httpx.BaseTransport, directory: Union[str, Path]):
+        self._transport = transport
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        response = self._transport.handle_request(request)
+        body = response.read()
+        record = {
+            "method": request.method,
+            "url": str(request.url),
+            "status": response.status_code,
+            "content_type": response.headers.get("content-type", ""),
+            "body": base64.b64encode(body).decode(),
+        }
+        path = self.directory / f"{_request_key(request)}.json"
+        path.write_text(json.dumps(record, ensure_ascii=False))
+        # тело уже распаковано, поэтому заголовки сжатия не переносятся
+        headers = {
+            k: v
+            for k, v in response.headers.items()
+            if k not in ("content-encoding", "content-length", "transfer-encoding")
+        }
+        return httpx.Response(response.status_code, headers=headers, content=body)
+
+    def close(self):
+        self._transport.close()
+
+
+class FakeRedis:
+    """Подмена общего key-value сервера (подмножество redis.Redis) в памяти.
+
+    Один экземпляр можно отдать нескольким клиентам, как общий redis:
+    PKK(cache_type=KeyValueStorage(fake_redis))"""
+
+    def __init__(self):
+        # key -> (значение, момент истечения или None)
+        self.data: dict[str, tuple[bytes, Optional[float]]] = {}
+
+    def get(self, key: str) -> Optional[bytes]:
+        value, expires = self.data.get(key, (None, None))
+        if expires is not None and expires < monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def set(self, key: str, value: Union[str, bytes], px: Optional[int] = None):
+        if isinstance(value, str):
+            value = value.encode()
+        expires = monotonic() + px / 1000 if px is not None else None
+        self.data[key] = (value, expires)
+
+    def delete(self, key: str):
+        self.data.pop(key, None)
+
+    def close(self):
+        pass
+
+
+class AsyncFakeRedis:
+    """Асинхронный интерфейс к `FakeRedis` (подмножество redis.asyncio.Redis)"""
+
+    def __init__(self, redis: Optional[FakeRedis] = None):
+        self.redis = redis or FakeRedis()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self.redis.get(key)
+
+    async def set(self, key: str, value: Union[str, bytes], px: Optional[int] = None):
+        self.redis.set(key, value, px)
+
+    async def delete(self, key: str):
+        self.redis.delete(key)
+
+    async def aclose(self):
+        pass
@@ -1,9 +1,15 @@
-from typing import Optional
+import math
+from typing import TYPE_CHECKING, Optional
 
 from pypkk.schemas.coords import PkkExtent
 
+if TYPE_CHECKING:
+    from shapely.geometry.base import BaseGeometry
+
 # ~scale=375 в ответе с пкк; достаточный масштаб для определение выступа контура меньше метра
 DEFAULT_SCALE = 10
+# то же в размере пикселя на местности, м/px
+DEFAULT_RESOLUTION = 1 / DEFAULT_SCALE
 # константа подобранная опытным путем, НЕ МЕНЯТЬ
 # при запросе шириной/высотой больше этого значения будет ошибка
 PKK_MAX_TILE_SIZE = 4000
@@ -17,18 +23,86 @@ API_TRIES = 5
 TILE_TIMEOUT = 1000
 API_TIMEOUT = 1000
 
+# адаптивное разбиение: сначала грубый проход сеткой COARSE_GRID x COARSE_GRID,
+# затем в полном масштабе запрашиваются только ячейки на границе контура.
+# при равномерной сетке до ADAPTIVE_MIN_TILES тайлов почти все ячейки граничные,
+# и лишний грубый проход не окупается
+ADAPTIVE_MIN_TILES = 9
+COARSE_GRID = 1
+# запас вокруг грубой границы в пикселях грубого тайла:
+# epsilon approxPolyDP (5 px) плюс погрешность растеризации
+COARSE_MARGIN_PX = 7
+# точность подбора масштаба граничных ячеек, доля масштаба
+REFINED_SCALE_TOLERANCE = 0.01
+
+# сбор квартала: все объекты слоя рисуются на общих тайлах с обводкой
+# толщиной OUTLINE_PX, и тайлы склеиваются в одну мозаику не больше
+# KVARTAL_MAX_PIXELS, поэтому масштаб большого квартала понижается
+OUTLINE_PX = 2
+KVARTAL_MAX_PIXELS = 64_000_000
+
 
 def generate_tile_extents(
     extent: PkkExtent,
     custom_extent: Optional[PkkExtent] = None,
-    scale: Optional[int] = None,
+    scale: Optional[float] = None,
 ) -> list[PkkExtent]:
     # if custom_extent is not None:
     #     input_extent.xmin = max([input_extent.xmin, custom_extent.xmin])
     #     input_extent.ymin = max([input_extent.ymin, custom_extent.ymin])
     #     input_extent.xmax = min([input_extent.xmax, custom_extent.xmax])
     #     input_extent.ymax = min([input_extent.ymax, custom_extent.ymax])
-    scale = scale or DEFAULT_SCALE
+    return plan_tile_extents(extent, 1 / (scale or DEFAULT_SCALE))[0]
+
+
+def tile_scale(
+    extent: PkkExtent,
+    resolution: float = DEFAULT_RESOLUTION,
+    max_tiles: int = MAX_SUBTILES_PER_CN,
+) -> float:
+    """Наибольший масштаб (px/м) не мельче `resolution` (м/px), при котором
+    экстент покрывается сеткой не больше чем из `max_tiles` тайлов.
+
+    Считается сразу, без построения сеток: для каждого числа столбцов
+    `nx` берется наибольшее число строк `max_tiles // nx`, и из таких сеток
+    выбирается сетка с наименьшей стороной ячейки"""
+    if resolution <= 0:
+        raise ValueError("resolution должен быть больше нуля")
+    if max_tiles < 1:
+        raise ValueError("max_tiles должен быть не меньше 1")
+    # небольшой запас, чтобы погрешность не добавила лишний ряд тайлов
+    width = (extent.xmax - extent.xmin) * 1.001
+    height = (extent.ymax - extent.ymin) * 1.001
+    cell = min(
+        max(width / nx, height / (max_tiles // nx)) for nx in range(1, max_tiles + 1)
+    )
+    # если экстент не укладывается в бюджет тайлов при таком масштабе - уменьшаем,
+    # но страдает качество контуров
+    return min(1 / resolution, PKK_MAX_TILE_SIZE / (cell + TILE_BUFFER * 2))
+
+
+def plan_tile_extents(
+    extent: PkkExtent,
+    resolution: float = DEFAULT_RESOLUTION,
+    max_tiles: int = MAX_SUBTILES_PER_CN,
+) -> tuple[list[PkkExtent], float]:
+    """Тайлы объекта с буфером и масштаб, в котором их запрашивать, см. `tile_scale`"""
+    scale = tile_scale(extent, resolution, max_tiles)
+    extents = [buffer_extent(i, TILE_BUFFER) for i in _generate_grid(extent, scale)]
+    return extents, scale
+
+
+def buffer_extent(extent: PkkExtent, distance: float) -> PkkExtent:
+    return PkkExtent(
+        xmin=extent.xmin - distance,
+        xmax=extent.xmax + distance,
+        ymin=extent.ymin - distance,
+        ymax=extent.ymax + distance,
+    )
+
+
+def _generate_grid(extent: PkkExtent, scale: float) -> list[PkkExtent]:
+    """Ячейки сетки без буфера, покрывающие экстент"""
     max_tile_size = PKK_MAX_TILE_SIZE / scale - TILE_BUFFER * 2
     extents: list[PkkExtent] = []
     cymin = extent.ymin
@@ -47,18 +121,77 @@ def generate_tile_extents(
                 else max_tile_size
             )
             cxmax = cxmin + xoffset
-            extents.append(
-                PkkExtent(
-                    xmin=cxmin - TILE_BUFFER,
-                    xmax=cxmax + TILE_BUFFER,
-                    ymin=cymin - TILE_BUFFER,
-                    ymax=cymax + TILE_BUFFER,
-                )
-            )
+            extents.append(PkkExtent(xmin=cxmin, xmax=cxmax, ymin=cymin, ymax=cymax))
             cxmin += xoffset
         cymin += max_tile_size
-    # если экстентов слишком много при таком масштабе - уменьшаем
-    # но страдает качество контуров
-    if len(extents) > MAX_SUBTILES_PER_CN and scale > 1:
-        return generate_tile_extents(extent, custom_extent, scale - 1)
     return extents
+
+
+def coarse_scale(extent: PkkExtent) -> float:
+    """Масштаб грубого прохода: экстент укладывается в COARSE_GRID тайлов по стороне"""
+    # небольшой запас, чтобы погрешность не добавила лишний ряд тайлов
+    side = max(extent.xmax - extent.xmin, extent.ymax - extent.ymin) * 1.001
+    scale = PKK_MAX_TILE_SIZE * COARSE_GRID / (side + TILE_BUFFER * 2 * COARSE_GRID)
+    return min(scale, DEFAULT_SCALE)
+
+
+def generate_coarse_tile_extents(extent: PkkExtent) -> list[PkkExtent]:
+    return [
+        buffer_extent(i, TILE_BUFFER)
+        for i in _generate_grid(extent, coarse_scale(extent))
+    ]
+
+
+def generate_refined_tile_extents(
+    extent: PkkExtent,
+    coarse_geometry: "BaseGeometry",
+    resolution: float = DEFAULT_RESOLUTION,
+    max_tiles: int = MAX_SUBTILES_PER_CN,
+) -> tuple[list[PkkExtent], float]:
+    """Ячейки полного масштаба, через которые проходит граница грубого контура.
+
+    Остальные ячейки целиком внутри или снаружи контура, и для них хватает
+    грубой геометрии. Возвращаются ячейки без буфера (epsg:3857) и их масштаб"""
+    from shapely import STRtree, box
+
+    margin = COARSE_MARGIN_PX / coarse_scale(extent)
+    boundary = coarse_geometry.boundary.buffer(margin)
+
+    def boundary_cells(scale: float) -> list[PkkExtent]:
+        cells = _generate_grid(extent, scale)
+        boxes = [box(i.xmin, i.ymin, i.xmax, i.ymax) for i in cells]
+        hits = STRtree(boxes).query(boundary, predicate="intersects")
+        return [cells[i] for i in sorted(hits)]
+
+    # при масштабе `floor` в бюджет укладывается вся сетка, а значит
+    # и граничные ячейки; при `1 / resolution` ячеек больше всего
+    floor = tile_scale(extent, resolution, max_tiles)
+    best = max(1 / resolution, floor)
+    cells = boundary_cells(best)
+    if len(cells) <= max_tiles or best <= floor:
+        return cells, best
+    # число граничных ячеек растет с масштабом (с точностью до выравнивания
+    # сетки), и наибольший масштаб в бюджете ищется делением отрезка пополам
+    low, high = floor, best
+    cells = boundary_cells(low)
+    while high - low > REFINED_SCALE_TOLERANCE * high:
+        middle = (low + high) / 2
+        candidate = boundary_cells(middle)
+        if len(candidate) <= max_tiles:
+            low, cells = middle, candidate
+        else:
+            high = middle
+    return cells, low
+
+
+def kvartal_scale(extent: PkkExtent) -> float:
+    """Масштаб общих тайлов квартала: мозаика не больше KVARTAL_MAX_PIXELS"""
+    width = extent.xmax - extent.xmin + TILE_BUFFER * 2
+    height = extent.ymax - extent.ymin + TILE_BUFFER * 2
+    return min(DEFAULT_SCALE, math.sqrt(KVARTAL_MAX_PIXELS / (width * height)))
+
+
+def generate_kvartal_tile_extents(extent: PkkExtent) -> tuple[list[PkkExtent], float]:
+    scale = kvartal_scale(extent)
+    extents = [buffer_extent(i, TILE_BUFFER) for i in _generate_grid(extent, scale)]
+    return extents, scale
@@ -0,0 +1,281 @@
+"""Общие пулы соединений с ПКК.
+
+Каждый экземпляр PKK/AsyncPKK по умолчанию держит свой пул, и короткоживущие
+экземпляры платят за TLS-рукопожатие на каждом создании. `TransportManager`
+позволяет нескольким экземплярам делить один пул keep-alive соединений:
+
+    manager = TransportManager(PoolConfig(max_connections=32, http2=True))
+    for chunk in chunks:
+        with PKK(transport_manager=manager) as api: ...
+    print(manager.stats)
+    manager.close()
+"""
+
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+
+import httpx
+
+from pypkk.requests import SSL_CONTEXT
+
+
+@dataclass(frozen=True)
+class PoolConfig:
+    """Настройки пула; по умолчанию совпадают с httpx"""
+
+    max_connections: Optional[int] = 100
+    max_keepalive_connections: Optional[int] = 20
+    # сколько секунд простаивающее соединение держится открытым
+    keepalive_expiry: Optional[float] = 5.0
+    # мультиплексирование запросов в одном соединении, нужен пакет h2
+    http2: bool = False
+
+    @property
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+
+@dataclass
+class PoolStats:
+    # запросов через пул и сколько для них открыто новых соединений
+    requests: int = 0
+    connections_opened: int = 0
+    # соединения пула на момент снимка
+    connections: int = 0
+    active: int = 0
+    idle: int = 0
+    http2: int = 0
+    max_connections: Optional[int] = None
+    by_host: dict[str, int] = field(default_factory=dict)
+    # False - httpx/httpcore не дают заглянуть в пул, и поля снимка пустые
+    snapshot: bool = True
+
+    @property
+    def reuse(self) -> float:
+        """Доля запросов, обслуженных уже открытым соединением"""
+        if self.requests == 0:
+            return 0.0
+        return 1 - self.connections_opened / self.requests
+
+    @property
+    def utilization(self) -> Optional[float]:
+        """Доля занятых соединений от предела пула"""
+        if not self.max_connections:
+            return None
+        return self.active / self.max_connections
+
+
+def _connection_pool(transport: httpx.BaseTransport | httpx.AsyncBaseTransport):
+    """Пул httpcore за транспортом httpx или None.
+
+    Пул лежит в приватном атрибуте httpx, поэтому его наличие проверяется:
+    без него статистика обходится счетчиками из trace-событий"""
+    pool = getattr(transport, "_pool", None)
+    if pool is None or not hasattr(pool, "connections"):
+        return None
+    return pool
+
+
+def _connection_host(connection) -> str:
+    # у соединений httpcore нет публичного адреса, только приватный _origin
+    origin = getattr(connection, "_origin", None)
+    host = getattr(origin, "host", None)
+    return host.decode() if isinstance(host, bytes) else "?"
+
+
+def _is_connect(event: str) -> bool:
+    # connection.connect_tcp.complete, connection.connect_unix_socket.complete
+    return event.startswith("connection.connect_") and event.endswith(".complete")
+
+
+class _PoolMonitor:
+    """Статистика пула: запросы и новые соединения считаются по публичному
+    trace-расширению httpcore, снимок соединений - по пулу, если он доступен"""
+
+    def __init__(self, pool, config: PoolConfig):
+        self._pool = pool
+        self._config = config
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._opened = 0
+
+    def trace(self, request: httpx.Request):
+        """Подключает счетчик соединений к запросу, сохраняя чужой trace"""
+        previous = request.extensions.get("trace")
+
+        def trace(event: str, info: dict):
+            if _is_connect(event):
+                self._connected()
+            if previous is not None:
+                previous(event, info)
+
+        request.extensions["trace"] = trace
+
+    def async_trace(self, request: httpx.Request):
+        # асинхронный httpcore ждет от trace корутину
+        previous = request.extensions.get("trace")
+
+        async def trace(event: str, info: dict):
+            if _is_connect(event):
+                self._connected()
+            if previous is not None:
+                await previous(event, info)
+
+        request.extensions["trace"] = trace
+
+    def _connected(self):
+        with self._lock:
+            self._opened += 1
+
+    def observe(self):
+        with self._lock:
+            self._requests += 1
+
+    @property
+    def stats(self) -> PoolStats:
+        with self._lock:
+            stats = PoolStats(
+                requests=self._requests,
+                connections_opened=self._opened,
+                max_connections=self._config.max_connections,
+                snapshot=self._pool is not None,
+            )
+        if self._pool is None:
+            return stats
+        for i in self._pool.connections:
+            stats.connections += 1
+            if i.is_idle():
+                stats.idle += 1
+            else:
+                stats.active += 1
+            if "HTTP/2" in i.info():
+                stats.http2 += 1
+            host = _connection_host(i)
+            stats.by_host[host] = stats.by_host.get(host, 0) + 1
+        return stats
+
+
+class SharedTransport(httpx.BaseTransport):
+    """Транспорт поверх общего пула; закрытие клиента пул не закрывает"""
+
+    def __init__(self, transport: httpx.HTTPTransport, monitor: _PoolMonitor):
+        self._transport = transport
+        self._monitor = monitor
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self._monitor.trace(request)
+        response = self._transport.handle_request(request)
+        self._monitor.observe()
+        return response
+
+    def close(self):
+        pass
+
+
+class AsyncSharedTransport(httpx.AsyncBaseTransport):
+    """Асинхронный вариант `SharedTransport`"""
+
+    def __init__(self, transport: httpx.AsyncHTTPTransport, monitor: _PoolMonitor):
+        self._transport = transport
+        self._monitor = monitor
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self._monitor.async_trace(request)
+        response = await self._transport.handle_async_request(request)
+        self._monitor.observe()
+        return response
+
+    async def aclose(self):
+        pass
+
+
+class TransportManager:
+    """Владелец пулов соединений, общих для нескольких PKK/AsyncPKK.
+
+    Синхронный и асинхронный пулы создаются при первом запросе транспорта.
+    Асинхронный пул привязан к event loop, поэтому делить его можно только
+    между клиентами одного loop"""
+
+    def __init__(self, config: Optional[PoolConfig] = None):
+        self.config = config or PoolConfig()
+        if self.config.http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError as e:
+                raise RuntimeError(
+                    "для http2=True нужен пакет h2: pip install httpx[http2]"
+                ) from e
+        self._lock = threading.Lock()
+        self._transport: Optional[httpx.HTTPTransport] = None
+        self._async_transport: Optional[httpx.AsyncHTTPTransport] = None
+        self._monitor: Optional[_PoolMonitor] = None
+        self._async_monitor: Optional[_PoolMonitor] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excinfo):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *excinfo):
+        await self.aclose()
+
+    def transport(self) -> SharedTransport:
+        with self._lock:
+            if self._transport is None:
+                self._transport = httpx.HTTPTransport(
+                    verify=SSL_CONTEXT,
+                    http2=self.config.http2,
+                    limits=self.config.limits,
+                )
+                self._monitor = _PoolMonitor(
+                    _connection_pool(self._transport), self.config
+                )
+        return SharedTransport(self._transport, self._monitor)
+
+    def async_transport(self) -> AsyncSharedTransport:
+        with self._lock:
+            if self._async_transport is None:
+                self._async_transport = httpx.AsyncHTTPTransport(
+                    verify=SSL_CONTEXT,
+                    http2=self.config.http2,
+                    limits=self.config.limits,
+                )
+                self._async_monitor = _PoolMonitor(
+                    _connection_pool(self._async_transport), self.config
+                )
+        return AsyncSharedTransport(self._async_transport, self._async_monitor)
+
+    @property
+    def stats(self) -> PoolStats:
+        """Статистика синхронного пула"""
+        if self._monitor is None:
+            return PoolStats(max_connections=self.config.max_connections)
+        return self._monitor.stats
+
+    @property
+    def async_stats(self) -> PoolStats:
+        if self._async_monitor is None:
+            return PoolStats(max_connections=self.config.max_connections)
+        return self._async_monitor.stats
+
+    def close(self):
+        with self._lock:
+            transport, self._transport = self._transport, None
+        if transport is not None:
+            transport.close()
+
+    async def aclose(self):
+        with self._lock:
+            transport, self._async_transport = self._async_transport, None
+        if transport is not None:
+            await transport.aclose()
+        self.close()
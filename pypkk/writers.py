@@ -0,0 +1,362 @@
+"""Потоковая запись результатов на диск.
+
+Объекты дописываются по мере поступления, в памяти держится не больше
+одного буфера, поэтому выгрузка миллионов объектов не растет по памяти:
+
+    with GeoPackageWriter("parcels.gpkg") as writer:
+        await writer.write_from(api.find_geojson_many(cns))
+
+Сериализация идет через `model_dump_json`/`model_dump` без повторной
+валидации pydantic, геометрии в GeoPackage кодируются пачкой средствами GEOS"""
+
+import json
+import sqlite3
+import struct
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, AsyncIterable, Optional, TextIO, Union
+
+from pypkk.schemas.features import PkkGeojson
+
+if TYPE_CHECKING:
+    import numpy as np
+
+    from pypkk.geom_utils import OutputCrs
+
+# RFC 8142: каждая запись GeoJSONSeq начинается с символа RS
+RECORD_SEPARATOR = "\x1e"
+# размер буфера файла GeoJSONSeq, байт
+BUFFER_SIZE = 1 << 20
+# сколько объектов GeoPackage копится перед записью одной транзакцией
+GPKG_BATCH_SIZE = 1000
+
+ResultItem = Union[PkkGeojson, tuple[Any, Union[PkkGeojson, Exception, None]]]
+
+
+class FeatureWriter(ABC):
+    """Приемник объектов, дописывающий их на диск по мере поступления"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excinfo):
+        self.close()
+
+    @abstractmethod
+    def write(self, feature: PkkGeojson): ...
+
+    def flush(self):
+        pass
+
+    @abstractmethod
+    def close(self): ...
+
+    async def write_from(self, results: AsyncIterable[ResultItem]) -> int:
+        """Записывает результаты AsyncPKK: объекты или пары (cn, результат),
+        как из `find_geojson_many`; пустые результаты и ошибки пропускаются.
+        Возвращает количество записанных объектов"""
+        count = 0
+        async for item in results:
+            if isinstance(item, tuple):
+                item = item[1]
+            if isinstance(item, PkkGeojson):
+                self.write(item)
+                count += 1
+        return count
+
+
+class GeoJsonSeqWriter(FeatureWriter):
+    """GeoJSONSeq (RFC 8142) в файл или открытый текстовый поток.
+
+    `record_separator=False` - ndjson, по объекту на строку"""
+
+    def __init__(
+        self,
+        target: Union[str, Path, TextIO],
+        record_separator: bool = True,
+        buffer_size: int = BUFFER_SIZE,
+    ):
+        if isinstance(target, (str, Path)):
+            self._file = open(target, "a", encoding="utf-8", buffering=buffer_size)
+            self._owns_file = True
+        else:
+            self._file = target
+            self._owns_file = False
+        self._prefix = RECORD_SEPARATOR if record_separator else ""
+
+    def write(self, feature: PkkGeojson):
+        self._file.write(f"{self._prefix}{feature.model_dump_json()}\n")
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._owns_file:
+            self._file.close()
+        else:
+            self._file.flush()
+
+
+_WGS84_WKT = (
+    'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,'
+    'AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,'
+    'AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,'
+    'AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]'
+)
+_PSEUDO_MERCATOR_WKT = (
+    f'PROJCS["WGS 84 / Pseudo-Mercator",{_WGS84_WKT},'
+    'PROJECTION["Mercator_1SP"],PARAMETER["central_meridian",0],'
+    'PARAMETER["scale_factor",1],PARAMETER["false_easting",0],'
+    'PARAMETER["false_northing",0],UNIT["metre",1,AUTHORITY["EPSG","9001"]],'
+    'AXIS["Easting",EAST],AXIS["Northing",NORTH],AUTHORITY["EPSG","3857"]]'
+)
+# строки gpkg_spatial_ref_sys для систем координат результата
+_GPKG_SRS: dict[int, tuple[str, str]] = {
+    4326: ("WGS 84 geodetic", _WGS84_WKT),
+    3857: ("WGS 84 / Pseudo-Mercator", _PSEUDO_MERCATOR_WKT),
+}
+_GPKG_APPLICATION_ID = 0x47504B47
+_GPKG_VERSION = 10300
+_GPKG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (
+    srs_name TEXT NOT NULL,
+    srs_id INTEGER PRIMARY KEY,
+    organization TEXT NOT NULL,
+    organization_coordsys_id INTEGER NOT NULL,
+    definition TEXT NOT NULL,
+    description TEXT
+);
+CREATE TABLE IF NOT EXISTS gpkg_contents (
+    table_name TEXT NOT NULL PRIMARY KEY,
+    data_type TEXT NOT NULL,
+    identifier TEXT UNIQUE,
+    description TEXT DEFAULT '',
+    last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+    min_x DOUBLE,
+    min_y DOUBLE,
+    max_x DOUBLE,
+    max_y DOUBLE,
+    srs_id INTEGER REFERENCES gpkg_spatial_ref_sys(srs_id)
+);
+CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (
+    table_name TEXT NOT NULL REFERENCES gpkg_contents(table_name),
+    column_name TEXT NOT NULL,
+    geometry_type_name TEXT NOT NULL,
+    srs_id INTEGER NOT NULL REFERENCES gpkg_spatial_ref_sys(srs_id),
+    z TINYINT NOT NULL,
+    m TINYINT NOT NULL,
+    PRIMARY KEY (table_name, column_name)
+);
+CREATE TABLE IF NOT EXISTS gpkg_extensions (
+    table_name TEXT,
+    column_name TEXT,
+    extension_name TEXT NOT NULL,
+    definition TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    UNIQUE (table_name, column_name, extension_name)
+);
+INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES
+    ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', NULL),
+    ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', NULL);
+"""
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _column_type(value: Any) -> str:
+    if isinstance(value, bool):
+        return "BOOLEAN"
+    if isinstance(value, int):
+        return "INTEGER"
+    if isinstance(value, float):
+        return "REAL"
+    return "TEXT"
+
+
+def _column_value(value: Any) -> Any:
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def _gpkg_geometries(geometries: "np.ndarray", srs_id: int) -> list[bytes]:
+    """Двоичные геометрии GeoPackage: заголовок с экстентом и WKB"""
+    import shapely
+
+    bounds = shapely.bounds(geometries)
+    wkbs = shapely.to_wkb(geometries, byte_order=1)
+    # GP, версия 0, флаги: little endian (бит 0) и экстент xy (биты 1-3)
+    return [
+        struct.pack("<2sBBi4d", b"GP", 0, 0b011, srs_id, minx, maxx, miny, maxy) + wkb
+        for (minx, miny, maxx, maxy), wkb in zip(bounds.tolist(), wkbs)
+    ]
+
+
+class GeoPackageWriter(FeatureWriter):
+    """GeoPackage (sqlite) с пространственным индексом R*Tree.
+
+    Объекты копятся пачками по `batch_size` и пишутся одной транзакцией;
+    колонки атрибутов добавляются по мере появления новых полей.
+    В существующий файл объекты дописываются в ту же таблицу.
+    Индекс заполняется самим писателем, без триггеров расширения
+    gpkg_rtree_index: им нужны функции SpatiaLite (ST_MinX, ...).
+    `crs` - система координат объектов, как `output_crs` клиента"""
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        table: str = "features",
+        batch_size: int = GPKG_BATCH_SIZE,
+        crs: "OutputCrs" = 4326,
+    ):
+        if crs not in _GPKG_SRS:
+            raise ValueError(f"неподдерживаемая система координат: {crs}")
+        self.table = table
+        self.batch_size = batch_size
+        self.crs = crs
+        self._rtree = f"rtree_{table}_geom"
+        self._connection = sqlite3.connect(path)
+        self._buffer: list[tuple[str, dict]] = []
+        try:
+            self._create_schema()
+        except Exception:
+            self._connection.close()
+            raise
+        self._columns = {
+            row[1]
+            for row in self._connection.execute(f"PRAGMA table_info({_quote(table)})")
+        }
+        self._next_fid = self._connection.execute(
+            f"SELECT coalesce(max(fid), 0) + 1 FROM {_quote(table)}"
+        ).fetchone()[0]
+
+    def _create_schema(self):
+        db = self._connection
+        db.execute(f"PRAGMA application_id = {_GPKG_APPLICATION_ID}")
+        db.execute(f"PRAGMA user_version = {_GPKG_VERSION}")
+        with db:
+            db.executescript(_GPKG_SCHEMA)
+            srs_name, definition = _GPKG_SRS[self.crs]
+            db.execute(
+                "INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)",
+                (srs_name, self.crs, "EPSG", self.crs, definition, None),
+            )
+            db.execute(
+                f"CREATE TABLE IF NOT EXISTS {_quote(self.table)} ("
+                "fid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, geom MULTIPOLYGON)"
+            )
+            db.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {_quote(self._rtree)} "
+                "USING rtree(id, minx, maxx, miny, maxy)"
+            )
+            db.execute(
+                "INSERT OR IGNORE INTO gpkg_contents "
+                "(table_name, data_type, identifier, srs_id) VALUES (?, ?, ?, ?)",
+                (self.table, "features", self.table, self.crs),
+            )
+            db.execute(
+                "INSERT OR IGNORE INTO gpkg_geometry_columns VALUES (?, ?, ?, ?, ?, ?)",
+                (self.table, "geom", "MULTIPOLYGON", self.crs, 0, 0),
+            )
+            # дозапись в таблицу другой системы координат смешала бы их
+            srs_id = db.execute(
+                "SELECT srs_id FROM gpkg_geometry_columns WHERE table_name = ?",
+                (self.table,),
+            ).fetchone()[0]
+            if srs_id != self.crs:
+                raise ValueError(
+                    f"таблица {self.table} в epsg:{srs_id}, а объекты в epsg:{self.crs}"
+                )
+            db.execute(
+                "INSERT OR IGNORE INTO gpkg_extensions VALUES (?, ?, ?, ?, ?)",
+                (
+                    self.table,
+                    "geom",
+                    "gpkg_rtree_index",
+                    "http://www.geopackage.org/spec120/#extension_rtree",
+                    "write-only",
+                ),
+            )
+
+    def write(self, feature: PkkGeojson):
+        self._buffer.append(
+            (feature.geometry.model_dump_json(), feature.properties.model_dump())
+        )
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def _add_columns(self, rows: list[dict]):
+        # тип колонки - по первому непустому значению в пачке
+        new: dict[str, Optional[str]] = {}
+        for properties in rows:
+            for key, value in properties.items():
+                if key in self._columns:
+                    continue
+                if value is not None and new.get(key) is None:
+                    new[key] = _column_type(value)
+                else:
+                    new.setdefault(key, None)
+        for key, column_type in new.items():
+            self._connection.execute(
+                f"ALTER TABLE {_quote(self.table)} "
+                f"ADD COLUMN {_quote(key)} {column_type or 'TEXT'}"
+            )
+            self._columns.add(key)
+
+    def flush(self):
+        if len(self._buffer) == 0:
+            return
+        import shapely
+
+        batch, self._buffer = self._buffer, []
+        geometries = shapely.from_geojson([i[0] for i in batch])
+        blobs = _gpkg_geometries(geometries, self.crs)
+        bounds = shapely.bounds(geometries)
+        fids = range(self._next_fid, self._next_fid + len(batch))
+        self._next_fid += len(batch)
+        db = self._connection
+        with db:
+            self._add_columns([i[1] for i in batch])
+            columns = sorted(self._columns - {"fid", "geom"})
+            placeholders = ", ".join("?" * (len(columns) + 2))
+            names = ", ".join(map(_quote, ["fid", "geom", *columns]))
+            db.executemany(
+                f"INSERT INTO {_quote(self.table)} ({names}) VALUES ({placeholders})",
+                (
+                    (fid, blob, *(_column_value(props.get(i)) for i in columns))
+                    for fid, blob, (_, props) in zip(fids, blobs, batch)
+                ),
+            )
+            db.executemany(
+                f"INSERT INTO {_quote(self._rtree)} VALUES (?, ?, ?, ?, ?)",
+                (
+                    (fid, minx, maxx, miny, maxy)
+                    for fid, (minx, miny, maxx, maxy) in zip(fids, bounds.tolist())
+                ),
+            )
+            db.execute(
+                "UPDATE gpkg_contents SET "
+                "min_x = min(coalesce(min_x, :min_x), :min_x), "
+                "min_y = min(coalesce(min_y, :min_y), :min_y), "
+                "max_x = max(coalesce(max_x, :max_x), :max_x), "
+                "max_y = max(coalesce(max_y, :max_y), :max_y), "
+                "last_change = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') "
+                "WHERE table_name = :table",
+                {
+                    "min_x": float(bounds[:, 0].min()),
+                    "min_y": float(bounds[:, 1].min()),
+                    "max_x": float(bounds[:, 2].max()),
+                    "max_y": float(bounds[:, 3].max()),
+                    "table": self.table,
+                },
+            )
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._connection.close()
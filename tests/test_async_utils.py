@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+
+from pypkk.async_utils import SingleFlight, gather_cancelling, map_bounded
+
+
+@pytest.mark.asyncio
+async def test_gather_cancelling_keeps_order():
+    async def job(i: int):
+        await asyncio.sleep(0.01 * (5 - i))
+        return i
+
+    res = await gather_cancelling(job(i) for i in range(5))
+    assert res == [0, 1, 2, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_gather_cancelling_cancels_on_error():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def fail():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        await gather_cancelling([slow(), fail(), slow()])
+    assert len(cancelled) == 2
+
+
+@pytest.mark.asyncio
+async def test_map_bounded_limits_in_flight():
+    in_flight = 0
+    max_in_flight = 0
+
+    async def job(i: int):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01 * (i % 3))
+        in_flight -= 1
+        if i == 4:
+            raise ValueError
+        return i * 2
+
+    res = [i async for i in map_bounded(job, range(10), concurrency=3)]
+    assert max_in_flight <= 3
+    assert sorted(i for i, _ in res) == list(range(10))
+    assert isinstance(dict(res)[4], ValueError)
+    assert dict(res)[5] == 10
+
+
+@pytest.mark.asyncio
+async def test_map_bounded_ordered():
+    async def items():
+        for i in range(6):
+            yield i
+
+    async def job(i: int):
+        await asyncio.sleep(0.01 * (6 - i))
+        return i
+
+    res = [i async for i in map_bounded(job, items(), concurrency=2, ordered=True)]
+    assert [i for i, _ in res] == list(range(6))
+
+
+@pytest.mark.asyncio
+async def test_map_bounded_slow_input_does_not_hold_results():
+    consumed = asyncio.Event()
+
+    async def items():
+        yield 1
+        # следующий элемент появится только после выдачи первого результата
+        await asyncio.wait_for(consumed.wait(), 5)
+        yield 2
+
+    async def double(x: int) -> int:
+        return x * 2
+
+    results = []
+    async for _, result in map_bounded(double, items(), concurrency=4):
+        results.append(result)
+        consumed.set()
+    assert results == [2, 4]
+
+
+@pytest.mark.asyncio
+async def test_single_flight_shares_result_and_error():
+    flights = SingleFlight()
+    calls = 0
+
+    async def work(fail: bool):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        if fail:
+            raise ValueError("boom")
+        return object()
+
+    results = await asyncio.gather(
+        *(flights.do("a", lambda: work(False)) for _ in range(5))
+    )
+    assert calls == 1
+    assert all(i is results[0] for i in results)
+    errors = await asyncio.gather(
+        *(flights.do("b", lambda: work(True)) for _ in range(3)), return_exceptions=True
+    )
+    assert calls == 2
+    assert all(isinstance(i, ValueError) for i in errors)
+    assert flights.stats.calls == 8
+    assert flights.stats.shared == 6
+
+
+@pytest.mark.asyncio
+async def test_single_flight_cancellation():
+    flights = SingleFlight()
+    started = asyncio.Event()
+
+    async def work():
+        started.set()
+        await asyncio.sleep(0.05)
+        return 1
+
+    first = asyncio.ensure_future(flights.do("a", work))
+    second = asyncio.ensure_future(flights.do("a", work))
+    await started.wait()
+    first.cancel()
+    assert await second == 1
+
+    lonely = asyncio.ensure_future(flights.do("b", work))
+    await asyncio.sleep(0.01)
+    lonely.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await lonely
+    assert flights._flights == {}
@@ -0,0 +1,79 @@
+import pytest
+
+from pypkk.api import PKK, AsyncPKK
+from pypkk.cache import AsyncKeyValueStorage, KeyValueStorage
+from pypkk.schemas.inputs import Cn
+from pypkk.testing import AsyncFakeRedis, FakePkkTransport, FakeRedis, sample_parcels
+
+NO_LIMITS = {"api_rate_limit": None, "tile_rate_limit": None}
+
+
+@pytest.fixture(scope="module")
+def parcels():
+    return sample_parcels()
+
+
+def test_memory_layer_in_front_of_sqlite(parcels, tmp_path):
+    cn = Cn.zu(parcels["small"].code)
+    fake = FakePkkTransport(parcels.values())
+    with PKK(cache_dir=tmp_path, transport=fake, **NO_LIMITS) as api:
+        api.get_attrs(cn)
+        api.get_attrs(cn)
+        assert api.memory_cache_stats.hits == 1
+    with PKK(cache_dir=tmp_path, transport=fake, **NO_LIMITS) as api:
+        # новый процесс: память пуста, ответ читается из sqlite
+        assert api.get_attrs(cn).feature.attrs.cn == cn.code
+        assert api.memory_cache_stats.misses == 1
+        assert api.memory_cache_stats.entries == 1
+    assert fake.calls["api", 200] == 1
+
+
+def test_memory_layer_limits(parcels, tmp_path):
+    fake = FakePkkTransport(parcels.values())
+    with PKK(
+        cache_dir=tmp_path, memory_cache_entries=1, transport=fake, **NO_LIMITS
+    ) as api:
+        for parcel in parcels.values():
+            api.get_attrs(Cn.zu(parcel.code))
+        assert api.memory_cache_stats.entries == 1
+    with PKK(
+        cache_dir=tmp_path, memory_cache_bytes=10, transport=fake, **NO_LIMITS
+    ) as api:
+        api.get_attrs(Cn.zu(parcels["small"].code))
+        assert api.memory_cache_stats.entries == 0
+
+
+def test_shared_key_value_store(parcels, tmp_path):
+    cn = Cn.zu(parcels["small"].code)
+    fake = FakePkkTransport(parcels.values())
+    redis = FakeRedis()
+    for _ in range(2):
+        with PKK(
+            cache_type=KeyValueStorage(redis),
+            cache_dir=tmp_path,
+            transport=fake,
+            **NO_LIMITS,
+        ) as api:
+            api.get_attrs(cn)
+    assert fake.calls["api", 200] == 1
+    assert len(redis.data) == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("cache_type", ["filesystem", "redis"])
+async def test_async_backends(parcels, tmp_path, cache_type):
+    cn = Cn.zu(parcels["small"].code)
+    fake = FakePkkTransport(parcels.values())
+    if cache_type == "redis":
+        cache_type = AsyncKeyValueStorage(AsyncFakeRedis())
+    for _ in range(2):
+        async with AsyncPKK(
+            cache_type=cache_type,
+            cache_dir=tmp_path,
+            executor=None,
+            transport=fake,
+            **NO_LIMITS,
+        ) as api:
+            await api.find_geojson(cn)
+    assert fake.calls["api", 200] == 1
+    assert fake.calls["tile", 200] == 1
@@ -0,0 +1,101 @@
+import asyncio
+import io
+import sys
+from time import sleep
+
+import pytest
+
+from pypkk.cli import _aiter_lines, build_parser, iter_cns, run
+
+
+def test_iter_cns_lines():
+    cns = list(
+        iter_cns(["77:01:0001001:1\n", "\n", "bad\n", " 77:01:0001001:2 \n"], 1, False)
+    )
+    assert [i.code for i in cns] == ["77:01:0001001:1", "77:01:0001001:2"]
+    assert all(i.kind == 1 for i in cns)
+
+
+def test_iter_cns_extract():
+    lines = ["участки 77:01:0001001:1, 77:01:0001001:2 и здание 77:01:0001001:3"]
+    cns = list(iter_cns(lines, 5, True))
+    assert len(cns) == 3
+    assert all(i.kind == 5 for i in cns)
+
+
+def test_parser_defaults():
+    args = build_parser().parse_args(["--type", "oks", "--api-rate", "0", "a.txt"])
+    assert args.type == "oks"
+    assert args.api_rate == 0
+    assert args.inputs == ["a.txt"]
+
+
+def test_parser_rejects_ordered_journal():
+    with pytest.raises(SystemExit):
+        build_parser().parse_args(["--ordered", "--journal", "job.sqlite"])
+
+
+class SlowInput:
+    def __init__(self, lines: list[str]):
+        self.lines = lines
+
+    def read1(self, size: int) -> bytes:
+        sleep(0.05)
+        return self.lines.pop(0).encode() if self.lines else b""
+
+
+class SlowStdin:
+    def __init__(self, lines: list[str]):
+        self.buffer = SlowInput(lines)
+
+
+@pytest.mark.asyncio
+async def test_stdin_is_read_off_event_loop(monkeypatch):
+    monkeypatch.setattr(sys, "stdin", SlowStdin(["77:01:0001001:1\n"] * 3))
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    ticker = asyncio.ensure_future(tick())
+    lines = [i async for i in _aiter_lines([])]
+    ticker.cancel()
+    assert len(lines) == 3
+    # пока поток ждет строку, event loop продолжает работу
+    assert ticks >= 10
+
+
+@pytest.mark.asyncio
+async def test_input_is_read_in_chunks(tmp_path, monkeypatch):
+    lines = [f"77:01:0001001:{i}\n" for i in range(20_000)]
+    path = tmp_path / "cns.txt"
+    # последняя строка без перевода
+    path.write_text("".join(lines) + "кадастр 77:01:0001001:0", encoding="utf-8")
+    hops = 0
+    to_thread = asyncio.to_thread
+
+    async def counting(func, *args):
+        nonlocal hops
+        hops += 1
+        return await to_thread(func, *args)
+
+    monkeypatch.setattr(asyncio, "to_thread", counting)
+    read = [i async for i in _aiter_lines([str(path)])]
+    assert read == [*lines, "кадастр 77:01:0001001:0"]
+    assert hops < 20
+    # куски режут строки и символы кириллицы посередине
+    monkeypatch.setattr("pypkk.cli.READ_CHUNK_SIZE", 5)
+    read = [i async for i in _aiter_lines([str(path)])]
+    assert read[-2:] == [lines[-1], "кадастр 77:01:0001001:0"]
+
+
+@pytest.mark.asyncio
+async def test_invalid_input_fails(tmp_path, capsys):
+    path = tmp_path / "cns.txt"
+    path.write_text("bad\n77:01\n", encoding="utf-8")
+    args = build_parser().parse_args(["--no-cache", str(path)])
+    assert await run(args, io.StringIO()) == 1
+    assert capsys.readouterr().err.count("не кадастровый номер") == 2
@@ -6,15 +6,16 @@ import pytest
 
 # import geopandas as gpd
 from pypkk import PKK, AsyncPKK
-from pypkk.schemas.features import OksGeojson, ZuGeojson
+from pypkk.schemas.features import OksGeojson, PkkGeojson, ZuGeojson
 from pypkk.schemas.inputs import Cn
 
 
 @pytest.fixture(scope="session", autouse=True)
 def delete_cache():
-    file = Path(__file__).parent.parent / ".hishel.sqlite"
-    if file.exists():
-        file.unlink()
+    for name in (".hishel.sqlite", ".pypkk.sqlite"):
+        file = Path(__file__).parent.parent / name
+        if file.exists():
+            file.unlink()
 
 
 @pytest.fixture
@@ -107,5 +108,31 @@ async def test_async_gather_requests():
         res = await asyncio.gather(*map(api.get_attrs, cns))
         assert all([i.feature is not None for i in res])
         cache_time = time()
-        assert non_cache_time - start_time > 3
+        # лимит API - 1 запрос в секунду, первый запрос проходит без ожидания
+        assert non_cache_time - start_time > 2
         assert cache_time - non_cache_time < 1
+
+
+@pytest.mark.asyncio
+async def test_async_get_geojson_concurrent_tiles(large_cn):
+    async with AsyncPKK(tile_concurrency=4) as api:
+        data = await api.get_attrs(large_cn)
+        geo = await api.get_geojson(data.feature)
+        assert not geo.shapely_geometry.is_empty
+
+
+@pytest.mark.asyncio
+async def test_async_find_geojson_many():
+    cns = Cn.zu_array("77:03:0001007:28, 77:03:0001007:36, 0:0:0:0")
+    async with AsyncPKK() as api:
+        res = {cn.code: r async for cn, r in api.find_geojson_many(cns, concurrency=2)}
+    assert len(res) == 3
+    assert isinstance(res["77:03:0001007:28"], PkkGeojson)
+
+
+@pytest.mark.parametrize("executor", [None, "thread", "process"])
+def test_get_geojson_executor(simple_cn, executor):
+    with PKK(executor=executor) as api:
+        data = api.get_attrs(simple_cn)
+        geo = api.get_geojson(data.feature)
+        assert not geo.shapely_geometry.is_empty
@@ -0,0 +1,15 @@
+import numpy as np
+import pyproj
+import shapely
+
+from pypkk.geom_utils import to_3857, to_4326
+
+
+def test_mercator_matches_pyproj():
+    coords = np.random.default_rng(0).uniform((-2e7, -2e7), (2e7, 2e7), (1000, 2))
+    transformer = pyproj.Transformer.from_crs("epsg:3857", "epsg:4326", always_xy=True)
+    expected = np.column_stack(transformer.transform(coords[:, 0], coords[:, 1]))
+    lnglat = shapely.get_coordinates(to_4326(shapely.multipoints(coords)))
+    assert np.allclose(lnglat, expected, rtol=0, atol=1e-9)
+    back = shapely.get_coordinates(to_3857(shapely.multipoints(lnglat)))
+    assert np.allclose(back, coords, rtol=0, atol=1e-6)
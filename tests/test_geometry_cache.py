@@ -0,0 +1,98 @@
+import threading
+
+import pytest
+from shapely.geometry import MultiPolygon, box
+
+from pypkk.api import PKK, AsyncPKK
+from pypkk.geometry_cache import GeometryCache
+from pypkk.schemas.features import PkkSearchFeature, ZuFeature
+from pypkk.schemas.inputs import Cn
+from pypkk.testing import FakePkkTransport, sample_parcels
+
+
+def _feature(xmax: float) -> PkkSearchFeature:
+    return PkkSearchFeature.model_validate(
+        {
+            "type": 1,
+            "attrs": {"id": "77:2:2003:70", "cn": "77:02:0002003:70"},
+            "extent": {"xmin": 0, "ymin": 0, "xmax": xmax, "ymax": 1},
+        }
+    )
+
+
+def test_geometry_cache_invalidates_on_extent_change(tmp_path):
+    cache = GeometryCache(tmp_path / "cache.sqlite")
+    geom = MultiPolygon([box(0, 0, 1, 1)])
+    cache.set(_feature(1), geom)
+    assert cache.get(_feature(1)).equals(geom)
+    assert cache.get(_feature(2)) is None
+    cache.close()
+
+
+def test_search_and_attrs_features_share_entry(tmp_path):
+    # поиск отдает SearchAttrs, get_attrs - ZuAttrs с другими типами полей
+    data = sample_parcels()["small"].to_json()
+    found = PkkSearchFeature.model_validate(data)
+    feature = ZuFeature.model_validate(data)
+    assert found.attrs.model_dump_json() != feature.attrs.model_dump_json()
+    cache = GeometryCache(tmp_path / "cache.sqlite")
+    geom = MultiPolygon([box(0, 0, 1, 1)])
+    cache.set(found, geom)
+    assert cache.get(feature).equals(geom)
+    cache.set(feature, geom)
+    assert cache.get(found).equals(geom)
+    cache.close()
+
+
+def test_geometry_cache_ttl(tmp_path):
+    cache = GeometryCache(tmp_path / "cache.sqlite", ttl=-1)
+    cache.set(_feature(1), MultiPolygon([box(0, 0, 1, 1)]))
+    assert cache.get(_feature(1)) is None
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_async_client_uses_cache_off_event_loop(tmp_path, monkeypatch):
+    parcel = sample_parcels()["small"]
+    threads = []
+    get, set_ = GeometryCache.get, GeometryCache.set
+
+    def record(method):
+        def wrapper(*args):
+            threads.append(threading.get_ident())
+            return method(*args)
+
+        return wrapper
+
+    monkeypatch.setattr(GeometryCache, "get", record(get))
+    monkeypatch.setattr(GeometryCache, "set", record(set_))
+    async with AsyncPKK(
+        cache_dir=tmp_path,
+        executor=None,
+        transport=FakePkkTransport([parcel]),
+        api_rate_limit=None,
+        tile_rate_limit=None,
+    ) as api:
+        await api.find_geojson(Cn.zu(parcel.code))
+        await api.find_geojson(Cn.zu(parcel.code))
+    # промах, запись и попадание
+    assert len(threads) == 3
+    assert threading.get_ident() not in threads
+
+
+def test_get_geojson_hits_cache_across_schemas(tmp_path):
+    parcel = sample_parcels()["small"]
+    events = []
+    with PKK(
+        cache_dir=tmp_path,
+        transport=FakePkkTransport([parcel]),
+        observer=events.append,
+        api_rate_limit=None,
+        tile_rate_limit=None,
+    ) as api:
+        feature = api.get_attrs(Cn.zu(parcel.code)).feature
+        found = PkkSearchFeature.model_validate(parcel.to_json())
+        for i in [found, feature, found, feature]:
+            api.get_geojson(i)
+    hits = [i.data["from_cache"] for i in events if i.name == "geojson"]
+    assert hits == [False, True, True, True]
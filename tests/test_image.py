@@ -0,0 +1,115 @@
+import cv2
+import numpy as np
+import pytest
+from shapely.geometry import Polygon, box
+
+from pypkk import image
+from pypkk.geom_utils import to_4326
+from pypkk.image import (
+    MOSAIC_MAX_PIXELS,
+    TilePayload,
+    _decode_mask,
+    _mosaic_pixels,
+    _split_mosaic,
+    extract_geometry,
+    extract_mosaic_geometry,
+    get_image_geometry,
+    get_payload_geometry,
+    to_geom,
+)
+from pypkk.schemas.coords import PkkExtent
+from pypkk.schemas.responses import PkkTileResponse
+from pypkk.testing import render_tile, sample_parcels
+from pypkk.tile_utils import plan_tile_extents
+
+
+def _tile(extent, size=400):
+    img = np.full((size, size), 255, np.uint8)
+    # квадрат 100..300 px с дыркой 180..220 px
+    cv2.rectangle(img, (100, 100), (300, 300), 0, -1)
+    cv2.rectangle(img, (180, 180), (220, 220), 255, -1)
+    png = cv2.imencode(".png", img)[1].tobytes()
+    return TilePayload(image=png, extent=extent, width=size, height=size)
+
+
+def test_extract_geometry_georeference():
+    geom = extract_geometry([_tile((0.0, 0.0, 40.0, 40.0))])
+    assert len(geom.geoms) == 1
+    polygon = geom.geoms[0]
+    assert len(polygon.interiors) == 1
+    expected = to_4326(box(10, 10, 30.1, 30.1).difference(box(18, 18, 22.1, 22.1)))
+    assert polygon.symmetric_difference(expected).area / expected.area < 0.02
+
+
+def test_decode_mask_threshold():
+    # фон белый, объект - все, что темнее 245
+    img = np.array([[255, 245, 244, 0]], np.uint8)
+    png = cv2.imencode(".png", img)[1].tobytes()
+    assert _decode_mask(png).tolist() == [[0, 0, 128, 128]]
+
+
+def test_extract_geometry_output_crs():
+    geom = extract_geometry([_tile((0.0, 0.0, 40.0, 40.0))], output_crs=3857)
+    expected = box(10, 10, 30.1, 30.1).difference(box(18, 18, 22.1, 22.1))
+    assert geom.symmetric_difference(expected).area / expected.area < 0.02
+
+
+def test_get_image_geometry_accepts_tile_response():
+    tile = _tile((0.0, 0.0, 40.0, 40.0))
+    response = PkkTileResponse.model_construct(
+        image_data=tile.image,
+        content_type="image/png",
+        width=tile.width,
+        height=tile.height,
+        extent=PkkExtent(xmin=0, ymin=0, xmax=40, ymax=40),
+        scale=0,
+    )
+    assert get_image_geometry(response) == get_payload_geometry(tile)
+
+
+def test_to_geom_nested_lists():
+    shell = [[0, 0], [40, 0], [40, 40], [0, 40]]
+    hole = [[10, 10], [20, 10], [20, 20], [10, 20]]
+    geom = to_geom([[shell, hole], [[[50, 50], [60, 50], [60, 60]]]])
+    expected = to_4326(
+        box(0, 0, 40, 40)
+        .difference(box(10, 10, 20, 20))
+        .union(Polygon([(50, 50), (60, 50), (60, 60)]))
+    )
+    assert geom.symmetric_difference(expected).area / expected.area < 1e-9
+
+
+def _parcel_tiles(parcel, scale: float) -> list[TilePayload]:
+    extent = PkkExtent(**parcel.to_json()["extent"])
+    tiles = []
+    for i in plan_tile_extents(extent, 1 / scale)[0]:
+        bbox = (i.xmin, i.ymin, i.xmax, i.ymax)
+        width = round((i.xmax - i.xmin) * scale)
+        height = round((i.ymax - i.ymin) * scale)
+        png = render_tile([parcel.geometry], bbox, width, height)
+        tiles.append(TilePayload(image=png, extent=bbox, width=width, height=height))
+    return tiles
+
+
+# 40 млн - полосы из целых рядов, 20 млн - нижний ряд режется по столбцам
+@pytest.mark.parametrize(
+    "max_pixels, strip_count",
+    [(MOSAIC_MAX_PIXELS, 1), (40_000_000, 2), (20_000_000, 3)],
+)
+def test_mosaic_matches_tiles(max_pixels, strip_count, monkeypatch):
+    parcel = sample_parcels()["complex"]
+    tiles = _parcel_tiles(parcel, 10)
+    assert len(tiles) == 6
+    monkeypatch.setattr(image, "MOSAIC_MAX_PIXELS", max_pixels)
+    dx = (tiles[0].extent[2] - tiles[0].extent[0]) / tiles[0].width
+    strips = _split_mosaic(tiles, dx, dx)
+    assert sorted(i for strip in strips for i in strip) == sorted(tiles)
+    assert len(strips) == strip_count
+    for strip in strips:
+        assert _mosaic_pixels(strip, dx, dx) <= max_pixels
+    mosaic = extract_mosaic_geometry(tiles, output_crs=3857)
+    reference = extract_geometry(tiles, output_crs=3857)
+    assert mosaic.symmetric_difference(reference).area / reference.area < 0.005
+    assert (
+        mosaic.symmetric_difference(parcel.geometry).area / parcel.geometry.area < 0.01
+    )
@@ -0,0 +1,36 @@
+import json
+import subprocess
+import sys
+
+from pypkk.testing import sample_parcels
+
+# загружаются только при первой работе с геометрией
+GEOMETRY_MODULES = ["cv2", "numpy", "shapely", "pyproj", "pypkk.image"]
+
+# атрибуты запрашиваются через MockTransport: pypkk.testing сам тянет opencv
+_SCRIPT = """
+import json, sys
+import httpx
+import pypkk
+
+feature = json.loads(sys.argv[1])
+transport = httpx.MockTransport(
+    lambda request: httpx.Response(200, json={"feature": feature})
+)
+with pypkk.PKK(
+    cache_type=None, transport=transport, api_rate_limit=None, tile_rate_limit=None
+) as api:
+    assert api.get_attrs(pypkk.Cn.zu(feature["attrs"]["cn"])).feature is not None
+print(json.dumps(sorted(set(sys.argv[2:]) & set(sys.modules))))
+"""
+
+
+def test_attrs_without_geometry_stack():
+    feature = sample_parcels()["small"].to_json()
+    result = subprocess.run(
+        [sys.executable, "-c", _SCRIPT, json.dumps(feature), *GEOMETRY_MODULES],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert json.loads(result.stdout) == []
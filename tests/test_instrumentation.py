@@ -0,0 +1,68 @@
+import pytest
+
+from pypkk.api import PKK, AsyncPKK
+from pypkk.image import extract_geometry
+from pypkk.instrumentation import Event, StatsAggregator, run_timed
+from pypkk.schemas.inputs import Cn
+from pypkk.testing import FakePkkTransport, sample_parcels
+
+NO_LIMITS = {"api_rate_limit": None, "tile_rate_limit": None}
+
+
+def test_stats_aggregator():
+    stats = StatsAggregator()
+    for i in range(1, 101):
+        stats(Event("http", i / 100, data={"from_cache": i % 2 == 0, "bytes": 10}))
+    summary = stats.summary()["http"]
+    assert summary.count == 100
+    assert summary.p50 == pytest.approx(0.505)
+    assert summary.p95 == pytest.approx(0.95, abs=0.01)
+    assert summary.counters == {"from_cache": 50, "bytes": 1000}
+    assert "http" in stats.format_summary()
+
+
+def test_stats_aggregator_memory_is_bounded():
+    stats = StatsAggregator(reservoir_size=1000, seed=0)
+    for i in range(100_000):
+        stats(Event("tiles", (i % 1000) / 1000))
+    summary = stats.summary()["tiles"]
+    assert len(stats._durations["tiles"].sample) == 1000
+    assert summary.count == 100_000
+    assert summary.total == pytest.approx(49_950)
+    assert summary.p50 == pytest.approx(0.5, abs=0.05)
+    assert summary.p95 == pytest.approx(0.95, abs=0.02)
+
+
+def test_run_timed_outside_observer():
+    parcel = sample_parcels()["small"]
+    fake = FakePkkTransport([parcel])
+    with PKK(cache_type=None, transport=fake, **NO_LIMITS) as api:
+        feature = api.get_attrs(Cn.zu(parcel.code)).feature
+        tiles = api._fetch_tiles(feature, [feature.extent])
+    geom, timings = run_timed(extract_geometry, tiles)
+    assert not geom.is_empty
+    assert {"decode", "contours", "polygons", "reproject", "union"} <= set(timings)
+
+
+@pytest.mark.asyncio
+async def test_async_pkk_events():
+    parcel = sample_parcels()["complex"]
+    events: list[Event] = []
+    fake = FakePkkTransport([parcel], tile_errors={400: 0.3}, seed=2)
+    async with AsyncPKK(
+        cache_type=None,
+        executor="thread",
+        transport=fake,
+        observer=events.append,
+        api_rate_limit=None,
+    ) as api:
+        await api.find_geojson(Cn.zu(parcel.code))
+    names = {i.name for i in events}
+    assert {"http", "rate_limit", "tiles", "decode", "union", "geojson"} <= names
+    http = [i for i in events if i.name == "http" and i.data["host"] == "tile"]
+    retries = [i for i in events if i.name == "retry"]
+    assert len(http) == sum(fake.calls[k] for k in fake.calls if k[0] == "tile")
+    assert len(retries) == fake.calls["tile", 400]
+    tiles = [i for i in events if i.name == "tiles"]
+    assert sum(i.data["tiles"] for i in tiles) == fake.calls["tile", 200]
+    assert all(i.data["bytes"] > 0 for i in tiles)
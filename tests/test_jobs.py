@@ -0,0 +1,95 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from pypkk.async_utils import map_bounded
+from pypkk.jobs import BulkJob
+from pypkk.schemas.inputs import Cn
+
+
+class FakePKK:
+    def __init__(self, broken: set[str]):
+        self.broken = broken
+        self.calls: list[str] = []
+
+    async def find_geojson(self, cn: Cn):
+        self.calls.append(cn.code)
+        if cn.clean_code in self.broken:
+            raise RuntimeError("tile server is down")
+        return None
+
+    def find_geojson_many(self, cns, concurrency: int, ordered: bool = False):
+        return map_bounded(self.find_geojson, cns, concurrency, ordered)
+
+
+@pytest.mark.asyncio
+async def test_bulk_job_resumes_and_retries_failures(tmp_path):
+    cns = [Cn.zu(f"77:01:0001001:{i}") for i in range(5)]
+    api = FakePKK(broken={cns[1].clean_code})
+    with BulkJob(api, tmp_path / "journal.sqlite", batch_size=2) as job:
+        async for _ in job.run(cns):
+            break
+        done_first = len(api.calls)
+
+    api = FakePKK(broken={cns[1].clean_code})
+    with BulkJob(api, tmp_path / "journal.sqlite", batch_size=2) as job:
+        results = [i async for i in job.run(cns)]
+        assert job.progress.done == 4
+        assert job.progress.failed == 1
+        assert job.progress.pending == 0
+        assert [cn.code for cn, _ in job.failures()] == [cns[1].clean_code]
+    assert len(results) + done_first >= 5
+
+    api = FakePKK(broken=set())
+    with BulkJob(api, tmp_path / "journal.sqlite") as job:
+        results = [i async for i in job.run()]
+        assert [cn.clean_code for cn, _ in results] == [cns[1].clean_code]
+        assert job.progress.done == 5
+
+
+@pytest.mark.asyncio
+async def test_bulk_job_streams_input(tmp_path):
+    api = FakePKK(broken=set())
+    first_done = asyncio.Event()
+
+    async def cns():
+        yield Cn.zu("77:01:0001001:1")
+        # второй номер появится только после обработки первого
+        await asyncio.wait_for(first_done.wait(), 5)
+        yield Cn.zu("77:01:0001001:2")
+        yield Cn.zu("77:01:0001001:1")
+
+    with BulkJob(api, tmp_path / "journal.sqlite") as job:
+        async for cn, _ in job.run(cns()):
+            first_done.set()
+        assert job.progress.done == 2
+    assert api.calls == ["77:01:0001001:1", "77:01:0001001:2"]
+
+
+@pytest.mark.asyncio
+async def test_bulk_job_dedups_cleaned_codes(tmp_path):
+    api = FakePKK(broken=set())
+    cns = [Cn.zu("77:01:0001001:1"), Cn.zu("77:1:1001:1"), Cn.zu("77:01:1001:01")]
+    with BulkJob(api, tmp_path / "journal.sqlite") as job:
+        results = [i async for i in job.run(cns)]
+        assert job.add([Cn.zu("77:1:0001001:1")]) == 0
+        assert job.progress.total == 1
+    assert len(results) == 1
+    assert api.calls == ["77:01:0001001:1"]
+
+
+def test_bulk_job_cleans_old_journal(tmp_path):
+    path = tmp_path / "journal.sqlite"
+    with BulkJob(FakePKK(broken=set()), path) as job:
+        pass
+    db = sqlite3.connect(path)
+    with db:
+        db.executemany(
+            "INSERT INTO journal (kind, code, state) VALUES (1, ?, ?)",
+            [("77:01:0001001:1", "done"), ("77:1:1001:1", "pending")],
+        )
+    db.close()
+    with BulkJob(FakePKK(broken=set()), path) as job:
+        assert job.progress.total == 1
+        assert job.progress.done == 1
@@ -0,0 +1,383 @@
+import subprocess
+import sys
+
+import pytest
+from shapely.affinity import translate
+from shapely.geometry import box
+from shapely.ops import unary_union
+
+from pypkk.api import PKK, AsyncPKK, NoCoordsFeatureError
+from pypkk.geom_utils import to_4326
+from pypkk.geometry_cache import GeometryCache
+from pypkk.instrumentation import StatsAggregator
+from pypkk.requests import TileLayer
+from pypkk.schemas.coords import PkkExtent
+from pypkk.schemas.inputs import Cn
+from pypkk.testing import (
+    ORIGIN_3857,
+    FakeFeature,
+    FakePkkTransport,
+    RecordingTransport,
+    sample_kvartal,
+    sample_parcels,
+)
+from pypkk.tile_utils import generate_tile_extents
+
+NO_LIMITS = {"api_rate_limit": None, "tile_rate_limit": None}
+
+
+@pytest.fixture(scope="module")
+def parcels():
+    return sample_parcels()
+
+
+def relative_error(geojson, parcel) -> float:
+    reference = to_4326(parcel.geometry)
+    diff = geojson.shapely_geometry.symmetric_difference(reference)
+    return diff.area / reference.area
+
+
+def test_get_geojson(parcels):
+    parcel = parcels["complex"]
+    fake = FakePkkTransport(parcels.values())
+    with PKK(cache_type=None, transport=fake, **NO_LIMITS) as api:
+        feature = api.get_attrs(Cn.zu(parcel.code)).feature
+        assert feature.attrs.cn == parcel.code
+        geojson = api.get_geojson(feature)
+    assert relative_error(geojson, parcel) < 0.01
+    assert fake.calls["api", 200] == 1
+    assert fake.calls["tile", 200] > 1
+
+
+def test_get_geojson_output_crs(parcels):
+    parcel = parcels["small"]
+    fake = FakePkkTransport(parcels.values())
+    with PKK(cache_type=None, transport=fake, output_crs=3857, **NO_LIMITS) as api:
+        geojson = api.get_geojson(api.get_attrs(Cn.zu(parcel.code)).feature)
+    diff = geojson.shapely_geometry.symmetric_difference(parcel.geometry)
+    assert diff.area / parcel.geometry.area < 0.01
+
+
+@pytest.mark.parametrize("tile_planner", ["grid", "adaptive"])
+def test_get_geojson_tile_budget(parcels, tile_planner, tmp_path):
+    parcel = parcels["large"]
+    fake = FakePkkTransport(parcels.values())
+    events = []
+    with PKK(
+        cache_dir=tmp_path,
+        tile_planner=tile_planner,
+        transport=fake,
+        observer=events.append,
+        **NO_LIMITS,
+    ) as api:
+        feature = api.get_attrs(Cn.zu(parcel.code)).feature
+        geojson = api.get_geojson(feature, resolution=0.5, max_tiles=6)
+        budget = fake.calls["tile", 200]
+        # геометрия другого разрешения не кладется в кэш геометрий
+        api.get_geojson(feature, resolution=0.5, max_tiles=6)
+    assert [i.data["from_cache"] for i in events if i.name == "geojson"] == [
+        False,
+        False,
+    ]
+    assert budget <= 6 + (tile_planner == "adaptive")
+    assert budget < len(generate_tile_extents(feature.extent))
+    assert relative_error(geojson, parcel) < 0.02
+
+
+@pytest.mark.asyncio
+async def test_adaptive_falls_back_when_coarse_pass_is_empty():
+    # полоса 2 м шириной на грубом тайле тоньше пикселя и пропадает
+    strip = FakeFeature(
+        "77:01:0001001:104",
+        translate(box(0, 0, 6000, 2), ORIGIN_3857[0], ORIGIN_3857[1] + 5000),
+    )
+    fake = FakePkkTransport([strip])
+    feature_json = strip.to_json()
+    grid_tiles = len(generate_tile_extents(PkkExtent(**feature_json["extent"])))
+    with PKK(cache_type=None, transport=fake, **NO_LIMITS) as api:
+        geojson = api.get_geojson(api.get_attrs(Cn.zu(strip.code)).feature)
+    assert relative_error(geojson, strip) < 0.05
+    # грубый тайл и полная сетка
+    assert fake.calls["tile", 200] == 1 + grid_tiles
+    async with AsyncPKK(
+        cache_type=None, executor=None, transport=fake, **NO_LIMITS
+    ) as api:
+        async_geojson = await api.find_geojson(Cn.zu(strip.code))
+    assert async_geojson.geometry == geojson.geometry
+
+
+def test_missing_feature_and_search_at_point(parcels):
+    fake = FakePkkTransport(parcels.values())
+    with PKK(cache_type=None, transport=fake, **NO_LIMITS) as api:
+        assert api.get_attrs(Cn.zu("77:01:0001001:999")).feature is None
+        point = to_4326(parcels["small"].geometry.representative_point())
+        found = api.search_at_point(point.x, point.y, types=[1])
+    assert [i.attrs.cn for i in found.results] == [parcels["small"].code]
+
+
+@pytest.mark.asyncio
+async def test_async_errors_are_retried(parcels):
+    parcel = parcels["small"]
+    fake = FakePkkTransport(
+        parcels.values(), api_errors={502: 0.5}, tile_errors={400: 0.5}, seed=1
+    )
+    async with AsyncPKK(
+        cache_type=None, executor=None, transport=fake, **NO_LIMITS
+    ) as api:
+        geojson = await api.find_geojson(Cn.zu(parcel.code))
+    assert relative_error(geojson, parcel) < 0.01
+    assert fake.calls["api", 502] > 0 or fake.calls["tile", 400] > 0
+
+
+def test_record_and_replay(parcels, tmp_path):
+    parcel = parcels["small"]
+    fake = FakePkkTransport(parcels.values())
+    recorder = RecordingTransport(fake, tmp_path)
+    with PKK(cache_type=None, transport=recorder, **NO_LIMITS) as api:
+        feature = api.get_attrs(Cn.zu(parcel.code)).feature
+        expected = api.get_geojson(feature)
+
+    replay = FakePkkTransport(recordings=tmp_path)
+    with PKK(cache_type=None, transport=replay, **NO_LIMITS) as api:
+        feature = api.get_attrs(Cn.zu(parcel.code)).feature
+        assert api.get_geojson(feature) == expected
+
+
+@pytest.mark.asyncio
+async def test_async_duplicates_are_coalesced(parcels):
+    parcel = parcels["complex"]
+    fake = FakePkkTransport(parcels.values())
+    cns = [Cn.zu(parcel.code)] * 4
+    async with AsyncPKK(
+        cache_type=None, executor=None, transport=fake, **NO_LIMITS
+    ) as api:
+        results = [r async for _, r in api.find_geojson_many(cns, concurrency=4)]
+        assert api.coalesce_stats.shared > 0
+    assert all(i == results[0] for i in results)
+    assert fake.calls["api", 200] == 1
+    single = FakePkkTransport(parcels.values())
+    async with AsyncPKK(
+        cache_type=None, executor=None, transport=single, **NO_LIMITS
+    ) as api:
+        await api.find_geojson(Cn.zu(parcel.code))
+    assert fake.calls["tile", 200] == single.calls["tile", 200]
+
+
+@pytest.mark.parametrize("outline", [True, False])
+def test_harvest_kvartal(outline):
+    kvartal, parcels = sample_kvartal()
+    fake = FakePkkTransport([kvartal, *parcels, *sample_parcels().values()])
+    with PKK(cache_type=None, transport=fake, **NO_LIMITS) as api:
+        harvested = api.harvest_kvartal(Cn.kvartal(kvartal.code), outline=outline)
+    by_cn = {i.properties.cn: i for i in harvested}
+    assert sorted(by_cn) == sorted(i.code for i in parcels)
+    for parcel in parcels:
+        assert relative_error(by_cn[parcel.code], parcel) < 0.05
+    if outline:
+        # один общий тайл на квартал и отдельный запрос для участка
+        # из двух контуров вместо тайлов на каждый участок
+        assert fake.calls["tile", 200] == 2
+
+
+@pytest.mark.asyncio
+async def test_async_harvest_kvartal():
+    kvartal, parcels = sample_kvartal()
+    fake = FakePkkTransport([kvartal, *parcels])
+    async with AsyncPKK(
+        cache_type=None, executor=None, transport=fake, **NO_LIMITS
+    ) as api:
+        harvested = await api.harvest_kvartal(Cn.kvartal(kvartal.code))
+    assert sorted(i.properties.cn for i in harvested) == sorted(i.code for i in parcels)
+    with PKK(cache_type=None, transport=fake, **NO_LIMITS) as api:
+        expected = api.harvest_kvartal(Cn.kvartal(kvartal.code))
+    # участок из двух контуров найден в двух сегментах: результат
+    # не зависит от порядка завершения задач и совпадает с синхронным
+    assert [i.properties.cn for i in harvested] == [i.properties.cn for i in expected]
+    for actual, geojson in zip(harvested, expected):
+        assert actual.shapely_geometry.equals(geojson.shapely_geometry)
+
+
+def test_get_geojson_batch(parcels):
+    _, neighbours = sample_kvartal()
+    # соседи умещаются в общий тайл, small - далеко от них
+    expected = [*neighbours, parcels["small"]]
+    fake = FakePkkTransport(expected)
+    with PKK(cache_type=None, transport=fake, **NO_LIMITS) as api:
+        features = [api.get_attrs(Cn.zu(i.code)).feature for i in expected]
+        geojsons = api.get_geojson_batch(features)
+        batch_tiles = fake.calls["tile", 200]
+        for feature in features:
+            api.get_geojson(feature)
+    single_tiles = fake.calls["tile", 200] - batch_tiles
+    for parcel, geojson in zip(expected, geojsons):
+        assert geojson.properties.cn == parcel.code
+        assert relative_error(geojson, parcel) < 0.05
+    # общий тайл соседей, участок из двух контуров и small
+    assert batch_tiles == 3
+    assert single_tiles == len(expected)
+
+
+@pytest.mark.asyncio
+async def test_async_get_geojson_batch():
+    _, neighbours = sample_kvartal()
+    fake = FakePkkTransport(neighbours)
+    async with AsyncPKK(
+        cache_type=None, executor=None, transport=fake, **NO_LIMITS
+    ) as api:
+        features = [(await api.get_attrs(Cn.zu(i.code))).feature for i in neighbours]
+        geojsons = await api.get_geojson_batch(features)
+    assert [i.properties.cn for i in geojsons] == [i.code for i in neighbours]
+    assert fake.calls["tile", 200] == 2
+
+
+def test_get_geojson_batch_per_item_errors(parcels, monkeypatch):
+    _, neighbours = sample_kvartal()
+    fake = FakePkkTransport(neighbours)
+    with PKK(cache_type=None, transport=fake, **NO_LIMITS) as api:
+        features = [api.get_attrs(Cn.zu(i.code)).feature for i in neighbours]
+        features.insert(1, features[1].model_copy(update={"extent": None}))
+        fetch_tiles = api._fetch_tiles
+
+        def fail_shared_tile(layer, *args):
+            if isinstance(layer, TileLayer):
+                raise RuntimeError("общий тайл недоступен")
+            return fetch_tiles(layer, *args)
+
+        monkeypatch.setattr(api, "_fetch_tiles", fail_shared_tile)
+        results = api.get_geojson_batch(features)
+    assert isinstance(results[1], NoCoordsFeatureError)
+    # без общего тайла остальные объекты построены по одному
+    geojsons = [i for n, i in enumerate(results) if n != 1]
+    assert [i.properties.cn for i in geojsons] == [i.code for i in neighbours]
+
+
+@pytest.mark.asyncio
+async def test_async_get_geojson_batch_is_bounded(tmp_path, monkeypatch):
+    _, neighbours = sample_kvartal()
+    fake = FakePkkTransport(neighbours)
+    reads = []
+    get = GeometryCache.get
+    monkeypatch.setattr(
+        GeometryCache, "get", lambda self, f: reads.append(f.attrs.cn) or get(self, f)
+    )
+    async with AsyncPKK(
+        cache_dir=tmp_path, executor=None, transport=fake, **NO_LIMITS
+    ) as api:
+        features = [(await api.get_attrs(Cn.zu(i.code))).feature for i in neighbours]
+        build_geojson = api._build_geojson
+        running = peak = 0
+
+        async def track(feature):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            try:
+                return await build_geojson(feature)
+            finally:
+                running -= 1
+
+        monkeypatch.setattr(api, "_build_geojson", track)
+        monkeypatch.setattr("pypkk.batch.plan_batches", lambda f: ([], []))
+        geojsons = await api.get_geojson_batch(features, concurrency=1)
+    assert [i.properties.cn for i in geojsons] == [i.code for i in neighbours]
+    assert peak == 1
+    # кэш геометрий читается один раз на объект
+    assert sorted(reads) == sorted(i.code for i in neighbours)
+
+
+def test_search_in_polygon():
+    kvartal, parcels = sample_kvartal()
+    area = to_4326(unary_union([i.geometry for i in parcels]).envelope)
+    fake = FakePkkTransport([kvartal, *parcels])
+    with PKK(cache_type=None, transport=fake, **NO_LIMITS) as api:
+        found = list(api.search_in_polygon(area, limit=None, types=[1]))
+        pruned_calls = fake.calls["api", 200]
+        first = list(api.search_in_polygon(area, limit=3, types=[1]))
+        fake.calls.clear()
+        list(api.search_in_polygon(area, limit=None, types=[1], prune=False))
+    assert sorted(i.attrs.cn for i in found) == sorted(i.code for i in parcels)
+    assert len(first) == 3
+    # ячейки внутри экстентов найденных участков не запрашиваются
+    assert pruned_calls < fake.calls["api", 200] / 2
+
+
+@pytest.mark.asyncio
+async def test_async_search_in_polygon():
+    kvartal, parcels = sample_kvartal()
+    fake = FakePkkTransport([kvartal, *parcels])
+    async with AsyncPKK(
+        cache_type=None, executor=None, transport=fake, **NO_LIMITS
+    ) as api:
+        found = [
+            i
+            async for i in api.search_in_polygon(
+                to_4326(kvartal.geometry), limit=None, types=[1]
+            )
+        ]
+    assert sorted(i.attrs.cn for i in found) == sorted(i.code for i in parcels)
+
+
+def test_tile_formats(parcels):
+    parcel = parcels["complex"]
+    results = {}
+    for tile_format, binary_tiles in [
+        ("json", True),
+        ("image", True),
+        ("image", False),
+    ]:
+        fake = FakePkkTransport(parcels.values(), binary_tiles=binary_tiles)
+        stats = StatsAggregator()
+        with PKK(
+            cache_type=None,
+            transport=fake,
+            tile_format=tile_format,
+            observer=stats,
+            **NO_LIMITS,
+        ) as api:
+            geojson = api.get_geojson(api.get_attrs(Cn.zu(parcel.code)).feature)
+        results[tile_format, binary_tiles] = (geojson, stats.summary())
+    json_geojson, json_stats = results["json", True]
+    image_geojson, image_stats = results["image", True]
+    assert image_geojson == json_geojson
+    # base64 в json - на треть больше байтов
+    assert image_stats["http"].counters["bytes"] < json_stats["http"].counters["bytes"]
+    # сервер без f=image: каждый тайл повторяется в json
+    fallback_geojson, fallback_stats = results["image", False]
+    assert fallback_geojson == json_geojson
+    assert fallback_stats["retry"].count == json_stats["tiles"].counters["tiles"]
+
+
+# скрипт без `if __name__ == "__main__":` - с пулом процессов spawn
+# по умолчанию он падал бы на первой векторизации
+_UNGUARDED_SCRIPT = """
+import asyncio
+from pypkk.api import AsyncPKK
+from pypkk.schemas.inputs import Cn
+from pypkk.testing import FakePkkTransport, sample_parcels
+
+parcel = sample_parcels()["small"]
+
+
+async def main():
+    async with AsyncPKK(
+        cache_type=None,
+        transport=FakePkkTransport([parcel]),
+        api_rate_limit=None,
+        tile_rate_limit=None,
+    ) as api:
+        geojson = await api.find_geojson(Cn.zu(parcel.code))
+    print(geojson.properties.cn)
+
+
+asyncio.run(main())
+"""
+
+
+def test_async_default_executor_without_main_guard(parcels, tmp_path):
+    script = tmp_path / "script.py"
+    script.write_text(_UNGUARDED_SCRIPT)
+    result = subprocess.run(
+        [sys.executable, str(script)], capture_output=True, text=True, timeout=120
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == parcels["small"].code
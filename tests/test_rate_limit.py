@@ -0,0 +1,27 @@
+import asyncio
+from time import monotonic
+
+import pytest
+
+from pypkk.rate_limit import TokenBucket
+
+
+def test_token_bucket_burst():
+    limiter = TokenBucket(rate=10, burst=3)
+    delays = [limiter.reserve() for _ in range(5)]
+    assert delays[:3] == [0, 0, 0]
+    assert delays[3] == pytest.approx(0.1, abs=0.01)
+    assert delays[4] == pytest.approx(0.2, abs=0.01)
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_async_stats():
+    limiter = TokenBucket(rate=20, burst=1)
+    start = monotonic()
+    await asyncio.gather(*[limiter.acquire_async() for _ in range(5)])
+    assert monotonic() - start >= 0.19
+    stats = limiter.stats
+    assert stats.requests == 5
+    assert stats.waits == 4
+    assert stats.max_queue_depth == 4
+    assert stats.queue_depth == 0
@@ -0,0 +1,147 @@
+import httpx
+import pytest
+
+from pypkk.requests import (
+    PNG_SIGNATURE,
+    TileCircuitOpenError,
+    TileLayer,
+    TileServerNotResponsedError,
+    api_request,
+    async_api_request,
+    async_tile_request,
+    tile_request,
+)
+from pypkk.retry import CircuitOpenError, RetryPolicy
+from pypkk.schemas.coords import PkkExtent
+
+LAYER = TileLayer(1, "ID = '77:1:1:1'")
+
+
+def _policy(**kwargs) -> RetryPolicy:
+    defaults = {"base_delay": 0, "budget_ratio": None, "failure_threshold": None}
+    return RetryPolicy(**{**defaults, **kwargs})
+
+
+def _client(statuses: list[int], requests: list[httpx.Request]) -> httpx.Client:
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        status = statuses.pop(0) if statuses else 200
+        if status != 200:
+            return httpx.Response(status)
+        if "export" in request.url.path:
+            return httpx.Response(200, content=PNG_SIGNATURE)
+        return httpx.Response(200, json={"feature": None})
+
+    return httpx.Client(transport=httpx.MockTransport(handler))
+
+
+def test_tile_400_does_not_mutate_extent():
+    extent = PkkExtent(xmin=0, ymin=0, xmax=100, ymax=100)
+    requests = []
+    client = _client([400, 400], requests)
+    tile = tile_request(client, LAYER, extent, tile_format="image", retry=_policy())
+    assert extent == PkkExtent(xmin=0, ymin=0, xmax=100, ymax=100)
+    bboxes = [i.url.params["bbox"] for i in requests]
+    assert len(set(bboxes)) == 3
+    # тайл привязан к тому bbox, который запрошен последним
+    assert bboxes[-1] == ",".join(
+        map(
+            str,
+            [tile.extent.xmin, tile.extent.ymin, tile.extent.xmax, tile.extent.ymax],
+        )
+    )
+
+
+def test_tile_retries_are_bounded():
+    requests = []
+    client = _client([502] * 10, requests)
+    extent = PkkExtent(xmin=0, ymin=0, xmax=100, ymax=100)
+    with pytest.raises(TileServerNotResponsedError):
+        tile_request(client, LAYER, extent, retry=_policy(tile_tries=4))
+    assert len(requests) == 4
+
+
+@pytest.mark.asyncio
+async def test_api_retries_are_iterative():
+    # рекурсия на каждый 502 упала бы с RecursionError
+    statuses = [502] * 2000
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(statuses.pop() if statuses else 200, json={})
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        assert (
+            await async_api_request(
+                client, "get", "/features/", retry=_policy(api_tries=5000)
+            )
+            == {}
+        )
+    assert len(requests) == 2001
+
+
+def test_circuit_breaker_fails_fast():
+    requests = []
+    client = _client([502] * 100, requests)
+    policy = _policy(api_tries=2, failure_threshold=3, reset_timeout=60)
+    for _ in range(2):
+        with pytest.raises(httpx.HTTPStatusError):
+            api_request(client, "get", "/features/", retry=policy)
+    assert policy.breakers["api"].state == "open"
+    with pytest.raises(CircuitOpenError):
+        api_request(client, "get", "/features/", retry=policy)
+    # автомат разомкнулся на третьем сбое, третий запрос отклонен без отправки
+    assert len(requests) == 3
+    assert policy.stats.circuit_opened == 1
+    assert policy.stats.rejected == 1
+
+
+@pytest.mark.asyncio
+async def test_tile_circuit_open_is_tile_error():
+    requests = []
+    extent = PkkExtent(xmin=0, ymin=0, xmax=100, ymax=100)
+    policy = _policy(tile_tries=2, failure_threshold=2, reset_timeout=60)
+    client = _client([502] * 100, requests)
+    with pytest.raises(TileServerNotResponsedError):
+        tile_request(client, LAYER, extent, retry=policy)
+    # вызывающий код ловит отказ сервера тайлов одним типом ошибки
+    with pytest.raises(TileServerNotResponsedError) as e:
+        tile_request(client, LAYER, extent, retry=policy)
+    assert isinstance(e.value, CircuitOpenError)
+    async with httpx.AsyncClient(transport=client._transport) as async_client:
+        with pytest.raises(TileCircuitOpenError):
+            await async_tile_request(async_client, LAYER, extent, retry=policy)
+    assert len(requests) == 2
+
+
+def test_default_policy_is_shared(monkeypatch):
+    policy = _policy(failure_threshold=1, reset_timeout=60)
+    monkeypatch.setattr("pypkk.requests._DEFAULT_RETRY", policy)
+    requests = []
+    client = _client([502] * 100, requests)
+    with pytest.raises(httpx.HTTPStatusError):
+        api_request(client, "get", "/features/")
+    # автомат, разомкнутый первым запросом, отклоняет следующий
+    with pytest.raises(CircuitOpenError):
+        api_request(client, "get", "/features/")
+    assert len(requests) == 1
+
+
+def test_retry_budget():
+    requests = []
+    client = _client([502] * 100, requests)
+    policy = _policy(api_tries=100, budget_ratio=0, budget_min_per_second=0)
+    with pytest.raises(httpx.HTTPStatusError):
+        api_request(client, "get", "/features/", retry=policy)
+    # запас бюджета - 10 повторов
+    assert len(requests) == 11
+    assert policy.stats.budget_exhausted == 1
+
+
+def test_backoff_full_jitter():
+    policy = RetryPolicy(base_delay=1, max_delay=8, seed=0)
+    for retry in range(6):
+        delays = [policy.backoff(retry) for _ in range(200)]
+        assert 0 <= min(delays) and max(delays) <= min(8, 2**retry)
+        assert len(set(delays)) == len(delays)
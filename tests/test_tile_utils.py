@@ -0,0 +1,53 @@
+from shapely.geometry import LineString
+
+from pypkk.schemas.coords import PkkExtent
+from pypkk.tile_utils import (
+    MAX_SUBTILES_PER_CN,
+    PKK_MAX_TILE_SIZE,
+    TILE_BUFFER,
+    generate_refined_tile_extents,
+    generate_tile_extents,
+    plan_tile_extents,
+)
+
+
+def test_refined_tiles_follow_boundary():
+    road = LineString([(0, 0), (3000, 500), (6000, -800)]).buffer(12)
+    xmin, ymin, xmax, ymax = road.bounds
+    extent = PkkExtent(xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax)
+    cells, scale = generate_refined_tile_extents(extent, road)
+    assert len(cells) < len(generate_tile_extents(extent)) / 2
+    assert len(cells) <= MAX_SUBTILES_PER_CN
+    for i in cells:
+        assert xmin <= i.xmin < i.xmax <= xmax
+
+
+def test_plan_tile_extents_budget():
+    for width, height, max_tiles in [(50, 40, 100), (20000, 3000, 100), (9e4, 1e3, 7)]:
+        extent = PkkExtent(xmin=0, ymin=0, xmax=width, ymax=height)
+        extents, scale = plan_tile_extents(extent, 0.1, max_tiles)
+        assert 0 < len(extents) <= max_tiles
+        assert scale <= 10
+        for i in extents:
+            size = max(i.xmax - i.xmin, i.ymax - i.ymin) * scale
+            assert round(size) <= PKK_MAX_TILE_SIZE
+        # при чуть большем масштабе сетка в бюджет уже не укладывается
+        if scale < 10:
+            cell = PKK_MAX_TILE_SIZE / (scale * 1.01) - TILE_BUFFER * 2
+            assert (width // cell + 1) * (height // cell + 1) > max_tiles
+
+
+def test_refined_scale_is_largest_within_budget():
+    # при полном масштабе граничных ячеек больше бюджета
+    road = LineString([(0, 0), (30000, 5000), (60000, -8000)]).buffer(12)
+    xmin, ymin, xmax, ymax = road.bounds
+    extent = PkkExtent(xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax)
+    full, _ = generate_refined_tile_extents(extent, road, max_tiles=10_000)
+    assert len(full) > MAX_SUBTILES_PER_CN
+    cells, scale = generate_refined_tile_extents(extent, road)
+    assert 0 < len(cells) <= MAX_SUBTILES_PER_CN
+    assert scale < 10
+    larger, _ = generate_refined_tile_extents(
+        extent, road, resolution=1 / (scale * 1.03), max_tiles=10_000
+    )
+    assert len(larger) > MAX_SUBTILES_PER_CN
@@ -0,0 +1,82 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from pypkk.api import PKK
+from pypkk.transport import PoolConfig, TransportManager
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("content-length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/"
+    httpd.shutdown()
+
+
+def test_pool_shared_between_clients(server):
+    with TransportManager(PoolConfig(keepalive_expiry=60)) as manager:
+        for _ in range(3):
+            with httpx.Client(transport=manager.transport()) as client:
+                assert client.get(server).text == "ok"
+        stats = manager.stats
+    assert stats.requests == 3
+    assert stats.connections_opened == 1
+    assert stats.reuse == pytest.approx(2 / 3)
+    assert stats.by_host == {"127.0.0.1": 1}
+    assert stats.idle == 1
+
+
+@pytest.mark.asyncio
+async def test_async_pool_shared_between_clients(server):
+    async with TransportManager() as manager:
+        for _ in range(2):
+            async with httpx.AsyncClient(transport=manager.async_transport()) as c:
+                assert (await c.get(server)).text == "ok"
+        assert manager.async_stats.connections_opened == 1
+
+
+def test_pkk_does_not_close_shared_pool():
+    manager = TransportManager()
+    with PKK(cache_type=None, transport_manager=manager) as api:
+        assert api.pool_stats.requests == 0
+    assert manager._transport is not None
+    manager.close()
+    with pytest.raises(ValueError):
+        PKK(cache_type=None, pool=PoolConfig(), transport_manager=manager)
+
+
+def test_stats_without_pool_introspection(server, monkeypatch):
+    # пул httpcore недоступен - счетчики из trace-событий, снимок пустой
+    monkeypatch.setattr("pypkk.transport._connection_pool", lambda transport: None)
+    traced = []
+    with TransportManager(PoolConfig(keepalive_expiry=60)) as manager:
+        with httpx.Client(transport=manager.transport()) as client:
+            for _ in range(2):
+                response = client.get(
+                    server, extensions={"trace": lambda *args: traced.append(args)}
+                )
+                assert response.text == "ok"
+        stats = manager.stats
+    assert not stats.snapshot
+    assert stats.requests == 2
+    assert stats.connections_opened == 1
+    assert stats.connections == 0 and stats.by_host == {}
+    # чужой trace по-прежнему вызывается
+    assert any(name == "connection.connect_tcp.complete" for name, _ in traced)
@@ -0,0 +1,128 @@
+import json
+import sqlite3
+import struct
+
+import pytest
+import shapely
+from shapely.geometry import MultiPolygon, box, mapping
+
+from pypkk.geom_utils import to_3857
+from pypkk.schemas.features import PkkGeojson
+from pypkk.writers import RECORD_SEPARATOR, GeoJsonSeqWriter, GeoPackageWriter
+
+
+def _features(count: int, start: int = 0) -> list[PkkGeojson]:
+    return [
+        PkkGeojson(
+            geometry=mapping(
+                MultiPolygon([box(37 + i * 0.01, 55, 37.005 + i * 0.01, 55.005)])
+            ),
+            properties={
+                "id": f"77:1:1:{i}",
+                "cn": f"77:01:0000001:{i}",
+                "area_value": 100.5 if i % 2 else None,
+                "address": f"адрес {i}",
+            },
+        )
+        for i in range(start, start + count)
+    ]
+
+
+def test_geojsonseq_writer(tmp_path):
+    path = tmp_path / "out.geojsons"
+    features = _features(3)
+    with GeoJsonSeqWriter(path) as writer:
+        for i in features:
+            writer.write(i)
+    records = path.read_text(encoding="utf-8").split(RECORD_SEPARATOR)[1:]
+    assert [PkkGeojson.model_validate_json(i) for i in records] == features
+
+
+def test_geopackage_writer(tmp_path):
+    path = tmp_path / "out.gpkg"
+    with GeoPackageWriter(path, batch_size=2) as writer:
+        for i in _features(5):
+            writer.write(i)
+    # дозапись в существующий файл
+    with GeoPackageWriter(path) as writer:
+        writer.write(_features(1, start=5)[0])
+
+    db = sqlite3.connect(path)
+    assert db.execute("PRAGMA application_id").fetchone()[0] == 0x47504B47
+    rows = db.execute(
+        "SELECT fid, geom, cn, area_value, address FROM features ORDER BY fid"
+    ).fetchall()
+    assert [i[0] for i in rows] == list(range(1, 7))
+    assert rows[1][2:] == ("77:01:0000001:1", 100.5, "адрес 1")
+    assert rows[0][3] is None
+    magic, version, flags, srs_id, minx, maxx, miny, maxy = struct.unpack(
+        "<2sBBi4d", rows[0][1][:40]
+    )
+    assert (magic, flags, srs_id) == (b"GP", 0b011, 4326)
+    geom = shapely.from_wkb(rows[0][1][40:])
+    assert geom.equals(MultiPolygon([box(37, 55, 37.005, 55.005)]))
+    assert (minx, miny, maxx, maxy) == pytest.approx(geom.bounds)
+    hits = db.execute(
+        "SELECT id FROM rtree_features_geom WHERE minx <= 37.025 AND maxx >= 37.025"
+    ).fetchall()
+    assert hits == [(3,)]
+    extent = db.execute(
+        "SELECT min_x, max_x FROM gpkg_contents WHERE table_name = 'features'"
+    ).fetchone()
+    assert extent == pytest.approx((37, 37.055))
+    geometry_type = db.execute(
+        "SELECT geometry_type_name, srs_id FROM gpkg_geometry_columns"
+    ).fetchone()
+    assert geometry_type == ("MULTIPOLYGON", 4326)
+    db.close()
+
+
+def test_geopackage_writer_3857(tmp_path):
+    path = tmp_path / "out.gpkg"
+    features = [
+        PkkGeojson(
+            geometry=mapping(to_3857(i.shapely_geometry)), properties=i.properties
+        )
+        for i in _features(2)
+    ]
+    with GeoPackageWriter(path, crs=3857) as writer:
+        for i in features:
+            writer.write(i)
+    # таблицу в epsg:3857 нельзя дописать объектами в epsg:4326
+    with pytest.raises(ValueError):
+        GeoPackageWriter(path)
+
+    db = sqlite3.connect(path)
+    blob = db.execute("SELECT geom FROM features WHERE fid = 1").fetchone()[0]
+    assert struct.unpack("<i", blob[4:8])[0] == 3857
+    assert shapely.from_wkb(blob[40:]).equals(features[0].shapely_geometry)
+    srs = db.execute(
+        "SELECT s.srs_id, s.organization_coordsys_id, s.definition "
+        "FROM gpkg_geometry_columns g JOIN gpkg_contents c USING (table_name) "
+        "JOIN gpkg_spatial_ref_sys s ON s.srs_id = g.srs_id AND s.srs_id = c.srs_id"
+    ).fetchone()
+    assert srs[:2] == (3857, 3857)
+    assert 'AUTHORITY["EPSG","3857"]' in srs[2]
+    min_x, max_x = db.execute("SELECT min_x, max_x FROM gpkg_contents").fetchone()
+    assert min_x == pytest.approx(features[0].shapely_geometry.bounds[0])
+    assert max_x > 4e6
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_write_from_results(tmp_path):
+    features = _features(2)
+
+    async def results():
+        yield "77:01:0000001:0", features[0]
+        yield "77:01:0000001:9", None
+        yield "77:01:0000001:8", RuntimeError()
+        yield features[1]
+
+    with GeoJsonSeqWriter(tmp_path / "out.ndjson", record_separator=False) as writer:
+        assert await writer.write_from(results()) == 2
+    lines = (tmp_path / "out.ndjson").read_text(encoding="utf-8").splitlines()
+    assert [json.loads(i)["properties"]["cn"] for i in lines] == [
+        "77:01:0000001:0",
+        "77:01:0000001:1",
+    ]